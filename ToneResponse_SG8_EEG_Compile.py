@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""Compile a ToneResponse_SG8_EEG session ahead of time.
+
+Everything that does not need the participant is done here: drawing the
+silences, filling the schedule, synthesizing and rendering the audio,
+shuffling and writing the schedule. The result is a bundle (see
+meeg.bundle) that ToneResponse_SG8_EEG_Exp.py maps and runs right away.
+
+    python ToneResponse_SG8_EEG_Compile.py SUBJID --seed 1234
+
+The same subject ID and seed always give the same session. The plans of a
+whole cohort can be drawn up front, counterbalanced across subjects, into
+one file (see meeg.cohort); sessions of its subjects then follow their plan:
+
+    python ToneResponse_SG8_EEG_Compile.py --cohort S01 S02 S03 --seed 1234
+    python ToneResponse_SG8_EEG_Compile.py S02
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import io
+import json
+import os
+from os.path import join as opj
+from typing import List
+import numpy as np
+
+from meeg.stimcache import StimulusCache
+from meeg.stimstore import StimulusStore
+from meeg.blocks import render_block
+from meeg import timing
+from meeg.bundle import write_bundle
+from meeg.cohort import (CohortFile, balanced_order, subject_seed,
+                         williams_square, write_cohort)
+from meeg.schedule import pack_schedule
+from meeg.trialtable import TrialTable
+
+STIM_DIR: str = './stims/'
+BUNDLE_DIR: str = './bundles/'
+# counterbalanced plans of all subjects (see buildCohort)
+COHORT_FILE: str = opj(BUNDLE_DIR, 'cohort.dat')
+# seeds of subjects compiled without a seed and not in the cohort file are
+# derived from this and their ID
+defaultBaseSeed: int = 0
+
+# how many seconds we have available
+experimentTimeMax_sec: int = 600 / 2 # 5 minutes eyes open, 5 minutes eyes closed
+
+# Standard is usually 44.1 or 48 kHz
+audioSamplingRate: float = 44100.
+
+# how long should the tone be
+requiredAudStimDur_sec: float = 15.
+
+# how many times we play the tone for requiredAudStimDur_sec
+nRepsRequired: int = 1
+
+# for the other trials, this is the minimum duration to play the tone
+audStimDurMin_sec: float = 1.0
+
+# for the other trials, this is the maximum duration to play the tone
+audStimDurMax_sec: float = 2.5
+
+# Fade in/out duration at beginning and end of tone
+audStimTaper_sec: float = 0.1
+
+# render each condition (tones and silences) into a single buffer that is
+# played with one call, so tone onsets are fixed to the sample
+renderWholeBlocks: bool = True
+
+# with rendered blocks, write each tone's trigger code as a pulse train at
+# its onset into an audio channel (feed it to an EEG aux input): 0 = left,
+# 1 = right (tone stays on the other channel), 2 = dedicated third channel.
+# None sends triggers through the parallel port only.
+audioTriggerChannel = None
+useAudioTriggers: bool = renderWholeBlocks and audioTriggerChannel is not None
+
+# memory budget for synthesized stimuli (~25 min of unique stereo audio)
+stimCacheMaxBytes: int = 256 * 2**20
+
+# on-disk stimulus store limits (in ./stims/)
+stimStoreMaxBytes: int = 2 * 2**30
+stimStoreMaxAge_days: float = 90.
+
+# how long between each tone?
+silenceDurationMin_sec: float = 0.8
+silenceDurationMax_sec: float = 2.5
+
+# configure Parallel Port triggers for EEG
+# 8 bit unsigned integer from 0 to 255
+# 0 = no trigger
+# 'open' = eyes open condition
+# 'closed' = eyes closed condition
+triggerMap: dict = {
+    50: {'open': 11, 'closed': 21},
+    100: {'open': 12, 'closed': 22},
+    250: {'open': 13, 'closed': 23},
+    500: {'open': 14, 'closed': 24},
+    2500: {'open': 15, 'closed': 25},
+    5000: {'open': 16, 'closed': 26},
+    7500: {'open': 17, 'closed': 27},
+    15000: {'open': 18, 'closed': 28},
+}
+
+# list of all tones we want to play
+stimListHz: List[int] = list(triggerMap.keys())
+nStims: int = len(stimListHz)
+
+# extra triggers
+triggerMap['stop'] = 0
+triggerMap['start'] = 1
+triggerMap['open'] = 10
+triggerMap['closed'] = 20
+
+# conditions (blocks), in the order they are run outside a cohort; in a
+# cohort the order alternates between subjects
+conditions: List[str] = ['open', 'closed']
+
+TRIALS_CSV_NAME: str = 'trials.csv'
+
+
+def sessionConfig() -> dict:
+    """Settings a compiled session depends on (stored in the bundle)."""
+    config = dict(experimentTimeMax_sec=experimentTimeMax_sec,
+                  audioSamplingRate=audioSamplingRate,
+                  requiredAudStimDur_sec=requiredAudStimDur_sec,
+                  audStimDurMin_sec=audStimDurMin_sec,
+                  audStimDurMax_sec=audStimDurMax_sec,
+                  audStimTaper_sec=audStimTaper_sec,
+                  renderWholeBlocks=renderWholeBlocks,
+                  audioTriggerChannel=audioTriggerChannel,
+                  silenceDurationMin_sec=silenceDurationMin_sec,
+                  silenceDurationMax_sec=silenceDurationMax_sec,
+                  triggerMap=[[stimHz, triggerMap[stimHz]['open'], triggerMap[stimHz]['closed']]
+                              for stimHz in stimListHz],
+                  conditions=conditions)
+    return json.loads(json.dumps(config))  # as read back from the bundle
+
+
+def bundleName(subjID: str, seed: int) -> str:
+    return opj(BUNDLE_DIR, '{}_seed{}'.format(subjID, seed))
+
+
+def buildSchedule(seed: int, orderIndex: int = None) -> TrialTable:
+    """Draw the trials of every condition, in playing order; same seed, same session.
+
+    Without `orderIndex` each condition is shuffled freely. With it, the
+    conditions are run in rotated order and the trials of each condition in
+    runs of one tone per frequency, ordered by rows of a balanced Latin
+    square; subjects with successive order indices get successive rows.
+    """
+    rng = np.random.RandomState(seed)
+    # the required-duration set plus as many random sets as fit, with the
+    # silences (and tone durations) stretched to use up the time budget
+    schedule = pack_schedule(nStims, experimentTimeMax_sec, requiredAudStimDur_sec,
+                             audStimDurMin_sec, audStimDurMax_sec,
+                             silenceDurationMin_sec, silenceDurationMax_sec, seed=rng)
+    trials = TrialTable.from_columns(stim=np.array(stimListHz)[schedule['stim']],
+                                     duration=schedule['duration'],
+                                     silence_duration=schedule['silence_duration'])
+    square = williams_square(nStims)
+
+    # the same trials for every condition, each in its own order
+    conditionTrials: dict = {}
+    for nCondition, condition in enumerate(conditions):
+        if orderIndex is None:
+            ordered = trials.shuffled(rng)
+        else:
+            # the conditions start from rows half the square apart
+            row = orderIndex + nCondition * len(square) // len(conditions)
+            ordered = trials[balanced_order(schedule['stim'], square, row, rng)]
+        ordered['condition'] = condition
+        ordered['trial'] = np.arange(len(ordered))
+        ordered['eeg_tag'] = ordered.lookup_triggers(triggerMap, condition)
+        conditionTrials[condition] = ordered
+    runOrder = conditions if orderIndex is None else np.roll(conditions, -orderIndex).tolist()
+    return TrialTable.concatenate([conditionTrials[condition] for condition in runOrder])
+
+
+def runConditions(trials: TrialTable) -> List[str]:
+    """Conditions of a schedule, in the order they are run."""
+    names, first = np.unique(trials['condition'], return_index=True)
+    return names[np.argsort(first)].tolist()
+
+
+def _cohortEntry(args) -> tuple:
+    subjID, baseSeed, orderIndex = args
+    seed = subject_seed(baseSeed, subjID)
+    trials = buildSchedule(seed, orderIndex)
+    return dict(subject=subjID, seed=seed, order_index=orderIndex,
+                conditions=runConditions(trials)), trials
+
+
+def buildCohort(subjIDs: List[str], baseSeed: int, fname: str = COHORT_FILE, nJobs: int = 1) -> str:
+    """Draw the counterbalanced plans of all subjects into one cohort file.
+
+    Subject ``i`` gets the seed ``subject_seed(baseSeed, subjID)`` and order
+    index ``i``, so across the cohort each frequency is played equally often
+    at every position and after every other frequency, and half the
+    subjects start with each condition. Returns the file name.
+    """
+    jobs = [(subjID, baseSeed, orderIndex) for orderIndex, subjID in enumerate(subjIDs)]
+    if nJobs == 1:
+        entries = list(map(_cohortEntry, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=nJobs) as executor:
+            entries = list(executor.map(_cohortEntry, jobs, chunksize=max(1, len(jobs) // (4 * nJobs))))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(fname))):
+        os.makedirs(os.path.dirname(os.path.abspath(fname)))
+    write_cohort(fname, [subject for subject, _ in entries], [trials for _, trials in entries],
+                 meta=dict(base_seed=baseSeed, config=sessionConfig()))
+    return fname
+
+
+def cohortPlan(subjID: str, seed: int = None, fname: str = COHORT_FILE):
+    """Plan of a subject from the cohort file, as (seed, trials, orderIndex).
+
+    With `seed`, the plan is only used if it was drawn with that seed. When
+    there is no plan to use, trials and orderIndex are None; without `seed`,
+    the seed is then derived from `defaultBaseSeed` and the subject ID.
+    """
+    cohort = CohortFile(fname) if os.path.isfile(fname) else None
+    if cohort is None or subjID not in cohort:
+        if seed is None:
+            seed = subject_seed(defaultBaseSeed, subjID)
+            print("Subject {} is not in the cohort file {}, using seed {}".format(subjID, fname, seed))
+        return seed, None, None
+    entry = cohort.info(subjID)
+    if seed is not None and seed != entry['seed']:
+        return seed, None, None
+    if cohort.meta['config'] != sessionConfig():
+        raise ValueError('The cohort file {} was drawn with other settings, draw it again'.format(fname))
+    return entry['seed'], cohort.table(subjID), entry['order_index']
+
+
+def compileSession(subjID: str, seed: int = None, dirname: str = None, verbose: bool = True) -> str:
+    """Build the session of a subject and seed and write it as a bundle.
+
+    Subjects in the cohort file follow their plan there; `seed` may be left
+    out (see `cohortPlan`). Returns the bundle directory (by default
+    `bundleName(subjID, seed)`).
+    """
+    seed, trials, orderIndex = cohortPlan(subjID, seed)
+    if trials is None:
+        trials = buildSchedule(seed)
+    if dirname is None:
+        dirname = bundleName(subjID, seed)
+    if verbose:
+        print("Number of unique frequencies: ", nStims)
+        # all conditions, i.e. both eyes open and closed
+        print("Total experiment time: ", trials.total_duration())
+
+    # reuse stimuli generated in earlier sessions, dropping ones unused for long
+    stimStore = StimulusStore(STIM_DIR, max_bytes=stimStoreMaxBytes,
+                              max_age_days=stimStoreMaxAge_days)
+    nEvicted = stimStore.evict()
+    if verbose:
+        print("Stimulus store: {} stimuli available, {} evicted".format(len(stimStore), nEvicted))
+        print("preparing stimuli")
+    # synthesize every unique (Hz, duration) pair in one batch, kept in memory
+    stimCache = StimulusCache(max_bytes=stimCacheMaxBytes,
+                              audioSamplingRate=audioSamplingRate,
+                              taperLenSec=audStimTaper_sec,
+                              store=stimStore)
+    runOrder: List[str] = runConditions(trials)
+    stimBuffers: dict = {}
+    for condition in runOrder:
+        rows = trials['condition'] == condition
+        # plain Python values, so the store keys match earlier sessions
+        stimBuffers[condition] = stimCache.prefetch(trials['stim'][rows].tolist(),
+                                                    trials['duration'][rows].tolist())
+    stimStore.flush()
+    if verbose:
+        print("stimuli prepared")
+
+    # one block per condition, with the onset/offset of every tone in samples
+    blocks: list = []
+    for condition in runOrder:
+        rows = np.flatnonzero(trials['condition'] == condition)
+        block, onsets = render_block(stimBuffers[condition],
+                                     trials['silence_duration'][rows],
+                                     audioSamplingRate,
+                                     trigger_codes=trials['eeg_tag'][rows] if useAudioTriggers else None,
+                                     trigger_channel=audioTriggerChannel)
+        blocks.append((condition, block))
+        trials['onset_samp'][rows] = onsets[:, 0]
+        trials['offset_samp'][rows] = onsets[:, 1]
+        if verbose:
+            print("Eyes {}:".format(condition))
+            print(' ->\n'.join(['{}Hz ({}s), silence ({}s)'.format(*trial) for trial in
+                                zip(trials['stim'][rows].tolist(), trials['duration'][rows].tolist(),
+                                    trials['silence_duration'][rows].tolist())]))
+
+    # triggers not embedded in the audio go to the parallel port on a plan:
+    # the trial's code at its onset, 'stop' at its offset
+    plan = trials if not useAudioTriggers else trials[:0]
+    triggers: dict = dict(condition=np.repeat(plan['condition'], 2),
+                          trial=np.repeat(plan['trial'], 2),
+                          time=np.column_stack((plan['onset_samp'], plan['offset_samp'])).ravel() / audioSamplingRate,
+                          code=np.column_stack((plan['eeg_tag'],
+                                                np.full(len(plan), triggerMap['stop']))).ravel(),
+                          column=np.tile([timing.TRIGGER_ONSET, timing.TRIGGER_OFFSET], len(plan)))
+
+    schedule = io.StringIO()
+    trials.to_csv(schedule,
+                  columns=['subjID', 'stim', 'stim_fade', 'duration', 'silence_duration', 'eeg_tag', 'condition'],
+                  header=['subjID', 'stim (Hz)', 'stim_fade', 'stim_duration', 'stim_silence_duration', 'eeg_tag',
+                          'condition'],
+                  constants=dict(subjID=subjID, stim_fade=audStimTaper_sec))
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(dirname))):
+        os.makedirs(os.path.dirname(os.path.abspath(dirname)))
+    write_bundle(dirname, blocks, trials.to_columns(), triggers,
+                 meta=dict(subjID=subjID, seed=seed, order_index=orderIndex,
+                           channels=blocks[0][1].shape[1], config=sessionConfig()),
+                 files={TRIALS_CSV_NAME: schedule.getvalue()})
+    if verbose:
+        print("Session bundle written to {}".format(dirname))
+    return dirname
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a ToneResponse_SG8_EEG session into a bundle, '
+                                                 'or draw the plans of a cohort.')
+    parser.add_argument('subjID', nargs='+')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='session seed, or base seed of a cohort (default: from the cohort file, '
+                             'else derived from the subject ID)')
+    parser.add_argument('--out', default=None, help='bundle directory (default: {}), or cohort file '
+                                                    '(default: {})'.format(bundleName('SUBJID', 'SEED'), COHORT_FILE))
+    parser.add_argument('--cohort', action='store_true', help='draw the plans of all subjects into a cohort file')
+    parser.add_argument('--n-jobs', type=int, default=1, help='processes drawing cohort plans')
+    args = parser.parse_args()
+    if args.cohort:
+        if args.seed is None:
+            parser.error('--cohort needs a base --seed')
+        print("Cohort written to {}".format(buildCohort(args.subjID, args.seed, args.out or COHORT_FILE,
+                                                        args.n_jobs)))
+    elif len(args.subjID) > 1:
+        parser.error('compile one session at a time, or use --cohort')
+    else:
+        compileSession(args.subjID[0], args.seed, args.out)
@@ -2,211 +2,239 @@
 # Set to False to use real EEG / parallel port
 DEBUG: bool = False
 DATA_DIR: str = './data/'
-STIM_DIR: str = './stims/'
 
 import datetime
-from glob import glob
+from functools import partial
 import os
-import random
-from typing import List
+import shutil
+import time
 from psychopy import core, visual, gui, event
-import sys
 import numpy as np
 if not DEBUG:
     from triggers import setParallelData
-
-from meeg import wavhelpers
+else:
+    from meeg.triggerdispatch import RecordingPort
+    setParallelData = RecordingPort().setData
+
+from meeg.audio import make_backend
+from meeg.scheduler import BlockAborted, DeadlineScheduler
+from meeg import timing
+from meeg.sessionlog import SessionLogger
+from meeg.triggerdispatch import TriggerDispatcher
+from meeg.bundle import SessionBundle
+from meeg.trialtable import TrialTable
+# the session itself (schedule, stimuli, triggers) is set up and compiled
+# ahead of time by ToneResponse_SG8_EEG_Compile.py
+from ToneResponse_SG8_EEG_Compile import (audioSamplingRate, audStimTaper_sec, renderWholeBlocks,
+                                          triggerMap, TRIALS_CSV_NAME,
+                                          bundleName, cohortPlan, compileSession, sessionConfig)
 
 targetKeys = dict(abort=['q', 'escape'])
 
-# how many seconds we have available
-experimentTimeMax_sec: int = 600 / 2 # 5 minutes eyes open, 5 minutes eyes closed
-
-# Standard is usually 44.1 or 48 kHz
-audioSamplingRate: float = 44100.
-
-# how long should the tone be
-requiredAudStimDur_sec: float = 15.
-
-# how many times we play the tone for requiredAudStimDur_sec
-nRepsRequired: int = 1
-
-# for the other trials, this is the minimum duration to play the tone
-audStimDurMin_sec: float = 1.0
-
-# for the other trials, this is the maximum duration to play the tone
-audStimDurMax_sec: float = 2.5
-
-# Fade in/out duration at beginning and end of tone
-audStimTaper_sec: float = 0.1
-
-# how long between each tone?
-silenceDurationMin_sec: float = 0.8
-silenceDurationMax_sec: float = 2.5
+# audio output: 'process' (the stream below in a worker process of its own,
+# fed from shared memory), 'sounddevice' (low-latency callback stream),
+# 'psychopy', or 'loopback' (no sound card; records output for timing checks)
+audioBackendName: str = 'process'
+# what the 'process' worker plays through: 'sounddevice' or 'loopback'
+audioWorkerBackendName: str = 'sounddevice'
 
+# time between starting a block and its first tone
+blockLeadIn_sec: float = 0.1
 
-def calculateDuration(stimListExperiment: List[dict]) -> float:
-    return sum(stim['duration'] + stim['silence_duration'] for stim in stimListExperiment)
+# without rendered blocks, each tone is queued this long before its onset
+audioLead_sec: float = 0.05
 
+# trials are logged this long after their offset trigger
+logDelay_sec: float = 0.05
 
 # Psychopy window
 curMonitor: str = 'testMonitor'
 bckColour: str = '#303030'
 fullScr: bool = False
 
+# leave the seed empty to use the subject's plan in the cohort file (subjects
+# not in it get a seed derived from their ID)
 expInfo: dict = {
     'subjID': 'test',
+    'seed': '',
 }
 
-# configure Parallel Port triggers for EEG
-# 8 bit unsigned integer from 0 to 255
-# 0 = no trigger
-# 'open' = eyes open condition
-# 'closed' = eyes closed condition
-triggerMap: dict = {
-    50: {'open': 11, 'closed': 21},
-    100: {'open': 12, 'closed': 22},
-    250: {'open': 13, 'closed': 23},
-    500: {'open': 14, 'closed': 24},
-    2500: {'open': 15, 'closed': 25},
-    5000: {'open': 16, 'closed': 26},
-    7500: {'open': 17, 'closed': 27},
-    15000: {'open': 18, 'closed': 28},
-}
-
-# list of all tones we want to play
-stimListHz: List[int] = triggerMap.keys()
-nStims: int = len(stimListHz)
-print("Number of unique frequencies: ", nStims)
-
-# extra triggers
-triggerMap['stop'] = 0
-triggerMap['start'] = 1
-triggerMap['open'] = 10
-triggerMap['closed'] = 20
-
-
-# clean up any old stimuli
-oldStimuli = glob(STIM_DIR + '*.wav')
-print("Removing old stimuli...")
-for oldStim in oldStimuli:
-    # we'll keep the 15 second ones
-    if oldStim.endswith('15.00s.wav'):
-        continue
-    print("Removing old stimulus: ", oldStim)
-    os.remove(oldStim)
-
-# just generate a bunch of lengths for the silence, we won't use 1000 but we can just read along the list
-silenceDurations_sec: List[float] = np.random.uniform(silenceDurationMin_sec, silenceDurationMax_sec, 1000).round(2).tolist()
-
-# get random silence durations
-silences: List[float] = silenceDurations_sec[-nStims:]
-
-# removed used random silence durations from list
-del silenceDurations_sec[-nStims:]
-
-# start off by adding the required durations for each tone to the list
-stimListExperiment: List[dict] = [{'stim': stimHz, 'duration': dur, 'silence_duration': sil} for stimHz, dur, sil in zip(stimListHz, [requiredAudStimDur_sec] * nStims, silences)]
-
-# now calculate used time
-expTimeUsed_sec: float = calculateDuration(stimListExperiment)
-
-
-# now we will add in as many additional sets of tones as we can to fill the time
-while expTimeUsed_sec < experimentTimeMax_sec:
-    toneDuration_sec: float = round(random.uniform(audStimDurMin_sec, audStimDurMax_sec), 2)
-    # get random silence durations
-    silences: List[float] = silenceDurations_sec[-nStims:]
-    # removed used random silence durations from list
-    del silenceDurations_sec[-nStims:]
-
-    # create a new set of stimuli, each tone played for the same duration
-    # but with random silence lengths
-    stimSet: List[dict] = [{'stim': stimHz, 'duration': dur, 'silence_duration': sil} for stimHz, dur, sil in zip(stimListHz, [toneDuration_sec] * nStims, silences)]
-
-    # calculate how long this new set will run for
-    stimSetDuration_sec: float = calculateDuration(stimSet)
-
-    # if the current running time plus the set is too long, we will stop
-    if expTimeUsed_sec + stimSetDuration_sec > experimentTimeMax_sec:
-        break
-
-    # otherwise we add it to the list of stimuli
-    stimListExperiment.extend(stimSet)
-
-    # update running time
-    expTimeUsed_sec += stimSetDuration_sec
-
-# times 2 because we are doing both eyes open and closed
-print("Total experiment time: ", expTimeUsed_sec * 2)
-
-print("preparing stimuli")
-for i, stim in enumerate(stimListExperiment):
-    # Save the stimulus as a wav file
-    monoChanStr = \
-        wavhelpers.load_stimuli(stim['stim'], audioSamplingRate,
-                                stim['duration'], audStimTaper_sec, False)
-    # Keep track of the file names
-    stimListExperiment[i]['filename'] = monoChanStr
-    
-print("stimuli prepared")
-
-# create a copy for the eyes closed condition
-stimListExperiment_closed = stimListExperiment.copy()
-
-# randomize order
-random.shuffle(stimListExperiment)
-random.shuffle(stimListExperiment_closed)
-
-print("final experiment structure: ")
-print("Eyes open:")
-print(' ->\n'.join(['{}Hz ({}s), silence ({}s)'.format(x['stim'], x['duration'], x['silence_duration']) for x in stimListExperiment]))
-print("Eyes closed:")
-print(' ->\n'.join(['{}Hz ({}s), silence ({}s)'.format(x['stim'], x['duration'], x['silence_duration']) for x in stimListExperiment_closed]))
-
-
 # present a dialogue to change params
 dlg = gui.DlgFromDict(expInfo,
                       title='Tone Differentiation',
-                      order=['subjID'])
+                      order=['subjID', 'seed'])
 if not dlg.OK:
     core.quit()  # the user hit cancel so exit
 
+seed, _, orderIndex = cohortPlan(expInfo['subjID'], int(expInfo['seed']) if str(expInfo['seed']).strip() else None)
+
+# map the compiled session; compile it now if that wasn't done beforehand
+bundleDir = bundleName(expInfo['subjID'], seed)
+if not os.path.isdir(bundleDir):
+    print("No compiled session in {}, compiling it now".format(bundleDir))
+    compileSession(expInfo['subjID'], seed)
+bundle = SessionBundle(bundleDir)
+if bundle.meta['config'] != sessionConfig() or bundle.meta.get('order_index') != orderIndex:
+    print("Session in {} was compiled with other settings or another cohort plan, "
+          "compiling it again".format(bundleDir))
+    compileSession(expInfo['subjID'], seed)
+    bundle = SessionBundle(bundleDir)
+
+# trials of each condition, in playing order; conditions run in block order
+trials = TrialTable.from_columns(**bundle.trials)
+stimLists: dict = {condition: trials[trials['condition'] == condition] for condition in bundle.blocks}
+
 # save the experiment structure to a log file
-# make a text file to save data
 fileName = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-dataFile = open(DATA_DIR + fileName + '.csv', 'w')
-
-# write header
-dataFile.write('subjID,stim (Hz),stim_fade,stim_duration,stim_silence_duration,eeg_tag,condition\n')
-# write data
-for stim in stimListExperiment:
-    dataFile.write('{},{},{},{},{},{},{}\n'.format(expInfo['subjID'],
-                                                    stim['stim'],
-                                                    audStimTaper_sec,
-                                                    stim['duration'],
-                                                    stim['silence_duration'],
-                                                    triggerMap[stim['stim']]['open'],
-                                                    'open'))
-for stim in stimListExperiment_closed:
-    dataFile.write('{},{},{},{},{},{},{}\n'.format(expInfo['subjID'],
-                                                    stim['stim'],
-                                                    audStimTaper_sec,
-                                                    stim['duration'],
-                                                    stim['silence_duration'],
-                                                    triggerMap[stim['stim']]['closed'],
-                                                    'closed'))
-dataFile.close()
-
-if sys.platform == 'win32':
-    import winsound  # noqa
-    def playSound(wavfile):
-        winsound.PlaySound(wavfile,
-                           winsound.SND_FILENAME | winsound.SND_NOWAIT | winsound.SND_ASYNC)
+shutil.copyfile(bundle.path(TRIALS_CSV_NAME), DATA_DIR + fileName + '.csv')
+
+# trial records with actual timings, written in the background as we go
+sessionLog = SessionLogger(DATA_DIR + fileName + '_log',
+                           ['subjID', 'condition', 'trial', 'stim', 'stim_fade',
+                            'stim_duration', 'stim_silence_duration', 'eeg_tag',
+                            'scheduled_onset', 'scheduled_offset', 'play_return',
+                            'trigger_onset', 'trigger_offset', 'aborted'])
+
+# all buffers are handed to the audio backend before the trial loop, so
+# nothing is read or converted while it runs
+audioBackend = make_backend(audioBackendName, audioSamplingRate, bundle.meta['channels'],
+                            **(dict(worker_backend=audioWorkerBackendName) if audioBackendName == 'process' else {}))
+
+blockHandles: dict = {}
+stimHandles: dict = {}
+for condition, stimList in stimLists.items():
+    block = bundle.block(condition)
+    # read the mapped audio once, so playback doesn't wait for the disk
+    block.max()
+    if renderWholeBlocks:
+        # one buffer per condition, tone onsets fixed to the sample
+        blockHandles[condition] = audioBackend.preload(block)
+    else:
+        # one handle per tone, a view of its samples in the block
+        stimHandles[condition] = [audioBackend.preload(block[onset:offset])
+                                  for onset, offset in zip(stimList['onset_samp'], stimList['offset_samp'])]
+# e.g. copy them to the playback process, which then owns all sample data
+audioBackend.prepare()
+
+
+def playSound(handle, when=None):
+    audioBackend.play(handle, when)
+
+
+# triggers are written on their deadlines by a dedicated thread
+triggerDispatcher = TriggerDispatcher(setParallelData)
+
+
+def sendTrigger(code, deadline=None, callback=None):
+    triggerDispatcher.send(code, deadline, callback)
+
+
+def abortRequested():
+    return bool(event.getKeys(keyList=targetKeys['abort']))
+
+
+scheduler = DeadlineScheduler(abort_check=abortRequested)
+
+
+def playTrial(timer, trial, handle, when):
+    playSound(handle, when)
+    timer.mark(trial, timing.PLAY_RETURN)
+
+
+def logTrial(timer, trial, stim, condition, blockStart, aborted=False):
+    """Queue the trial's planned and actual timings, then sync the log.
+
+    Runs at the tone offset, so the log is written during the silence.
+    """
+    times = timer.times[trial] - blockStart
+    sessionLog.log(dict(subjID=expInfo['subjID'],
+                        condition=condition,
+                        trial=trial,
+                        stim=int(stim['stim']),
+                        stim_fade=audStimTaper_sec,
+                        stim_duration=float(stim['duration']),
+                        stim_silence_duration=float(stim['silence_duration']),
+                        eeg_tag=int(stim['eeg_tag']),
+                        scheduled_onset=float(times[timing.SCHEDULED_ONSET]),
+                        scheduled_offset=float(times[timing.SCHEDULED_OFFSET]),
+                        play_return=float(times[timing.PLAY_RETURN]),
+                        trigger_onset=float(times[timing.TRIGGER_ONSET]),
+                        trigger_offset=float(times[timing.TRIGGER_OFFSET]),
+                        aborted=aborted))
+    sessionLog.sync()
+
+
+def closeSessionLog():
+    sessionLog.close()
+    csvName, npzName = sessionLog.export()
+    print("Session log written to {} and {}".format(csvName, npzName))
+
+
+def saveBlockTiming(timer, condition):
+    """Write the block's raw timestamps and its latency/jitter summary."""
+    report = timer.report('Eyes {} timing'.format(condition))
+    print(report)
+    timingFileName = DATA_DIR + fileName + '_timing_' + condition
+    timer.save(timingFileName + '.npz')
+    with open(timingFileName + '.txt', 'w') as timingFile:
+        timingFile.write(report + '\n')
+
+
+def runBlock(condition):
+    """Run one condition on absolute deadlines from the block start."""
+    stimList = stimLists[condition]
+    onsets = stimList['onset_samp'] / audioSamplingRate
+    offsets = stimList['offset_samp'] / audioSamplingRate
+    blockEnd = len(bundle.block(condition)) / audioSamplingRate
+    blockStart = time.perf_counter() + blockLeadIn_sec
+    timer = timing.TrialTimer(len(stimList))
+    # play is called ahead of the onsets on purpose: its latency is measured
+    # from the intended call time, not the onset
+    if renderWholeBlocks:
+        plays = np.full(len(stimList), blockStart - blockLeadIn_sec)  # right away
+    else:
+        plays = blockStart + onsets - audioLead_sec
+    timer.set_schedule(blockStart + onsets, blockStart + offsets, plays)
+
+    # the parallel port is only a fallback for audio-embedded triggers, so the
+    # trigger plan is empty when they are used
+    for row in np.flatnonzero(bundle.triggers['condition'] == condition):
+        sendTrigger(int(bundle.triggers['code'][row]), blockStart + float(bundle.triggers['time'][row]),
+                    partial(timer.set, int(bundle.triggers['trial'][row]), int(bundle.triggers['column'][row])))
+
+    schedule = []
+    for trial, (stim, onset, offset) in enumerate(zip(stimList, onsets, offsets)):
+        if not renderWholeBlocks:
+            # queue each tone ahead of time, the backend starts it on time
+            schedule.append((onset - audioLead_sec, playTrial,
+                             (timer, trial, stimHandles[condition][trial], blockStart + onset)))
+        # log once the offset trigger has been written
+        schedule.append((offset + logDelay_sec, logTrial, (timer, trial, stim, condition, blockStart)))
+    schedule.append((blockEnd, None, ()))
+
+    if renderWholeBlocks:
+        playTrial(timer, 0, blockHandles[condition], blockStart)
+    try:
+        scheduler.run(schedule, start=blockStart)
+    except BlockAborted:
+        audioBackend.stop()
+        triggerDispatcher.cancel()
+        sendTrigger(triggerMap['stop'])
+        # make sure the stop code is out before the dispatch thread is stopped
+        triggerDispatcher.flush(timeout=1.)
+        triggerDispatcher.close()
+        # the trial running at abort time is the first one not yet logged
+        abortedTrial = int(np.sum(timer.times[:, timing.SCHEDULED_OFFSET] + logDelay_sec <= time.perf_counter()))
+        if abortedTrial < len(stimList):
+            logTrial(timer, abortedTrial, stimList[abortedTrial], condition, blockStart, aborted=True)
+        closeSessionLog()
+        saveBlockTiming(timer, condition)
+        win.close()
+        core.quit()
+    saveBlockTiming(timer, condition)
 
 # create window and stimuli
 globalClock = core.Clock()  # to keep track of time
-trialClock = core.CountdownTimer()
 
 win = visual.Window(monitor=curMonitor,
                     units='deg',
@@ -226,105 +254,30 @@ if key in targetKeys['abort']:
     win.close()
     core.quit()
 
-message1.setText('Hit a key when ready.')
-message2.setText('Please keep your eyes OPEN for the first part of this experiment and try to look at the dot on the screen.')
-
-message1.draw()
-message2.draw()
-fixation.draw()
-win.flip()
-# check for a keypress
-key = event.waitKeys(keyList=['space', 'enter', 'return'] + targetKeys['abort'])
-if key in targetKeys['abort']:
-    win.close()
-    core.quit()
-# draw all stimuli
-fixation.draw()
-win.flip()
-
-globalClock.reset()
-if not DEBUG:
-    setParallelData(triggerMap['start'])
-# eyes open loop
-for stim in stimListExperiment:
-    # play the tone
-    print("playing sound at {} Hz".format(stim['stim']))
-    playSound(stim['filename'])
-    if not DEBUG:
-        setParallelData(triggerMap[stim['stim']]['open'])
-    try:
-        # wait for the duration of the tone
-        # and listen for "abort" keypress
-        key, time_key = event.waitKeys(maxWait=stim['duration'], keyList=targetKeys['abort'])
-        if key in targetKeys['abort']:
-            win.close()
-            core.quit()
-    except IndexError:
-        # ignore key timeout
-        pass
-    except TypeError:
-        # ignore key timeout
-        pass
-            
-    print("done")
-    if not DEBUG:
-        setParallelData(triggerMap['stop'])
-    trialClock.reset(stim['silence_duration'])
-
-    while trialClock.getTime() > 0.:
-        core.wait(0.010)  # adds some uncertainty too...
-
-message1.setText('Hit a key when ready.')
-message2.setText('Please keep your eyes CLOSED for the second part of this experiment. You will be informed when it is complete.')
-
-message1.draw()
-message2.draw()
-fixation.draw()
-win.flip()
-# check for a keypress
-key = event.waitKeys(keyList=['space', 'enter', 'return'] + targetKeys['abort'])
-if key in targetKeys['abort']:
-    win.close()
-    core.quit()
-# draw all stimuli
-fixation.draw()
-win.flip()
-
-globalClock.reset()
-if not DEBUG:
-    setParallelData(triggerMap['start'])
-
-# eyes closed loop
-for stim in stimListExperiment_closed:
-    # play the tone
-    print("playing sound at {} Hz".format(stim['stim']))
-    playSound(stim['filename'])
-    if not DEBUG:
-        setParallelData(triggerMap[stim['stim']]['closed'])
-    try:
-        # wait for the duration of the tone
-        # and listen for "abort" keypress
-        key, time_key = event.waitKeys(maxWait=stim['duration'], keyList=targetKeys['abort'])
-        if key in targetKeys['abort']:
-            win.close()
-            core.quit()
-    except IndexError:
-        # ignore key timeout
-        pass
-    except TypeError:
-        # ignore key timeout
-        pass
-            
-    print("done")
-    if not DEBUG:
-        setParallelData(triggerMap['stop'])
-    trialClock.reset(stim['silence_duration'])
-
-    while trialClock.getTime() > 0.:
-        core.wait(0.010)  # adds some uncertainty too...
-
-
-
+blockInstructions: dict = {
+    'open': 'Please keep your eyes OPEN for the {} part of this experiment and try to look at the dot on the screen.',
+    'closed': 'Please keep your eyes CLOSED for the {} part of this experiment. You will be informed when it is complete.',
+}
+for part, condition in zip(['first', 'second'], bundle.blocks):
+    message1.setText('Hit a key when ready.')
+    message2.setText(blockInstructions[condition].format(part))
+
+    message1.draw()
+    message2.draw()
+    fixation.draw()
+    win.flip()
+    # check for a keypress
+    key = event.waitKeys(keyList=['space', 'enter', 'return'] + targetKeys['abort'])
+    if key in targetKeys['abort']:
+        win.close()
+        core.quit()
+    # draw all stimuli
+    fixation.draw()
+    win.flip()
+
+    globalClock.reset()
+    sendTrigger(triggerMap['start'])
+    runBlock(condition)
 
 message1.setText('That\'s it!')
 message2.setText('The experiment is over, thanks for participating!')
@@ -334,5 +287,10 @@ win.flip()
 
 event.waitKeys(keyList=['space', 'enter'])
 
+closeSessionLog()
+print("Audio scheduling latency (ms): ", audioBackend.latency_stats())
+print("Trigger dispatch latency (ms): ", triggerDispatcher.latency_stats())
+triggerDispatcher.close()
+audioBackend.close()
 win.close()
 core.quit()
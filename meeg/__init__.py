@@ -1,12 +1,40 @@
-# this file is intentionally blank:
 # the various utilities depend on all sorts of libs, for example,
 # extract_delays_MEG imports mne
 # attenuator imports labjack and psychopy
-# to import modules, one must therefore be explicit, such as
+# nothing is therefore imported here up front: submodules and the names
+# below are loaded on first access, so that e.g.
 # from meeg import wavhelpers
-# from meeg.psychopy_utils import attenuator
-from .delays import extract_delays
+# does not pull in mne (and works where it isn't installed)
+import importlib
+import sys
+import types
 
-from . import delays
-from . import wavhelpers
-from .montage import (montage_to_mapping_triux, read_eeg_mapping_triux)
+# public name -> (submodule, attribute in it, or None for the module)
+_LAZY = {
+    'extract_delays': ('.delays', 'extract_delays'),
+    'delays': ('.delays', None),
+    'wavhelpers': ('.wavhelpers', None),
+    'montage_to_mapping_triux': ('.montage', 'montage_to_mapping_triux'),
+    'read_eeg_mapping_triux': ('.montage', 'read_eeg_mapping_triux'),
+}
+
+
+class _LazyModule(types.ModuleType):
+    # module-level __getattr__ (PEP 562) needs Python 3.7
+    def __getattr__(self, name):
+        try:
+            module_name, attr = _LAZY[name]
+        except KeyError:
+            raise AttributeError('module {!r} has no attribute {!r}'
+                                 .format(self.__name__, name))
+        value = importlib.import_module(module_name, self.__name__)
+        if attr is not None:
+            value = getattr(value, attr)
+        setattr(self, name, value)  # later lookups skip __getattr__
+        return value
+
+    def __dir__(self):
+        return sorted(set(super(_LazyModule, self).__dir__()) | set(_LAZY))
+
+
+sys.modules[__name__].__class__ = _LazyModule
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""Pluggable audio playback backends for preloaded stimulus buffers.
+
+All backends share one interface: buffers are handed over once with
+`preload` (before the trial loop), and `play` then only refers to them by
+handle. Every backend measures its scheduling latency, i.e. the time from
+the requested start (the `play` call, or its `when` deadline) to the moment
+the first sample reaches the output, see `latency_stats`.
+
+Available backends (see `make_backend`):
+
+- 'sounddevice': callback-driven, low-latency PortAudio stream (requires the
+  ``sounddevice`` package). Buffers are mixed into the stream directly from
+  memory and can be started at a given time with sample accuracy.
+- 'loopback': no audio device at all. A thread consumes the output at the
+  sampling rate and writes the played samples and their timestamps into
+  ring buffers, for benchmarking and testing on headless machines.
+- 'psychopy': psychopy.sound, see `meeg.psychopy.audio`.
+- 'process': one of the callback backends run in a separate process, fed
+  from shared memory, see `meeg.audioproc`.
+"""
+from collections import deque
+import threading
+import time
+import numpy as np
+
+from .ringbuffer import RingBuffer
+
+# rows of the onset log: handle, requested at, target time, actual onset
+_ONSET_LOG_LEN = 4096
+
+
+class AudioBackend(object):
+    """Base class of the playback backends.
+
+    Parameters
+    ----------
+    audioSamplingRate : float
+        Sampling rate of the buffers and the output, in Hz.
+    channels : int
+        Number of output channels; buffers with fewer channels are padded
+        with silence.
+    """
+    name = 'base'
+
+    def __init__(self, audioSamplingRate=44100., channels=2):
+        self.audioSamplingRate = float(audioSamplingRate)
+        self.channels = int(channels)
+        self._buffers = []
+        self._onsets = RingBuffer(_ONSET_LOG_LEN, shape=(4,))
+
+    def preload(self, buffer):
+        """Hand a buffer over to the backend; returns its playback handle."""
+        buffer = np.asarray(buffer)
+        if buffer.ndim == 1:
+            buffer = buffer[:, np.newaxis]
+        if buffer.shape[1] > self.channels:
+            raise ValueError('Buffer has {} channels, backend only {}'
+                             .format(buffer.shape[1], self.channels))
+        self._buffers.append(buffer)
+        return len(self._buffers) - 1
+
+    def prepare(self):
+        """Finish setting up after the last `preload`, before playing.
+
+        Backends that hand the buffers on (e.g. to another process) do it
+        here; for the others this does nothing.
+        """
+
+    def play(self, handle, when=None):
+        """Start playing a preloaded buffer.
+
+        Parameters
+        ----------
+        handle : int
+            As returned by `preload`.
+        when : float | None
+            Start time on the `time.perf_counter` clock. None (default)
+            means as soon as possible.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """Stop the current (or scheduled) buffer."""
+        raise NotImplementedError
+
+    def close(self):
+        self.stop()
+
+    def onset_log(self):
+        """Array of (handle, requested, target, actual) rows, in seconds."""
+        return self._onsets.read()
+
+    def latency_stats(self):
+        """Summary of actual minus target onset times, in ms."""
+        log = self.onset_log()
+        latency = (log[:, 3] - log[:, 2]) * 1e3
+        if len(latency) == 0:
+            return dict(n=0)
+        return dict(n=len(latency), mean=np.mean(latency),
+                    std=np.std(latency), p50=np.percentile(latency, 50.),
+                    p99=np.percentile(latency, 99.), max=np.max(latency))
+
+    def _log_onset(self, handle, requested, target, actual):
+        self._onsets.append((handle, requested, target, actual))
+
+
+class _CallbackBackend(AudioBackend):
+    """Mixes preloaded buffers into fixed-size output blocks.
+
+    Subclasses call `_render` once per output block with the time at which
+    its first sample will be heard; `play`/`stop` only queue commands for it.
+    """
+    def __init__(self, audioSamplingRate=44100., channels=2, blocksize=64):
+        AudioBackend.__init__(self, audioSamplingRate, channels)
+        self.blocksize = int(blocksize)
+        self._commands = deque()
+        self._scheduled = None  # (handle, requested, when)
+        self._current = None
+        self._position = 0
+
+    def play(self, handle, when=None):
+        requested = time.perf_counter()
+        if not 0 <= handle < len(self._buffers):
+            # fail here, not in the audio thread
+            raise ValueError('Unknown buffer handle: {}'.format(handle))
+        self._queue(handle, requested, when)
+
+    def _queue(self, handle, requested, when):
+        # `requested` may come from another process (translated to our clock)
+        self._commands.append((handle, requested, when))
+
+    def stop(self):
+        self._commands.append(None)
+
+    def _render(self, out, dacTime):
+        """Fill `out` (frames x channels) for output starting at `dacTime`."""
+        frames = len(out)
+        while self._commands:
+            command = self._commands.popleft()
+            if command is None:
+                self._scheduled = self._current = None
+            else:
+                self._scheduled = command
+        out.fill(0)
+
+        start = 0
+        if self._scheduled is not None:
+            handle, requested, when = self._scheduled
+            if when is None:
+                offset = 0
+            else:
+                offset = int(round((when - dacTime) *
+                                   self.audioSamplingRate))
+            if offset < frames:
+                start = max(offset, 0)
+                self._scheduled = None
+                self._current = self._buffers[handle]
+                self._position = 0
+                self._log_onset(handle, requested,
+                                requested if when is None else when,
+                                dacTime + start / self.audioSamplingRate)
+
+        if self._current is not None:
+            chunk = self._current[self._position:
+                                  self._position + frames - start]
+            out[start:start + len(chunk), :chunk.shape[1]] = chunk
+            self._position += len(chunk)
+            if self._position >= len(self._current):
+                self._current = None
+
+
+class SoundDeviceBackend(_CallbackBackend):
+    """Low-latency PortAudio output stream (``sounddevice``).
+
+    Parameters
+    ----------
+    device : int | str | None
+        Output device (see ``sounddevice.query_devices``); None for default.
+    blocksize : int
+        Frames per callback; smaller means lower latency and finer `when`
+        resolution at the cost of more CPU load.
+    latency : str | float
+        Requested output latency, passed on to PortAudio.
+    """
+    name = 'sounddevice'
+
+    def __init__(self, audioSamplingRate=44100., channels=2, device=None,
+                 blocksize=64, latency='low'):
+        # only import sounddevice if this backend is explicitly needed
+        import sounddevice as sd  # noqa
+
+        _CallbackBackend.__init__(self, audioSamplingRate, channels,
+                                  blocksize)
+        self._stream = sd.OutputStream(samplerate=self.audioSamplingRate,
+                                       channels=self.channels, dtype='int16',
+                                       device=device, blocksize=blocksize,
+                                       latency=latency,
+                                       callback=self._callback)
+        self._stream.start()
+
+    def _callback(self, outdata, frames, time_info, status):
+        # PortAudio's stream clock differs from perf_counter, but the
+        # difference between its timestamps tells how far ahead we are
+        ahead = time_info.outputBufferDacTime - time_info.currentTime
+        if not 0. < ahead < 1.:  # not reported by all host APIs
+            ahead = self._stream.latency
+        self._render(outdata, time.perf_counter() + ahead)
+
+    def close(self):
+        self._stream.stop()
+        self._stream.close()
+
+
+class LoopbackBackend(_CallbackBackend):
+    """Null audio device that records what would have been played.
+
+    A thread renders one block every `blocksize` samples' worth of time and
+    appends the samples to `samples` and the (first sample index, output
+    time) of every block to `timestamps`, both ring buffers.
+
+    Parameters
+    ----------
+    record_sec : float
+        Length of the sample ring buffer, in seconds.
+    output_latency : float
+        Simulated delay between rendering a block and it being "heard".
+    """
+    name = 'loopback'
+
+    def __init__(self, audioSamplingRate=44100., channels=2, blocksize=64,
+                 record_sec=10., output_latency=0.):
+        _CallbackBackend.__init__(self, audioSamplingRate, channels,
+                                  blocksize)
+        self.output_latency = output_latency
+        self.samples = RingBuffer(int(record_sec * self.audioSamplingRate),
+                                  shape=(self.channels,), dtype=np.int16)
+        nBlocks = int(record_sec * self.audioSamplingRate / blocksize) + 1
+        self.timestamps = RingBuffer(nBlocks, shape=(2,))
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='LoopbackBackend')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        out = np.zeros((self.blocksize, self.channels), dtype=np.int16)
+        blockDur = self.blocksize / self.audioSamplingRate
+        nextBlock = time.perf_counter()
+        nRendered = 0
+        while self._running:
+            dacTime = nextBlock + self.output_latency
+            self._render(out, dacTime)
+            self.timestamps.append((nRendered, dacTime))
+            self.samples.extend(out)
+            nRendered += self.blocksize
+            nextBlock += blockDur
+            sleep = nextBlock - time.perf_counter()
+            if sleep > 0:
+                time.sleep(sleep)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+
+
+def make_backend(name, audioSamplingRate=44100., channels=2, **kwargs):
+    """Create a playback backend by name ('sounddevice', 'loopback',
+    'psychopy' or 'process'); extra keyword arguments go to the backend
+    class.
+    """
+    if name == 'sounddevice':
+        return SoundDeviceBackend(audioSamplingRate, channels, **kwargs)
+    elif name == 'loopback':
+        return LoopbackBackend(audioSamplingRate, channels, **kwargs)
+    elif name == 'psychopy':
+        from .psychopy.audio import PsychopyBackend
+        return PsychopyBackend(audioSamplingRate, channels, **kwargs)
+    elif name == 'process':
+        from .audioproc import ProcessBackend
+        return ProcessBackend(audioSamplingRate, channels, **kwargs)
+    raise ValueError('Unknown audio backend: {}'.format(name))
+
+
+def benchmark_backend(backend, n_plays=50, interval_sec=0.05,
+                      lead_sec=0.02, buffer_sec=0.01):
+    """Play a short buffer repeatedly, half on deadlines, half immediately.
+
+    Returns the backend's `latency_stats` (ms).
+    """
+    nSamp = int(buffer_sec * backend.audioSamplingRate)
+    handle = backend.preload(np.full((nSamp, backend.channels), 1000,
+                                     dtype=np.int16))
+    backend.prepare()
+    for ii in range(n_plays):
+        if ii % 2:
+            backend.play(handle, when=time.perf_counter() + lead_sec)
+        else:
+            backend.play(handle)
+        time.sleep(interval_sec)
+    return backend.latency_stats()
+
+
+if __name__ == '__main__':
+    import sys
+    backend = make_backend(sys.argv[1] if len(sys.argv) > 1 else 'loopback')
+    try:
+        stats = benchmark_backend(backend)
+    finally:
+        backend.close()
+    print('{} backend, scheduling latency (ms):'.format(backend.name))
+    for key in ('n', 'mean', 'std', 'p50', 'p99', 'max'):
+        print('  {:>4s}: {}'.format(key, stats.get(key)))
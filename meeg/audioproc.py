@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Audio playback in a process of its own.
+
+`ProcessBackend` runs a callback backend ('sounddevice' or 'loopback') in
+a worker process, so garbage collection, window handling and everything
+else the experiment does between tones cannot hold up the audio. At
+`prepare` all preloaded buffers are copied, once, into a memory-mapped
+file the worker maps as well; from then on the experiment only sends
+fixed-size (command, handle, deadline) records down the worker's stdin,
+and the worker writes the actual onset of every buffer into a shared ring
+buffer that `onset_log` reads. Neither side copies or pickles sample data
+during playback.
+
+Deadlines and onsets are on the experiment's `time.perf_counter` clock.
+That clock is only system-wide on some platforms (on Windows, for one, it
+may count from the start of each process), so right after starting, the
+two processes exchange clock readings: the offset between their clocks is
+taken from the exchange with the shortest round trip, and times are
+translated with it on their way to and from the worker.
+
+The worker is started with ``python -m meeg.audioproc`` rather than
+multiprocessing, so it doesn't re-run the experiment script on platforms
+that spawn processes.
+"""
+import atexit
+import gc
+import json
+import os
+from os.path import join as opj
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from .audio import AudioBackend, _ONSET_LOG_LEN, make_backend
+from .ringbuffer import RingBuffer
+
+_AUDIO_NAME = 'audio.npy'
+_LOG_NAME = 'onsets.dat'
+# a command: op, handle, deadline (nan: as soon as possible), requested at
+_COMMAND = struct.Struct('<iidd')
+_PLAY, _STOP, _CLOSE, _SYNC = 1, 2, 3, 4
+_READY = b'R'
+# the worker's clock reading, in reply to each of the _N_SYNC sync commands
+_CLOCK = struct.Struct('<d')
+_N_SYNC = 8
+# shared onset log: total count (int64), then the (handle, requested,
+# target, actual) rows
+_LOG_HEADER_BYTES = 8
+
+
+class _SharedRingBuffer(RingBuffer):
+    """RingBuffer kept in a file mapped by both processes.
+
+    The worker is the single writer; the count is stored after the item,
+    so a reader never sees a count ahead of the data.
+    """
+    def __init__(self, fname, capacity, shape=(4,), mode='r+'):
+        self.capacity = int(capacity)
+        self._count = np.memmap(fname, dtype=np.int64, mode=mode, shape=(1,))
+        self._data = np.memmap(fname, dtype=np.float64, mode=mode,
+                               offset=_LOG_HEADER_BYTES,
+                               shape=(self.capacity,) + tuple(shape))
+
+    @property
+    def count(self):
+        return int(self._count[0])
+
+    @count.setter
+    def count(self, value):
+        self._count[0] = value
+
+
+class ProcessBackend(AudioBackend):
+    """Playback backend running in a worker process.
+
+    Parameters
+    ----------
+    worker_backend : str
+        Backend the worker plays through: 'sounddevice' or 'loopback'.
+    close_timeout : float
+        How long to wait for the worker to exit on `close`, in seconds.
+    tmp_dir : str | None
+        Where to put the shared files (default: /dev/shm if it exists,
+        else the system temporary directory).
+    **kwargs
+        Passed on to the worker's backend (e.g. device, blocksize).
+    """
+    name = 'process'
+
+    def __init__(self, audioSamplingRate=44100., channels=2,
+                 worker_backend='sounddevice', close_timeout=5.,
+                 tmp_dir=None, **kwargs):
+        if worker_backend not in ('sounddevice', 'loopback'):
+            raise ValueError('The worker needs a callback backend, got {}'
+                             .format(worker_backend))
+        AudioBackend.__init__(self, audioSamplingRate, channels)
+        self.worker_backend = worker_backend
+        self.close_timeout = close_timeout
+        if tmp_dir is None and os.path.isdir('/dev/shm'):
+            tmp_dir = '/dev/shm'
+        self._tmp_dir = tmp_dir
+        self._kwargs = kwargs
+        self._dirname = None
+        self._worker = None
+        self._clock_offset = 0.  # experiment clock minus worker clock
+
+    def preload(self, buffer):
+        if self._worker is not None:
+            raise RuntimeError('Buffers must be preloaded before prepare()')
+        return AudioBackend.preload(self, buffer)
+
+    def prepare(self):
+        """Copy the buffers to shared memory and start the worker."""
+        if self._worker is not None:
+            return
+        self._dirname = tempfile.mkdtemp(prefix='meeg_audio_',
+                                         dir=self._tmp_dir)
+        # stop the worker and remove the files even if the experiment quits
+        # without closing the backend
+        atexit.register(self.close)
+        # all buffers back to back, int16 like the output stream
+        sizes = [buffer.size for buffer in self._buffers]
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(int)
+        audio = np.lib.format.open_memmap(opj(self._dirname, _AUDIO_NAME),
+                                          mode='w+', dtype=np.int16,
+                                          shape=(max(sum(sizes), 1),))
+        layout = []
+        for buffer, start in zip(self._buffers, starts.tolist()):
+            audio[start:start + buffer.size] = buffer.ravel()
+            layout.append([start, buffer.shape[0], buffer.shape[1]])
+        audio.flush()
+        del audio
+
+        log_fname = opj(self._dirname, _LOG_NAME)
+        with open(log_fname, 'wb') as fp:
+            fp.truncate(_LOG_HEADER_BYTES + _ONSET_LOG_LEN * 4 * 8)
+        self._onsets = _SharedRingBuffer(log_fname, _ONSET_LOG_LEN)
+
+        config = dict(dirname=self._dirname, layout=layout,
+                      audioSamplingRate=self.audioSamplingRate,
+                      channels=self.channels, backend=self.worker_backend,
+                      kwargs=self._kwargs)
+        # the worker imports this package from wherever it is installed
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            [path for path in [env.get('PYTHONPATH')] if path])
+        self._worker = subprocess.Popen(
+            [sys.executable, '-m', 'meeg.audioproc', json.dumps(config)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0,
+            env=env)
+        # the worker writes a single byte once its backend is running, and
+        # exits (closing its output) if it can't start
+        if self._worker.stdout.read(1) != _READY:
+            self.close()
+            raise RuntimeError('The audio worker did not start, see its '
+                               'error output')
+        self._clock_offset = self._sync_clock()
+
+    def _sync_clock(self):
+        """Offset of the experiment's clock from the worker's."""
+        best = (np.inf, 0.)
+        for _ in range(_N_SYNC):
+            before = time.perf_counter()
+            self._send(_SYNC)
+            reply = self._worker.stdout.read(_CLOCK.size)
+            after = time.perf_counter()
+            if len(reply) < _CLOCK.size:
+                self.close()
+                raise RuntimeError('The audio worker quit while starting, '
+                                   'see its error output')
+            worker_time, = _CLOCK.unpack(reply)
+            best = min(best, (after - before,
+                              (before + after) / 2. - worker_time))
+        return best[1]
+
+    def play(self, handle, when=None):
+        requested = time.perf_counter()
+        if not 0 <= handle < len(self._buffers):
+            raise ValueError('Unknown buffer handle: {}'.format(handle))
+        self.prepare()
+        # the worker schedules on its own clock
+        self._send(_PLAY, handle,
+                   np.nan if when is None else when - self._clock_offset,
+                   requested - self._clock_offset)
+
+    def stop(self):
+        if self._worker is not None:
+            self._send(_STOP)
+
+    def onset_log(self):
+        # the worker logs times on its clock
+        log = np.asarray(AudioBackend.onset_log(self))
+        log[:, 1:] += self._clock_offset
+        return log
+
+    def close(self):
+        if self._dirname is None:
+            return
+        if self._worker is not None:
+            if self._worker.poll() is None:
+                try:
+                    self._send(_CLOSE)
+                    self._worker.wait(self.close_timeout)
+                except (OSError, subprocess.TimeoutExpired):
+                    self._worker.kill()
+                    self._worker.wait()
+            self._worker.stdin.close()
+            self._worker.stdout.close()
+        # keep the log readable once the shared files are gone
+        onsets = RingBuffer(_ONSET_LOG_LEN, shape=(4,))
+        onsets.extend(self._onsets.read())
+        self._onsets = onsets
+        shutil.rmtree(self._dirname, ignore_errors=True)
+        self._dirname = None
+
+    def _send(self, op, handle=-1, when=np.nan, requested=np.nan):
+        self._worker.stdin.write(_COMMAND.pack(op, handle, when, requested))
+
+
+def _run_worker(config):
+    """Play buffers from shared memory on the commands read from stdin."""
+    audio = np.load(opj(config['dirname'], _AUDIO_NAME), mmap_mode='r')
+    backend = make_backend(config['backend'], config['audioSamplingRate'],
+                           config['channels'], **config['kwargs'])
+    backend._onsets = _SharedRingBuffer(opj(config['dirname'], _LOG_NAME),
+                                        _ONSET_LOG_LEN)
+    for start, n_samples, n_channels in config['layout']:
+        # views of the mapped file, nothing is copied
+        backend.preload(audio[start:start + n_samples * n_channels]
+                        .reshape(n_samples, n_channels))
+    # touch every page now rather than in the audio callback
+    audio.max()
+    # nothing is allocated in the loop below that needs collecting
+    gc.disable()
+
+    commands = sys.stdin.buffer
+    sys.stdout.buffer.write(_READY)
+    sys.stdout.flush()
+    try:
+        # answer the clock exchange (see ProcessBackend._sync_clock)
+        for _ in range(_N_SYNC):
+            if len(commands.read(_COMMAND.size)) < _COMMAND.size:
+                return
+            sys.stdout.buffer.write(_CLOCK.pack(time.perf_counter()))
+            sys.stdout.flush()
+        # nobody reads our output any more: print to the error output
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        while True:
+            command = commands.read(_COMMAND.size)
+            if len(command) < _COMMAND.size:
+                break  # the experiment is gone
+            op, handle, when, requested = _COMMAND.unpack(command)
+            if op == _PLAY:
+                backend._queue(handle, requested,
+                               None if np.isnan(when) else when)
+            elif op == _STOP:
+                backend.stop()
+            elif op == _CLOSE:
+                break
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    _run_worker(json.loads(sys.argv[1]))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Import time of the modules the experiment loads at startup.
+
+Each module is imported in a fresh interpreter, several times, and the
+fastest time is compared to `IMPORT_BUDGET_SEC`. The heavy dependencies in
+`HEAVY_MODULES` must not be imported along with them. Run with::
+
+    python -m meeg.bench_import
+
+The exit status is 1 if a module is over budget or pulls in a heavy
+dependency.
+"""
+from __future__ import print_function
+import json
+import subprocess
+import sys
+
+# seconds, including numpy
+IMPORT_BUDGET_SEC = 0.5
+MODULES = ('meeg', 'meeg.wavhelpers', 'meeg.stimcache', 'meeg.blocks',
+           'meeg.audio', 'meeg.scheduler', 'meeg.timing',
+           'meeg.triggerdispatch', 'meeg.sessionlog')
+HEAVY_MODULES = ('mne', 'scipy', 'matplotlib', 'six')
+
+_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps([duration, heavy]))
+'''
+
+
+def time_import(module, repeats=5):
+    """Fastest import time (s) of `module` in a fresh interpreter, and the
+    heavy modules it imported.
+    """
+    best, heavy = None, []
+    for _ in range(repeats):
+        out = subprocess.check_output(
+            [sys.executable, '-c',
+             _PROBE.format(module=module, heavy=HEAVY_MODULES)])
+        duration, heavy = json.loads(out.decode('utf-8').splitlines()[-1])
+        best = duration if best is None else min(best, duration)
+    return best, heavy
+
+
+def benchmark_imports(modules=MODULES, budget=IMPORT_BUDGET_SEC, repeats=5):
+    """Rows of (module, seconds, heavy modules imported, within budget)."""
+    results = []
+    for module in modules:
+        duration, heavy = time_import(module, repeats)
+        results.append((module, duration, heavy,
+                        duration <= budget and not heavy))
+    return results
+
+
+if __name__ == '__main__':
+    numpy_sec, _ = time_import('numpy')
+    print('numpy alone: {:.1f} ms; budget: {:.1f} ms'.format(
+        numpy_sec * 1e3, IMPORT_BUDGET_SEC * 1e3))
+    ok = True
+    for module, duration, heavy, passed in benchmark_imports():
+        print('{:<22s} {:8.1f} ms  {:<4s} {}'.format(
+            module, duration * 1e3, 'ok' if passed else 'FAIL',
+            'imports ' + ', '.join(heavy) if heavy else ''))
+        ok = ok and passed
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Render a whole block of trials (tones and silences) into one buffer.
+
+Playing a block with a single call removes per-trial scheduling jitter: the
+onset of every tone is fixed by its sample position in the block, which is
+returned as an onset/offset table.
+"""
+import numpy as np
+
+from .wavhelpers import encode_trigger_pulses, MAX_VAL_16BITS
+
+
+def block_onsets(stimLenSamp, silenceLenSamp, leadInSamp=0):
+    """Onset/offset table of consecutive tone + silence trials.
+
+    Parameters
+    ----------
+    stimLenSamp : array-like of int
+        Tone length of each trial, in samples.
+    silenceLenSamp : array-like of int
+        Silence following each tone, in samples.
+    leadInSamp : int
+        Silence before the first tone, in samples.
+
+    Returns
+    -------
+    onsets : ndarray, shape (n_trials, 2)
+        Tone onset and offset (exclusive) of each trial, in samples from the
+        start of the block.
+    n_samples : int
+        Total length of the block.
+    """
+    stimLenSamp = np.asarray(stimLenSamp, dtype=np.int64)
+    trialLenSamp = stimLenSamp + np.asarray(silenceLenSamp, dtype=np.int64)
+    onsets = np.empty((len(stimLenSamp), 2), dtype=np.int64)
+    onsets[:, 0] = leadInSamp
+    onsets[1:, 0] += np.cumsum(trialLenSamp[:-1])
+    onsets[:, 1] = onsets[:, 0] + stimLenSamp
+    return onsets, int(leadInSamp + trialLenSamp.sum())
+
+
+def render_block(buffers, silence_durations, audioSamplingRate,
+                 lead_in_sec=0., trigger_codes=None, trigger_channel=1,
+                 scaling=MAX_VAL_16BITS):
+    """Concatenate trial buffers and silences into one contiguous block.
+
+    Parameters
+    ----------
+    buffers : list of ndarray
+        One (n_samples, n_channels) stimulus buffer per trial, e.g. from
+        `meeg.wavhelpers.synthesize_tones`. All must share dtype and number
+        of channels.
+    silence_durations : array-like of float
+        Silence after each tone, in seconds. Rounded to whole samples.
+    audioSamplingRate : float
+        Sampling rate in Hz.
+    lead_in_sec : float
+        Silence before the first tone, in seconds.
+    trigger_codes : array-like of int | None
+        If given, the trigger code of each trial is written as a pulse train
+        (see `meeg.wavhelpers.encode_trigger_pulses`) at its tone onset.
+    trigger_channel : int
+        Channel holding the pulse trains. An existing channel is cleared
+        first; a channel index equal to the number of channels in `buffers`
+        adds a dedicated trigger channel.
+    scaling : int
+        Peak value of the trigger pulses.
+
+    Returns
+    -------
+    block : ndarray, shape (n_samples, n_channels)
+        The whole block, ready to play.
+    onsets : ndarray, shape (n_trials, 2)
+        Tone onset and offset (exclusive) of each trial, in samples from the
+        start of the block. Divide by `audioSamplingRate` for seconds.
+    """
+    if len(buffers) == 0:
+        raise ValueError('Cannot render an empty block')
+    if len(buffers) != len(silence_durations):
+        raise ValueError('Need one silence duration per buffer ({} vs. {})'
+                         .format(len(buffers), len(silence_durations)))
+    silenceLenSamp = np.round(np.asarray(silence_durations, dtype=float) *
+                              audioSamplingRate).astype(np.int64)
+    onsets, nSamp = block_onsets([len(buf) for buf in buffers],
+                                 silenceLenSamp,
+                                 int(round(lead_in_sec * audioSamplingRate)))
+    nChan = buffers[0].shape[1]
+    if trigger_codes is not None and trigger_channel == nChan:
+        nChan += 1
+    block = np.zeros((nSamp, nChan), dtype=buffers[0].dtype)
+    for (onset, offset), buf in zip(onsets, buffers):
+        block[onset:offset, :buf.shape[1]] = buf
+
+    if trigger_codes is not None:
+        if len(trigger_codes) != len(buffers):
+            raise ValueError('Need one trigger code per buffer ({} vs. {})'
+                             .format(len(buffers), len(trigger_codes)))
+        block[:, trigger_channel] = 0
+        for (onset, offset), code in zip(onsets, trigger_codes):
+            pulses = encode_trigger_pulses(code, audioSamplingRate,
+                                           scaling=scaling)
+            pulses = pulses[:offset - onset]
+            block[onset:onset + len(pulses), trigger_channel] = pulses
+    return block, onsets
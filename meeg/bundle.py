@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Ready-to-run session bundles.
+
+A bundle is a directory holding everything a session needs, prepared
+ahead of time:
+
+- ``audio.npy``: the rendered audio of all blocks, one after the other,
+  memory-mapped when the bundle is opened;
+- ``trials.npz``: the trial table, one array per column;
+- ``triggers.npz``: the trigger plan, one array per column;
+- ``bundle.json``: where each block is in the audio, plus free-form
+  metadata (subject, seed, configuration, ...);
+- any extra text files, e.g. a human-readable schedule.
+
+Opening a bundle reads two small files and maps the audio, so it takes the
+same (short) time however long the session is.
+"""
+import json
+import os
+from os.path import join as opj
+import shutil
+import numpy as np
+
+BUNDLE_VERSION = 1
+META_NAME = 'bundle.json'
+AUDIO_NAME = 'audio.npy'
+TRIALS_NAME = 'trials.npz'
+TRIGGERS_NAME = 'triggers.npz'
+
+
+def write_bundle(dirname, blocks, trials, triggers, meta=None, files=None):
+    """Write a session bundle, replacing any bundle at `dirname`.
+
+    Parameters
+    ----------
+    dirname : str
+        Bundle directory. The bundle is written next to it first and then
+        moved into place, so it is never seen half-written.
+    blocks : list of (str, ndarray)
+        Name and (n_samples, n_channels) audio of each block, in playing
+        order. All blocks must share dtype and number of channels.
+    trials : dict of array-like
+        Columns of the trial table.
+    triggers : dict of array-like
+        Columns of the trigger plan.
+    meta : dict | None
+        JSON-serializable metadata, stored under 'meta' in bundle.json.
+    files : dict | None
+        Extra text files to include, as {file name: contents}.
+    """
+    if len(blocks) == 0:
+        raise ValueError('A bundle needs at least one block')
+    if len(set(block.shape[1:] + (block.dtype,) for _, block in blocks)) > 1:
+        raise ValueError('All blocks must have the same channels and dtype')
+    tmp_dirname = dirname.rstrip(os.sep) + '.tmp'
+    if os.path.isdir(tmp_dirname):
+        shutil.rmtree(tmp_dirname)
+    os.makedirs(tmp_dirname)
+
+    n_samples = sum(len(block) for _, block in blocks)
+    first = blocks[0][1]
+    audio = np.lib.format.open_memmap(opj(tmp_dirname, AUDIO_NAME), mode='w+',
+                                      dtype=first.dtype,
+                                      shape=(n_samples,) + first.shape[1:])
+    block_index = []
+    start = 0
+    for name, block in blocks:
+        audio[start:start + len(block)] = block
+        block_index.append([name, start, start + len(block)])
+        start += len(block)
+    audio.flush()
+    del audio
+
+    np.savez(opj(tmp_dirname, TRIALS_NAME), **trials)
+    np.savez(opj(tmp_dirname, TRIGGERS_NAME), **triggers)
+    for fname, contents in (files or dict()).items():
+        with open(opj(tmp_dirname, fname), 'w') as fp:
+            fp.write(contents)
+    with open(opj(tmp_dirname, META_NAME), 'w') as fp:
+        json.dump(dict(version=BUNDLE_VERSION, blocks=block_index,
+                       meta=meta or dict()), fp, indent=1)
+
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmp_dirname, dirname)
+
+
+class SessionBundle(object):
+    """A session bundle opened for running.
+
+    Parameters
+    ----------
+    dirname : str
+        Bundle directory, as written by `write_bundle`.
+    mmap_mode : str | None
+        How to map the audio (default: 'r', read-only); None reads it
+        into memory.
+
+    Attributes
+    ----------
+    meta : dict
+        The metadata stored with the bundle.
+    blocks : list of str
+        Block names, in playing order.
+    trials, triggers : dict of ndarray
+        Columns of the trial table and of the trigger plan.
+    """
+    def __init__(self, dirname, mmap_mode='r'):
+        self.dirname = dirname
+        with open(opj(dirname, META_NAME), 'r') as fp:
+            index = json.load(fp)
+        if index['version'] != BUNDLE_VERSION:
+            raise ValueError('Bundle {} has version {}, expected {}'.format(
+                dirname, index['version'], BUNDLE_VERSION))
+        self.meta = index['meta']
+        self._slices = dict((name, slice(start, stop))
+                            for name, start, stop in index['blocks'])
+        self.blocks = [name for name, _, _ in index['blocks']]
+        self.audio = np.load(opj(dirname, AUDIO_NAME), mmap_mode=mmap_mode)
+        self.trials = _load_columns(opj(dirname, TRIALS_NAME))
+        self.triggers = _load_columns(opj(dirname, TRIGGERS_NAME))
+
+    def block(self, name):
+        """Audio of a block (a view of the mapped audio)."""
+        return self.audio[self._slices[name]]
+
+    def path(self, fname):
+        """Full path of a file in the bundle."""
+        return opj(self.dirname, fname)
+
+
+def _load_columns(fname):
+    with np.load(fname) as data:
+        return dict((key, data[key]) for key in data.files)
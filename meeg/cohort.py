@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Counterbalanced schedules for a whole cohort, in one indexed file.
+
+A cohort file holds the trial tables of many subjects back to back in one
+structured array, preceded by a JSON header listing, for every subject,
+its seed, condition order and rows. Opening the file reads the header and
+maps the rows, so a subject's plan is found and read in constant time
+however many subjects the file holds.
+
+Order balancing uses Williams designs (balanced Latin squares): each
+stimulus takes every position equally often across rows, and immediately
+follows every other stimulus equally often. `balanced_order` orders a
+subject's trials in runs of one trial per stimulus, each run in the order
+of a square row; giving subjects successive rows balances positions and
+carry-over across the cohort.
+"""
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+
+from .trialtable import TrialTable
+
+COHORT_VERSION = 1
+_MAGIC = b'MEEGCOHORT\n'
+_ALIGN = 64
+
+
+def subject_seed(base_seed, subject):
+    """Seed of a subject: the same for the same base seed and subject ID,
+    whatever other subjects are in the cohort.
+    """
+    digest = hashlib.sha1('{}:{}'.format(base_seed, subject).encode('utf-8'))
+    return struct.unpack('<I', digest.digest()[:4])[0] & 0x7fffffff
+
+
+def williams_square(n):
+    """Balanced Latin square of `n` symbols.
+
+    Returns an (n, n) array for even `n` and a (2 * n, n) array for odd
+    `n` (the square and its mirror image), whose rows are orders of
+    ``range(n)``.
+    """
+    first = np.empty(n, dtype=np.int64)
+    first[0::2] = np.arange((n + 1) // 2)
+    first[1::2] = (n - np.arange(1, n // 2 + 1)) % n
+    square = (first[np.newaxis] + np.arange(n)[:, np.newaxis]) % n
+    if n % 2:
+        square = np.concatenate((square, square[:, ::-1]))
+    return square
+
+
+def balanced_order(stims, square, row=0, seed=None):
+    """Order trials in runs of one trial per stimulus.
+
+    Parameters
+    ----------
+    stims : array of int, shape (n_trials,)
+        Stimulus index (0 to n_stims - 1) of every trial; every stimulus
+        must have the same number of trials.
+    square : array of int, shape (n_rows, n_stims)
+        Stimulus orders, e.g. from `williams_square`.
+    row : int
+        Square row of the first run; run ``k`` uses row ``row + k``
+        (modulo the number of rows).
+    seed : int | None | instance of np.random.RandomState
+        Which of a stimulus' trials goes into which run is drawn at random.
+
+    Returns
+    -------
+    order : array of int, shape (n_trials,)
+        Indices into `stims`, in playing order.
+    """
+    if not isinstance(seed, np.random.RandomState):
+        seed = np.random.RandomState(seed)
+    stims = np.asarray(stims)
+    n_rows, n_stims = square.shape
+    counts = np.bincount(stims, minlength=n_stims)
+    if len(counts) != n_stims or np.any(counts != counts[0]):
+        raise ValueError('Every stimulus needs the same number of trials, '
+                         'got {}'.format(counts.tolist()))
+    n_runs = counts[0]
+    # trials grouped by stimulus, in random order within each stimulus
+    grouped = np.lexsort((seed.rand(len(stims)), stims)).reshape(n_stims,
+                                                                 n_runs)
+    runs = square[(row + np.arange(n_runs)) % n_rows]
+    return grouped[runs, np.arange(n_runs)[:, np.newaxis]].ravel()
+
+
+def write_cohort(fname, subjects, tables, meta=None):
+    """Write the plans of a cohort to one indexed file.
+
+    Parameters
+    ----------
+    fname : str
+        Output file. It is written next to its final name first and then
+        moved into place.
+    subjects : list of dict
+        One entry per subject, with at least a unique 'subject' ID; the
+        rest (seed, condition order, ...) is kept as is.
+    tables : list of TrialTable
+        Plan of each subject, all with the same columns.
+    meta : dict | None
+        JSON-serializable metadata about the whole cohort.
+    """
+    if len(subjects) != len(tables):
+        raise ValueError('Got {} subjects but {} tables'.format(
+            len(subjects), len(tables)))
+    ids = [subject['subject'] for subject in subjects]
+    if len(set(ids)) != len(ids):
+        raise ValueError('Subject IDs must be unique')
+    data = np.concatenate([table.data for table in tables])
+    stops = np.cumsum([len(table) for table in tables]).tolist()
+    index = [dict(subject, start=start, stop=stop) for subject, start, stop
+             in zip(subjects, [0] + stops[:-1], stops)]
+    header = json.dumps(dict(version=COHORT_VERSION,
+                             dtype=np.lib.format.dtype_to_descr(data.dtype),
+                             n_rows=len(data), subjects=index,
+                             meta=meta or dict())).encode('utf-8')
+    offset = len(_MAGIC) + 8 + len(header)
+    header += b' ' * (-offset % _ALIGN)
+
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as fp:
+        fp.write(_MAGIC)
+        fp.write(struct.pack('<Q', len(header)))
+        fp.write(header)
+        fp.write(data.tobytes())
+    os.replace(tmp_fname, fname)
+
+
+class CohortFile(object):
+    """A cohort file opened for reading.
+
+    Parameters
+    ----------
+    fname : str
+        File written by `write_cohort`.
+
+    Attributes
+    ----------
+    subjects : list of str
+        Subject IDs, in the order they were written.
+    meta : dict
+        The metadata stored with the cohort.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as fp:
+            if fp.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('{} is not a cohort file'.format(fname))
+            n_header, = struct.unpack('<Q', fp.read(8))
+            header = json.loads(fp.read(n_header).decode('utf-8'))
+        if header['version'] != COHORT_VERSION:
+            raise ValueError('Cohort {} has version {}, expected {}'.format(
+                fname, header['version'], COHORT_VERSION))
+        self.meta = header['meta']
+        self._index = dict((entry['subject'], entry)
+                           for entry in header['subjects'])
+        self.subjects = [entry['subject'] for entry in header['subjects']]
+        dtype = np.dtype([tuple(field) for field in header['dtype']])
+        offset = len(_MAGIC) + 8 + n_header
+        self._rows = (np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                                shape=(header['n_rows'],))
+                      if header['n_rows'] else np.zeros(0, dtype))
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __contains__(self, subject):
+        return subject in self._index
+
+    def info(self, subject):
+        """Index entry of a subject (seed, condition order, rows, ...)."""
+        return dict(self._index[subject])
+
+    def table(self, subject):
+        """Plan of a subject, as a TrialTable read into memory."""
+        entry = self._index[subject]
+        return TrialTable(np.array(self._rows[entry['start']:entry['stop']]))
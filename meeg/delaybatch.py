@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""Delay extraction for many recordings at once, with a result cache.
+
+`batch_extract_delays` runs `meeg.delays.extract_delays` on a list of FIF or
+BrainVision recordings (or the directories holding them) in a process pool
+and returns one row of delay statistics per recording. The delays of every
+recording are cached in a JSON sidecar file, keyed by the extraction
+parameters and by the size, mtime and SHA-1 of the recording's files, so a
+rerun only processes recordings that are new or have changed.
+
+From the command line::
+
+    python -m meeg.delaybatch /data/qc/ --misc-chan MISC001 --n-jobs 4 \\
+        --out delays.csv
+"""
+from __future__ import print_function
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import hashlib
+import json
+import os
+from os.path import join as opj
+import re
+from six import string_types
+import numpy as np
+
+from .delays import extract_delays
+
+SIDECAR_EXT = '.delays.json'
+# bump when the extraction changes, so old sidecars are no longer matched
+CACHE_VERSION = 1
+STATS = ('n', 'mean', 'std', 'median', 'q10', 'q90', 'min', 'max')
+COLUMNS = ('file',) + STATS + ('cached', 'error')
+
+
+# raw FIF names as mne expects them (events, epochs, ICA, ... don't match),
+# with split continuations, and BrainVision headers
+RAW_PATTERN = re.compile(
+    r'((raw|raw_sss|raw_tsss|_meg|_eeg|_ieeg)(-\d+)?\.fif(\.gz)?|\.vhdr)$')
+
+
+def find_recordings(paths):
+    """Raw FIF and BrainVision header files in `paths` (files or
+    directories).
+
+    Directories are searched recursively for files named like raw
+    recordings (``*raw.fif``, ``*_meg.fif``, ``*.vhdr``, ... see
+    `RAW_PATTERN`), so events, epochs and other derived FIF files next to
+    them are skipped; files given by name are taken as they are.
+    Continuation files of split FIF recordings (``name-1.fif``, ...) are
+    left out when ``name.fif`` is there, as they are read along with it.
+    """
+    if isinstance(paths, string_types):
+        paths = [paths]
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                fnames.extend(opj(root, fname) for fname in sorted(files)
+                              if RAW_PATTERN.search(fname))
+        else:
+            fnames.append(path)
+    present = set(fnames)
+    return [fname for fname in fnames
+            if not (re.search(r'-\d+\.fif$', fname) and
+                    re.sub(r'-\d+\.fif$', '.fif', fname) in present)]
+
+
+def _recording_files(fname):
+    """All files the data of a recording is read from."""
+    base, ext = os.path.splitext(fname)
+    if ext == '.vhdr':
+        return [fname] + [base + sibling for sibling in ('.vmrk', '.eeg')
+                          if os.path.exists(base + sibling)]
+    files = [fname]
+    part = 1
+    while os.path.exists('{}-{:d}.fif'.format(base, part)):
+        files.append('{}-{:d}.fif'.format(base, part))
+        part += 1
+    return files
+
+
+def _file_sha1(fname, chunk_bytes=1 << 22):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_bytes), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _params_key(params):
+    """Hash of the extraction parameters."""
+    blob = json.dumps([CACHE_VERSION] + ['{}={!r}'.format(key, params[key])
+                                         for key in sorted(params)])
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+def _unique_name(fname, dirname, ext):
+    """File for `fname` in `dirname`, told apart from recordings with the
+    same name in other directories by a hash of its path.
+    """
+    path_hash = hashlib.sha1(
+        os.path.abspath(fname).encode('utf-8')).hexdigest()[:8]
+    return opj(dirname, '{}-{}{}'.format(os.path.basename(fname), path_hash,
+                                         ext))
+
+
+def sidecar_name(fname, cache_dir=None):
+    """Cache file of a recording: next to it, or in `cache_dir`."""
+    if cache_dir is None:
+        return fname + SIDECAR_EXT
+    return _unique_name(fname, cache_dir, SIDECAR_EXT)
+
+
+def report_name(fname, report_dir):
+    """HTML QC report of a recording in `report_dir`."""
+    return _unique_name(fname, report_dir, '.html')
+
+
+def _read_sidecar(sidecar, fname, params_key):
+    """Cached entry of a recording, if still valid (else None)."""
+    try:
+        with open(sidecar, 'r') as fp:
+            entry = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if entry.get('params') != params_key:
+        return None
+    files = _recording_files(fname)
+    cached_files = entry.get('files', [])
+    if [info['name'] for info in cached_files] != files:
+        return None
+    for info in cached_files:
+        stat = os.stat(info['name'])
+        if stat.st_size != info['size']:
+            return None
+        if stat.st_mtime != info['mtime']:
+            # touched but maybe not changed: compare contents
+            if _file_sha1(info['name']) != info['sha1']:
+                return None
+            info['mtime'] = stat.st_mtime
+            entry['refreshed'] = True
+    return entry
+
+
+def _write_sidecar(sidecar, entry):
+    entry.pop('refreshed', None)
+    tmp_fname = sidecar + '.tmp'
+    with open(tmp_fname, 'w') as fp:
+        json.dump(entry, fp)
+    os.replace(tmp_fname, sidecar)
+
+
+def _cache_error(err):
+    return 'not cached: {}: {}'.format(type(err).__name__, err)
+
+
+def delay_stats(delays):
+    """Statistics (ms) of an array of delays, as in the batch table."""
+    delays = np.asarray(delays, dtype=float)
+    if len(delays) == 0:
+        return dict(n=0)
+    return dict(n=len(delays), mean=np.mean(delays), std=np.std(delays),
+                median=np.median(delays),
+                q10=np.percentile(delays, 10.),
+                q90=np.percentile(delays, 90.),
+                min=np.min(delays), max=np.max(delays))
+
+
+def _process(fname, params, sidecar, use_cache, report_fname=None):
+    """Delay statistics of one recording (runs in a worker process)."""
+    row = dict(file=fname, cached=False, error='')
+    params_key = _params_key(params)
+    entry = None
+    if use_cache and (report_fname is None or
+                      os.path.exists(report_fname)):
+        entry = _read_sidecar(sidecar, fname, params_key)
+    if entry is not None:
+        row.update(delay_stats(entry['delays']), cached=True)
+        if entry.get('refreshed'):
+            try:
+                _write_sidecar(sidecar, entry)
+            except (IOError, OSError) as err:  # the cached delays are fine
+                row.update(error=_cache_error(err))
+        return row
+    try:
+        delays = extract_delays(fname, plot_figures=False,
+                                return_values='delays',
+                                report_fname=report_fname, **params)
+    except Exception as err:  # report it in the table, go on with the rest
+        row.update(n=0, error='{}: {}'.format(type(err).__name__, err))
+        return row
+    row.update(delay_stats(delays))
+    if use_cache:
+        try:
+            files = []
+            for name in _recording_files(fname):
+                stat = os.stat(name)
+                files.append(dict(name=name, size=stat.st_size,
+                                  mtime=stat.st_mtime, sha1=_file_sha1(name)))
+            _write_sidecar(sidecar, dict(params=params_key, files=files,
+                                         delays=np.asarray(delays).tolist()))
+        except (IOError, OSError) as err:  # keep the delays, uncached
+            row.update(error=_cache_error(err))
+    return row
+
+
+def batch_extract_delays(paths, n_jobs=1, cache_dir=None, use_cache=True,
+                         report_dir=None, **params):
+    """Run `extract_delays` on many recordings, reusing cached results.
+
+    Parameters
+    ----------
+    paths : str | list of str
+        Recordings (.fif, .vhdr) and/or directories to search for them.
+    n_jobs : int
+        Number of worker processes (default: 1, no pool).
+    cache_dir : str | None
+        Directory for the sidecar cache files. None (default) puts them
+        next to the recordings.
+    use_cache : bool
+        Read and write the sidecar cache (default: True).
+    report_dir : str | None
+        If given, write an HTML QC report (figure and delay stats) of each
+        recording to this directory. Recordings without a report are
+        processed again even if cached.
+    **params
+        Keyword arguments of `extract_delays` (e.g. ``stim_chan``,
+        ``misc_chan``, ``trig_codes``, ``streaming``); `plot_figures` and
+        `return_values` are set by the batch.
+
+    Returns
+    -------
+    rows : list of dict
+        One row per recording with the keys in `COLUMNS`; delay statistics
+        are in ms. Recordings that failed have ``n == 0`` and the error
+        message in ``error``; they are not cached, so a rerun retries them.
+        A sidecar that could not be written is noted in ``error`` too, with
+        the statistics kept.
+    """
+    for key in ('plot_figures', 'return_values', 'report_fname'):
+        if key in params:
+            raise ValueError('{} cannot be set for batch extraction'
+                             .format(key))
+    fnames = find_recordings(paths)
+    for path in (cache_dir, report_dir):
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+    jobs = [(fname, params, sidecar_name(fname, cache_dir), use_cache,
+             None if report_dir is None else report_name(fname, report_dir))
+            for fname in fnames]
+    if n_jobs == 1:
+        return [_process(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(_process, *zip(*jobs))) if jobs else []
+
+
+def write_stats_table(rows, fname):
+    """Write the rows of `batch_extract_delays` to a CSV file."""
+    with open(fname, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=COLUMNS,
+                                extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def format_stats_table(rows):
+    """Human-readable table of the rows of `batch_extract_delays`."""
+    lines = ['{:<40s} {:>6s} {:>8s} {:>7s} {:>8s} {:>8s} {:>8s}  {}'.format(
+        'file', 'n', 'mean', 'std', 'median', 'q10', 'q90', 'note')]
+    for row in rows:
+        note = row['error'] or ('cached' if row['cached'] else '')
+        if row['n'] == 0:
+            lines.append('{:<40s} {:>6d} {:>52s}'.format(
+                os.path.basename(row['file']), 0, note))
+            continue
+        lines.append('{:<40s} {:>6d} {:>8.2f} {:>7.2f} {:>8.2f} {:>8.2f} '
+                     '{:>8.2f}  {}'.format(
+                         os.path.basename(row['file']), row['n'],
+                         row['mean'], row['std'], row['median'], row['q10'],
+                         row['q90'], note))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extract trigger-to-analogue delays of many recordings.')
+    parser.add_argument('paths', nargs='+',
+                        help='recordings and/or directories holding them')
+    parser.add_argument('--stim-chan', default='STI101')
+    parser.add_argument('--misc-chan', default='MISC001')
+    parser.add_argument('--trig-codes', type=int, nargs='+', default=None)
+    parser.add_argument('--min-separation', type=float, default=None,
+                        help='seconds')
+    parser.add_argument('--time-shift', type=float, default=None,
+                        help='seconds')
+    parser.add_argument('--streaming', action='store_true',
+                        help='read recordings in chunks, without preloading')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--cache-dir', default=None,
+                        help='sidecar directory (default: next to the data)')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--report-dir', default=None,
+                        help='directory for per-recording HTML reports')
+    parser.add_argument('--out', default=None, help='CSV file for the table')
+    args = parser.parse_args(argv)
+
+    rows = batch_extract_delays(
+        args.paths, n_jobs=args.n_jobs, cache_dir=args.cache_dir,
+        use_cache=not args.no_cache, report_dir=args.report_dir,
+        stim_chan=args.stim_chan, misc_chan=args.misc_chan,
+        trig_codes=args.trig_codes,
+        min_separation=args.min_separation, time_shift=args.time_shift,
+        streaming=args.streaming)
+    print(format_stats_table(rows))
+    if args.out is not None:
+        write_stats_table(rows, args.out)
+
+
+if __name__ == '__main__':
+    main()
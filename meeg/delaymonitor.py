@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""Online trigger-to-analogue delay monitoring during a session.
+
+`DelayMonitor` is fed blocks of stim and misc samples as they arrive and
+does what `meeg.delays.extract_delays` does offline, incrementally: stim
+onsets (steps up in value) are detected as they come in, the analogue
+threshold is a running estimate over the baseline windows of all triggers
+so far, and each trigger's delay is found as soon as the misc data after
+it crosses the threshold. Memory is bounded: only the misc samples that
+can still be needed and the last `history` results are kept.
+
+Samples come from a source (see `make_source`):
+
+- 'array': numpy arrays, e.g. a recording already in memory.
+- 'file': a FIF or BrainVision recording, read block by block (needs mne);
+  with ``realtime=True`` it is replayed at the sampling rate.
+- 'socket': a local TCP stream of (stim, misc) float32 sample pairs, the
+  stand-in for the amplifier stream; `serve_source` sends any source to it.
+
+From the command line, replay a recording through the monitor::
+
+    python -m meeg.delaymonitor rec_raw.fif --misc-chan MISC001 --realtime
+"""
+from __future__ import print_function
+import argparse
+import socket
+import time
+import numpy as np
+
+from .ringbuffer import RingBuffer
+from .stimsteps import merge_samples, merge_steps
+
+DEFAULT_PORT = 50007
+# a socket frame: stim value and misc value of one sample
+_FRAME_DTYPE = np.dtype('<f4')
+_FRAME_BYTES = 2 * _FRAME_DTYPE.itemsize
+
+
+class SampleSource(object):
+    """Base class of the sample sources.
+
+    `read` returns the next block as a (stim, misc) pair of 1D arrays, or
+    None at the end of the stream; iterating over a source yields blocks.
+    `min_duration` is the stim step merging the data calls for, if known.
+    """
+    sfreq = None
+    min_duration = None
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            block = self.read()
+            if block is None:
+                return
+            yield block
+
+
+class _ReplaySource(SampleSource):
+    """Source reading blocks of a finished recording, optionally paced."""
+    def __init__(self, n_times, sfreq, block_duration=0.05, realtime=False):
+        self.n_times = n_times
+        self.sfreq = sfreq
+        self.block_samps = max(int(block_duration * sfreq), 1)
+        self.realtime = realtime
+        self._pos = 0
+        self._start = None
+
+    def read(self):
+        if self._pos >= self.n_times:
+            return None
+        stop = min(self._pos + self.block_samps, self.n_times)
+        if self.realtime:
+            if self._start is None:
+                self._start = time.perf_counter()
+            # a block is available once its last sample was recorded
+            wait = self._start + stop / self.sfreq - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        block = self._get(self._pos, stop)
+        self._pos = stop
+        return block
+
+    def _get(self, start, stop):
+        raise NotImplementedError
+
+
+class ArraySource(_ReplaySource):
+    """Replay stim and misc arrays in blocks of `block_duration` seconds."""
+    def __init__(self, stim, misc, sfreq, block_duration=0.05,
+                 realtime=False):
+        if len(stim) != len(misc):
+            raise ValueError('stim and misc must have the same length')
+        super(ArraySource, self).__init__(len(stim), sfreq, block_duration,
+                                          realtime)
+        self.stim = np.asarray(stim)
+        self.misc = np.asarray(misc)
+
+    def _get(self, start, stop):
+        return self.stim[start:stop], self.misc[start:stop]
+
+
+class FileSource(_ReplaySource):
+    """Replay the stim and misc channels of a FIF or BrainVision file.
+
+    Only the two channels are read, block by block, so the recording is
+    never loaded as a whole.
+    """
+    def __init__(self, fname, stim_chan='STI101', misc_chan='MISC001',
+                 block_duration=0.05, realtime=False):
+        from mne import pick_channels
+        from mne.io import read_raw_fif, read_raw_brainvision
+        # as `extract_delays`: merge close steps for MEG, not for EEG
+        if fname.endswith('vhdr'):
+            raw = read_raw_brainvision(fname, misc=[misc_chan])
+            self.min_duration = 0.
+        else:
+            raw = read_raw_fif(fname, preload=False)
+            self.min_duration = 0.002
+        self.raw = raw
+        self._picks = [pick_channels(raw.info['ch_names'],
+                                     include=[name])[0]
+                       for name in (stim_chan, misc_chan)]
+        super(FileSource, self).__init__(raw.n_times, raw.info['sfreq'],
+                                         block_duration, realtime)
+
+    def _get(self, start, stop):
+        data = self.raw.get_data(picks=self._picks, start=start, stop=stop)
+        return data[0], data[1]
+
+
+class SocketSource(SampleSource):
+    """Read (stim, misc) float32 sample pairs from a local TCP stream.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate of the stream (not sent over the socket).
+    host, port : str, int
+        Address of the sender, e.g. `serve_source`.
+    max_block_samps : int
+        Largest number of samples returned by one `read`.
+    """
+    def __init__(self, sfreq, host='127.0.0.1', port=DEFAULT_PORT,
+                 max_block_samps=4096):
+        self.sfreq = sfreq
+        self.max_bytes = max_block_samps * _FRAME_BYTES
+        self._sock = socket.create_connection((host, port))
+        self._rest = b''
+
+    def read(self):
+        while True:
+            data = self._sock.recv(self.max_bytes - len(self._rest))
+            if not data:
+                return None
+            data = self._rest + data
+            n_bytes = len(data) - len(data) % _FRAME_BYTES
+            self._rest = data[n_bytes:]
+            if n_bytes:
+                frames = np.frombuffer(data[:n_bytes], dtype=_FRAME_DTYPE)
+                frames = frames.reshape(-1, 2)
+                return frames[:, 0], frames[:, 1]
+
+    def close(self):
+        self._sock.close()
+
+
+def serve_source(source, host='127.0.0.1', port=DEFAULT_PORT):
+    """Send the blocks of `source` to the first client that connects.
+
+    Stands in for the amplifier stream when testing a `SocketSource`, e.g.
+    by replaying a `FileSource` with ``realtime=True``. Blocks until the
+    source is exhausted.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    conn, _ = server.accept()
+    try:
+        for stim, misc in source:
+            frames = np.empty((len(stim), 2), dtype=_FRAME_DTYPE)
+            frames[:, 0] = stim
+            frames[:, 1] = misc
+            conn.sendall(frames.tobytes())
+    finally:
+        conn.close()
+        server.close()
+
+
+def make_source(name, **kwargs):
+    """Create a sample source by name ('array', 'file' or 'socket');
+    keyword arguments go to the source class.
+    """
+    if name == 'array':
+        return ArraySource(**kwargs)
+    elif name == 'file':
+        return FileSource(**kwargs)
+    elif name == 'socket':
+        return SocketSource(**kwargs)
+    raise ValueError('Unknown sample source: {}'.format(name))
+
+
+class DelayMonitor(object):
+    """Incremental delay estimation from blocks of stim and misc samples.
+
+    The threshold follows `meeg.delays.extract_delays`: the misc window
+    `baseline` around each trigger is corrected by its mean up to the
+    trigger and rectified,
+    and the off level and limit are the running means of its mean and
+    `sd_limit` times its SD, over all triggers so far. Stim steps closer
+    than `min_duration` are merged as by ``mne.find_events``, so a trigger
+    is only reported once its value has been stable for that long.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate in Hz.
+    trig_codes : list of int | None
+        Trigger values to monitor; None (default) means all.
+    baseline : tuple of float
+        Baseline window around the trigger, in seconds (default:
+        (-0.1, 0.)).
+    maxdelay : float
+        Longest delay looked for, in seconds (default: 1.); triggers with
+        no crossing within it are counted as missed.
+    sd_limit : float
+        Threshold in baseline SDs (default: 5.).
+    history : int
+        Number of recent results kept for `recent` and the recent stats.
+    max_block_duration : float
+        Longer blocks are fed in pieces of this length (default: 1 s); it
+        bounds the misc samples kept.
+    min_duration : float
+        Stim steps closer than this (in seconds) are merged into one, e.g.
+        ramping trigger values (default: 0.002, as `extract_delays` uses
+        for FIF recordings).
+    """
+    def __init__(self, sfreq, trig_codes=None, baseline=(-0.1, 0.),
+                 maxdelay=1., sd_limit=5., history=1000,
+                 max_block_duration=1., min_duration=0.002):
+        self.sfreq = sfreq
+        self.trig_codes = None if trig_codes is None else set(trig_codes)
+        self.sd_limit = sd_limit
+        self.base_start = int(round(baseline[0] * sfreq))
+        self.base_samps = int(round(baseline[1] * sfreq)) - \
+            self.base_start + 1
+        # samples up to the trigger, whose mean is subtracted
+        self.base_pre_samps = min(1 - self.base_start, self.base_samps)
+        if self.base_pre_samps <= 0:
+            raise ValueError('The baseline window must start at or before '
+                             'the trigger')
+        self.maxdelay_samps = int(round(maxdelay * sfreq))
+        self.max_block_samps = max(int(max_block_duration * sfreq), 1)
+        self._misc = RingBuffer(max(-self.base_start, 0) +
+                                max(self.maxdelay_samps,
+                                    self.base_start + self.base_samps) +
+                                self.max_block_samps)
+        self.merge_samps = merge_samples(min_duration, sfreq)
+        self._last_stim = 0
+        # (sample, before, after) stim steps that may still be merged
+        self._steps = np.empty((0, 3), dtype=np.int64)
+        # [sample, code, baseline done, samples searched]
+        self._pending = []
+        self._base_n = 0
+        self._base_mean_sum = 0.
+        self._base_std_sum = 0.
+        # (sample, code, delay in ms or NaN if missed)
+        self.results = RingBuffer(history, shape=(3,))
+        self.n_found = 0
+        self.n_missed = 0
+        self._mean = 0.
+        self._m2 = 0.
+        self._min = np.inf
+        self._max = -np.inf
+
+    @property
+    def n_samples(self):
+        """Number of samples fed so far."""
+        return self._misc.count
+
+    def threshold(self):
+        """Current (off level, limit), or None before the first baseline."""
+        if self._base_n == 0:
+            return None
+        return (self._base_mean_sum / self._base_n,
+                self.sd_limit * self._base_std_sum / self._base_n)
+
+    def feed(self, stim, misc):
+        """Add a block of samples.
+
+        Returns
+        -------
+        new : list of tuple
+            (sample, code, delay in ms) of the triggers resolved by this
+            block; the delay is NaN for a missed trigger.
+        """
+        stim = np.abs(np.asarray(stim)).astype(np.int64)
+        misc = np.asarray(misc, dtype=float)
+        new = []
+        for start in range(0, len(stim), self.max_block_samps):
+            block = slice(start, start + self.max_block_samps)
+            new.extend(self._feed(stim[block], misc[block]))
+        return new
+
+    def _feed(self, stim, misc):
+        if len(stim) == 0:
+            return []
+        first = self._misc.count
+        self._misc.extend(misc)
+        before = np.r_[self._last_stim, stim[:-1]]
+        idx = np.flatnonzero(stim != before)
+        self._last_stim = stim[-1]
+        steps = np.r_[self._steps,
+                      np.c_[first + idx, before[idx], stim[idx]]]
+        # a step may still merge with one less than merge_samps after it:
+        # hold back the steps from the last gap wider than that on
+        end = first + len(stim)
+        if len(steps) and end - steps[-1, 0] > self.merge_samps:
+            cut = len(steps)
+        else:
+            gaps = np.flatnonzero(np.diff(steps[:, 0]) > self.merge_samps)
+            cut = gaps[-1] + 1 if len(gaps) else 0
+        self._steps = steps[cut:]
+        for sample, value_before, code in merge_steps(steps[:cut],
+                                                      self.merge_samps):
+            if code > value_before and (self.trig_codes is None or
+                                        code in self.trig_codes):
+                self._pending.append([int(sample), int(code), False, 0])
+        if self._pending:
+            return self._resolve()
+        return []
+
+    def _resolve(self):
+        end = self._misc.count
+        data = self._misc.read()
+        data_start = end - len(data)
+        new = []
+        still_pending = []
+        for trigger in self._pending:
+            sample, code, base_done, searched = trigger
+            if not base_done:
+                base_first = sample + self.base_start
+                if base_first + self.base_samps > end:
+                    still_pending.append(trigger)
+                    continue
+                if base_first >= data_start:  # else: cut off, left out
+                    window = data[base_first - data_start:
+                                  base_first - data_start + self.base_samps]
+                    window = np.abs(window - window[:self.base_pre_samps]
+                                    .mean())  # RECTIFY!
+                    self._base_n += 1
+                    self._base_mean_sum += window.mean()
+                    self._base_std_sum += window.std()
+                trigger[2] = True
+            threshold = self.threshold()
+            stop = min(sample + self.maxdelay_samps, end)
+            if threshold is not None and stop > sample + searched:
+                offlevel, onlimit = threshold
+                window = np.abs(data[sample + searched - data_start:
+                                     stop - data_start])  # rectify!
+                crossed = np.flatnonzero(np.abs(window - offlevel) >=
+                                         np.abs(onlimit))
+                if len(crossed):
+                    new.append(self._record(sample, code,
+                                            searched + crossed[0]))
+                    continue
+                trigger[3] = stop - sample
+            if sample + self.maxdelay_samps <= end:
+                new.append(self._record(sample, code, None))
+                continue
+            still_pending.append(trigger)
+        self._pending = still_pending
+        return new
+
+    def _record(self, sample, code, delay_samps):
+        if delay_samps is None:
+            delay = np.nan
+            self.n_missed += 1
+        else:
+            delay = delay_samps / self.sfreq * 1e3
+            self.n_found += 1  # Welford's running mean and variance
+            diff = delay - self._mean
+            self._mean += diff / self.n_found
+            self._m2 += diff * (delay - self._mean)
+            self._min = min(self._min, delay)
+            self._max = max(self._max, delay)
+        self.results.append((sample, code, delay))
+        return sample, code, delay
+
+    def recent(self):
+        """Array of the last `history` (sample, code, delay in ms) rows."""
+        return self.results.read()
+
+    def stats(self):
+        """Running delay statistics (ms).
+
+        n, missed, mean, std, min and max cover the whole session; the
+        recent_* values cover the last `history` triggers, and drift is
+        their mean minus the session mean.
+        """
+        stats = dict(n=self.n_found, missed=self.n_missed)
+        threshold = self.threshold()
+        if threshold is not None:
+            stats['offlevel'], stats['onlimit'] = threshold
+        if self.n_found == 0:
+            return stats
+        stats.update(mean=self._mean,
+                     std=np.sqrt(self._m2 / self.n_found),
+                     min=self._min, max=self._max)
+        recent = self.recent()[:, 2]
+        recent = recent[~np.isnan(recent)]
+        if len(recent):
+            stats.update(recent_n=len(recent), recent_mean=np.mean(recent),
+                         recent_std=np.std(recent),
+                         recent_p50=np.percentile(recent, 50.),
+                         recent_p90=np.percentile(recent, 90.),
+                         drift=np.mean(recent) - self._mean)
+        return stats
+
+
+def format_stats(stats, t_sec=None):
+    """One-line summary of `DelayMonitor.stats`."""
+    line = '' if t_sec is None else '[{:8.1f} s] '.format(t_sec)
+    line += 'n={:<6d} missed={:<4d}'.format(stats['n'], stats['missed'])
+    if stats['n']:
+        line += (' mean={:7.2f} std={:6.2f} ms'
+                 .format(stats['mean'], stats['std']))
+    if 'recent_mean' in stats:
+        line += (' | recent mean={:7.2f} p90={:7.2f} drift={:+6.2f} ms'
+                 .format(stats['recent_mean'], stats['recent_p90'],
+                         stats['drift']))
+    return line
+
+
+def run_monitor(source, monitor=None, report_sec=5., report=print,
+                **kwargs):
+    """Feed all blocks of `source` to a monitor, reporting periodically.
+
+    Parameters
+    ----------
+    source : SampleSource
+        Where the samples come from.
+    monitor : DelayMonitor | None
+        If None, one is made for the source's sampling rate (and
+        `min_duration`, if it has one) with `kwargs`.
+    report_sec : float
+        Interval of the reports, in seconds of data.
+    report : callable
+        Called with each `format_stats` line (default: print).
+
+    Returns the monitor.
+    """
+    if monitor is None:
+        if source.min_duration is not None:
+            kwargs.setdefault('min_duration', source.min_duration)
+        monitor = DelayMonitor(source.sfreq, **kwargs)
+    report_samps = max(int(report_sec * source.sfreq), 1)
+    next_report = report_samps
+    try:
+        for stim, misc in source:
+            monitor.feed(stim, misc)
+            if monitor.n_samples >= next_report:
+                report(format_stats(monitor.stats(),
+                                    monitor.n_samples / source.sfreq))
+                next_report += report_samps
+    finally:
+        source.close()
+    report(format_stats(monitor.stats(), monitor.n_samples / source.sfreq))
+    return monitor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Monitor trigger-to-analogue delays online.')
+    parser.add_argument('fname', nargs='?', default=None,
+                        help='recording to replay (else: read the socket)')
+    parser.add_argument('--stim-chan', default='STI101')
+    parser.add_argument('--misc-chan', default='MISC001')
+    parser.add_argument('--trig-codes', type=int, nargs='+', default=None)
+    parser.add_argument('--realtime', action='store_true',
+                        help='replay the recording at its sampling rate')
+    parser.add_argument('--serve', action='store_true',
+                        help='send the recording to the socket instead')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--sfreq', type=float, default=1000.,
+                        help='sampling rate of the socket stream')
+    parser.add_argument('--report-sec', type=float, default=5.)
+    parser.add_argument('--min-duration', type=float, default=None,
+                        help='merge stim steps closer than this, in seconds '
+                             '(default: 0.002 for FIF and the socket, 0 for '
+                             'BrainVision)')
+    args = parser.parse_args(argv)
+
+    if args.fname is None:
+        source = SocketSource(args.sfreq, port=args.port)
+    else:
+        source = FileSource(args.fname, stim_chan=args.stim_chan,
+                            misc_chan=args.misc_chan,
+                            realtime=args.realtime or args.serve)
+    if args.serve:
+        serve_source(source, port=args.port)
+        return
+    kwargs = dict() if args.min_duration is None else dict(
+        min_duration=args.min_duration)
+    run_monitor(source, report_sec=args.report_sec,
+                trig_codes=args.trig_codes, **kwargs)
+
+
+if __name__ == '__main__':
+    main()
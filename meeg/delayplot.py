@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""QC figures and reports of delay extraction.
+
+`plot_delays` draws the analogue windows around the triggers as an image,
+their average below it and a histogram of the delays, from arrays that
+`meeg.delays.extract_delays` has already extracted. With ``show=False`` the
+figure is made without pyplot, so no display is needed; `save_report`
+writes it to PNG, or to a self-contained HTML page with the delay stats.
+"""
+import base64
+import io
+import numpy as np
+
+
+def plot_delays(windows, times, delays, title=None, show=True):
+    """Image, average and delay histogram of misc-channel windows.
+
+    Parameters
+    ----------
+    windows : ndarray, shape (n_events, n_times)
+        Baseline-corrected misc data around each trigger.
+    times : ndarray, shape (n_times,)
+        Time of each window sample relative to the trigger, in seconds.
+    delays : ndarray
+        Delay values in ms.
+    title : str | None
+        Title above the image.
+    show : bool
+        Make the figure with pyplot and show it (default: True). If False,
+        the figure is not attached to any GUI backend.
+
+    Returns
+    -------
+    fig : instance of matplotlib.figure.Figure
+    """
+    from matplotlib.gridspec import GridSpec
+    if show:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+    else:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    grid = GridSpec(3, 14, figure=fig)
+    ax_image = fig.add_subplot(grid[:2, :10])
+    ax_evoked = fig.add_subplot(grid[2, :10], sharex=ax_image)
+    ax_colorbar = fig.add_subplot(grid[2, 10])
+    ax_hist = fig.add_subplot(grid[:2, 10:])
+
+    times_ms = np.asarray(times) * 1e3
+    vmax = np.max(np.abs(windows)) if windows.size else 1.
+    image = ax_image.imshow(windows, aspect='auto', origin='lower',
+                            interpolation='nearest', cmap='RdBu_r',
+                            vmin=-vmax, vmax=vmax,
+                            extent=(times_ms[0], times_ms[-1],
+                                    0, len(windows)))
+    ax_image.set_ylabel('Epochs')
+    if title is not None:
+        ax_image.set_title(title)
+    fig.colorbar(image, cax=ax_colorbar)
+    if len(windows):
+        ax_evoked.plot(times_ms, windows.mean(axis=0))
+    ax_evoked.axvline(0., color='k', linewidth=0.5)
+    ax_evoked.set_xlabel('Time (ms)')
+
+    ax_hist.hist(delays, orientation=u'horizontal')
+    ax_hist.set_title('Delay values (ms)')
+    ax_hist.yaxis.tick_right()
+    if show:
+        plt.show()
+    return fig
+
+
+def save_report(fig, fname, stats=None, title=None):
+    """Save a figure of `plot_delays` as PNG, or as HTML with `stats`.
+
+    The format follows the extension of `fname` (.html or .htm for HTML,
+    anything else is passed on to `savefig`). The HTML page embeds the
+    image, so it can be copied around on its own.
+    """
+    if not fname.endswith(('.html', '.htm')):
+        fig.savefig(fname)
+        return
+    png = io.BytesIO()
+    fig.savefig(png, format='png')
+    rows = ''.join('<tr><th>{}</th><td>{:.3f}</td></tr>'.format(key, value)
+                   for key, value in sorted((stats or dict()).items()))
+    with open(fname, 'w') as fp:
+        fp.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                 '<title>{title}</title></head><body>\n<h1>{title}</h1>\n'
+                 '<img src="data:image/png;base64,{png}">\n'
+                 '<table>{rows}</table>\n</body></html>\n'.format(
+                     title=title or 'Delays',
+                     png=base64.b64encode(png.getvalue()).decode('ascii'),
+                     rows=rows))
@@ -1,7 +1,10 @@
-from mne import find_events, pick_channels, pick_types, pick_events, Epochs
+from mne import find_events, pick_channels, pick_types, pick_events
 from mne.io import Raw, BaseRaw, read_raw_fif, read_raw_brainvision
 from six import string_types
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .stimsteps import merge_samples, merge_steps
 
 
 def _next_crossing(a, offlevel, onlimit):
@@ -21,19 +24,266 @@ def _find_next_analogue_trigger(ana_data, ind, offlevel, onlimit,
                           offlevel, onlimit)
 
 
+def _find_analogue_triggers(ana_data, inds, offlevel, onlimit,
+                            maxdelay_samps=100, chunk_events=1000):
+    """Vectorized `_find_next_analogue_trigger` for many event indices.
+
+    Looks at a strided (events x maxdelay_samps) view of `ana_data`, in
+    chunks of `chunk_events` events to bound memory, and finds the first
+    threshold crossing after every index at once.
+
+    Returns
+    -------
+    delay_samps : ndarray of int
+        Samples from each index to its first crossing (0 if none).
+    found : ndarray of bool
+        Whether a crossing was found within the window.
+    """
+    inds = np.asarray(inds, dtype=np.int64)
+    # pad so windows of events near the end of the data stay in bounds;
+    # NaN never crosses the threshold
+    padded = np.concatenate((np.asarray(ana_data, dtype=float),
+                             np.full(maxdelay_samps, np.nan)))
+    windows = as_strided(padded, shape=(len(ana_data), maxdelay_samps),
+                         strides=(padded.strides[0], padded.strides[0]),
+                         writeable=False)
+    delay_samps = np.zeros(len(inds), dtype=np.int64)
+    found = np.zeros(len(inds), dtype=bool)
+    for start in range(0, len(inds), chunk_events):
+        chunk = slice(start, start + chunk_events)
+        with np.errstate(invalid='ignore'):
+            crossed = (np.abs(windows[inds[chunk]] - offlevel) >=
+                       np.abs(onlimit))
+        delay_samps[chunk] = np.argmax(crossed, axis=1)
+        found[chunk] = crossed[np.arange(len(crossed)),
+                               delay_samps[chunk]]
+    return delay_samps, found
+
+
+def _stim_steps_chunked(raw, stim_pick, chunk_samps):
+    """Steps (sample, before, after) of a stim channel, read chunk by chunk.
+
+    Only the steps are kept, so memory does not grow with recording length.
+    """
+    steps = []
+    prev = None
+    for start in range(0, raw.n_times, chunk_samps):
+        stop = min(start + chunk_samps, raw.n_times)
+        data = raw.get_data(picks=stim_pick, start=start, stop=stop)[0]
+        data = np.abs(data).astype(np.int64)
+        if prev is not None:  # step across the chunk boundary
+            data = np.r_[prev, data]
+            offset = start - 1
+        else:
+            offset = start
+        idx = np.flatnonzero(np.diff(data))
+        steps.append(np.c_[idx + 1 + offset + raw.first_samp, data[idx],
+                           data[idx + 1]])
+        prev = data[-1]
+    return (np.concatenate(steps).astype(np.int64), prev,
+            raw.n_times + raw.first_samp)
+
+
+def _find_events_chunked(raw, stim_chan, min_duration=0, shortest_event=2,
+                         chunk_duration=60.):
+    """Onset events of a stim channel without loading the recording.
+
+    Mirrors ``mne.find_events(raw, stim_channel, min_duration=...,
+    shortest_event=...)`` (consecutive='increasing', output='onset') on
+    data read in chunks of `chunk_duration` seconds.
+    """
+    stim_pick = pick_channels(raw.info['ch_names'], include=[stim_chan])
+    chunk_samps = max(int(chunk_duration * raw.info['sfreq']), 1)
+    steps, last_value, end_samp = _stim_steps_chunked(raw, stim_pick,
+                                                      chunk_samps)
+    if len(steps) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+    if last_value != 0:  # pad_stop=0
+        steps = np.r_[steps, [[end_samp, last_value, 0]]]
+    steps = merge_steps(steps, merge_samples(min_duration, raw.info['sfreq']))
+
+    onsets = steps[:, 2] > steps[:, 1]
+    offsets = (onsets | (steps[:, 2] == 0)) & (steps[:, 1] > 0)
+    onset_idx = np.flatnonzero(onsets)
+    offset_idx = np.flatnonzero(offsets)
+    if len(onset_idx) == 0 or len(offset_idx) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+    if onset_idx[-1] > offset_idx[-1]:  # orphaned onset at the end
+        onset_idx = onset_idx[:-1]
+    events = steps[onset_idx]
+
+    # the same safety check for spurious (e.g. Neuromag) events as mne
+    n_short_events = np.sum(np.diff(events[:, 0]) < shortest_event)
+    if n_short_events > 0:
+        raise ValueError("You have %i events shorter than the "
+                         "shortest_event. These are very unusual and you "
+                         "may want to set min_duration to a larger value "
+                         "e.g. x / raw.info['sfreq']. Where x = 1 sample "
+                         "shorter than the shortest event length."
+                         % n_short_events)
+    return events
+
+
+def _stream_analogue_triggers(raw, pick, inds, offlevel, onlimit,
+                              maxdelay_samps=100, chunk_duration=60.):
+    """`_find_analogue_triggers` on misc data read chunk by chunk.
+
+    Each chunk is read with `maxdelay_samps` extra samples, so events near
+    its end see their full window.
+    """
+    inds = np.asarray(inds, dtype=np.int64)
+    chunk_samps = max(int(chunk_duration * raw.info['sfreq']), 1)
+    delay_samps = np.zeros(len(inds), dtype=np.int64)
+    found = np.zeros(len(inds), dtype=bool)
+    for start in range(0, raw.n_times, chunk_samps):
+        sel = np.flatnonzero((inds >= start) & (inds < start + chunk_samps))
+        if len(sel) == 0:
+            continue
+        stop = min(start + chunk_samps + maxdelay_samps, raw.n_times)
+        ana_data = np.sqrt(raw.get_data(picks=pick, start=start,
+                                        stop=stop)[0]**2)  # rectify!
+        delay_samps[sel], found[sel] = \
+            _find_analogue_triggers(ana_data, inds[sel] - start, offlevel,
+                                    onlimit, maxdelay_samps=maxdelay_samps)
+    return delay_samps, found
+
+
+# display samples per window in QC figures
+_PLOT_MAX_SAMPS = 500
+
+
 def _find_analogue_trigger_limit(ana_data):
     return 2.5*ana_data.mean()
 
 
-def _find_analogue_trigger_limit_sd(raw, events, anapick, tmin=-0.2, tmax=0.0,
-                                    sd_limit=5.):
-    epochs = Epochs(raw, events, tmin=tmin, tmax=tmax, picks=anapick,
-                    baseline=(None, 0), preload=True)
-    epochs._data = np.sqrt(epochs._data**2)  # RECTIFY!
-    # ave = epochs.average(picks=[0])
-    ave = np.mean(np.mean(epochs.get_data(), axis=2))
-    std = np.mean(np.std(epochs.get_data(), axis=2))
-    return(ave, sd_limit * std)
+def _baseline_window(sfreq, tmin, tmax):
+    """First sample offset and length of the (tmin, tmax) window."""
+    start = int(round(tmin * sfreq))
+    return start, int(round(tmax * sfreq)) - start + 1
+
+
+def _baseline_stats(misc_data, inds, start, n_samps, chunk_events=1000):
+    """Mean and SD of the rectified, baseline-corrected window per event.
+
+    Windows of `n_samps` samples start `start` samples from each index;
+    those not entirely inside `misc_data` are left out (as `mne.Epochs`
+    drops them). Each window is corrected by its mean up to time 0, like
+    ``mne.Epochs(..., baseline=(None, 0))``.
+    """
+    n_baseline = min(1 - start, n_samps)  # samples up to time 0
+    if n_baseline <= 0:
+        raise ValueError('The baseline window must start at or before the '
+                         'trigger')
+    misc_data = np.asarray(misc_data, dtype=float)
+    first = np.asarray(inds, dtype=np.int64) + start
+    first = first[(first >= 0) & (first + n_samps <= len(misc_data))]
+    n_windows = max(len(misc_data) - n_samps + 1, 0)
+    windows = as_strided(misc_data, shape=(n_windows, n_samps),
+                         strides=(misc_data.strides[0],
+                                  misc_data.strides[0]),
+                         writeable=False)
+    means = np.empty(len(first))
+    stds = np.empty(len(first))
+    for chunk_start in range(0, len(first), chunk_events):
+        chunk = slice(chunk_start, chunk_start + chunk_events)
+        data = windows[first[chunk]]
+        base = data[:, :n_baseline].mean(axis=1, keepdims=True)
+        data = np.abs(data - base)  # RECTIFY!
+        means[chunk] = data.mean(axis=1)
+        stds[chunk] = data.std(axis=1)
+    return means, stds
+
+
+def _stream_windows(raw, pick, inds, start, n_samps, chunk_duration=60.):
+    """Misc data chunks holding full event windows, read one by one.
+
+    Yields the data of each chunk (with the window margins) and the
+    indices of the events in it, relative to the chunk data. Windows cut
+    off by the recording are still cut off, so they are dropped as usual.
+    """
+    inds = np.asarray(inds, dtype=np.int64)
+    chunk_samps = max(int(chunk_duration * raw.info['sfreq']), 1)
+    for chunk_start in range(0, raw.n_times, chunk_samps):
+        sel = inds[(inds >= chunk_start) &
+                   (inds < chunk_start + chunk_samps)]
+        if len(sel) == 0:
+            continue
+        first = max(chunk_start + min(start, 0), 0)
+        stop = min(chunk_start + chunk_samps + max(start + n_samps, 0),
+                   raw.n_times)
+        yield raw.get_data(picks=pick, start=first, stop=stop)[0], sel - first
+
+
+def _stream_baseline_stats(raw, pick, inds, start, n_samps,
+                           chunk_duration=60.):
+    """`_baseline_stats` on misc data read chunk by chunk."""
+    means, stds = [np.empty(0)], [np.empty(0)]
+    for misc_data, chunk_inds in _stream_windows(raw, pick, inds, start,
+                                                 n_samps, chunk_duration):
+        chunk_means, chunk_stds = _baseline_stats(misc_data, chunk_inds,
+                                                  start, n_samps)
+        means.append(chunk_means)
+        stds.append(chunk_stds)
+    return np.concatenate(means), np.concatenate(stds)
+
+
+def _plot_windows(misc_data, inds, start, n_samps, decim=1,
+                  chunk_events=1000):
+    """Baseline-corrected misc windows around events, for display.
+
+    The mean up to time 0 is subtracted from each window (the default
+    baseline of `mne.Epochs`); incomplete windows are left out.
+
+    Returns
+    -------
+    windows : ndarray, shape (n_events, n_times)
+        Every `decim`-th sample of each window.
+    max_amp, min_amp : float
+        Extremes over all windows, at full resolution (NaN if none).
+    """
+    misc_data = np.asarray(misc_data, dtype=float)
+    first = np.asarray(inds, dtype=np.int64) + start
+    first = first[(first >= 0) & (first + n_samps <= len(misc_data))]
+    n_windows = max(len(misc_data) - n_samps + 1, 0)
+    strided = as_strided(misc_data, shape=(n_windows, n_samps),
+                         strides=(misc_data.strides[0],
+                                  misc_data.strides[0]),
+                         writeable=False)
+    n_baseline = min(1 - start, n_samps)  # samples up to time 0
+    windows = np.empty((len(first), len(range(0, n_samps, decim))))
+    max_amp, min_amp = np.nan, np.nan
+    for chunk_start in range(0, len(first), chunk_events):
+        chunk = slice(chunk_start, chunk_start + chunk_events)
+        data = strided[first[chunk]]
+        if n_baseline > 0:
+            data = data - data[:, :n_baseline].mean(axis=1, keepdims=True)
+        max_amp = np.fmax(max_amp, data.max())
+        min_amp = np.fmin(min_amp, data.min())
+        windows[chunk] = data[:, ::decim]
+    return windows, max_amp, min_amp
+
+
+def _stream_plot_windows(raw, pick, inds, start, n_samps, decim=1,
+                         chunk_duration=60.):
+    """`_plot_windows` on misc data read chunk by chunk."""
+    windows = [np.empty((0, len(range(0, n_samps, decim))))]
+    max_amp, min_amp = np.nan, np.nan
+    for misc_data, chunk_inds in _stream_windows(raw, pick, inds, start,
+                                                 n_samps, chunk_duration):
+        chunk_windows, chunk_max, chunk_min = \
+            _plot_windows(misc_data, chunk_inds, start, n_samps, decim=decim)
+        windows.append(chunk_windows)
+        max_amp = np.fmax(max_amp, chunk_max)
+        min_amp = np.fmin(min_amp, chunk_min)
+    return np.concatenate(windows), max_amp, min_amp
+
+
+def _find_analogue_trigger_limit_sd(means, stds, sd_limit=5.):
+    """Off level and trigger limit from per-event baseline statistics."""
+    if len(means) == 0:
+        raise RuntimeError('ERROR: No complete baseline window found for '
+                           'any event')
+    return(np.mean(means), sd_limit * np.mean(stds))
 
 
 def _filter_events_too_close(events, min_samps):
@@ -58,7 +308,8 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
                    h_freq=None, plot_figures=True, crop_plot_time=None,
                    time_shift=None, min_separation=None,
                    return_values='delays', trig_limit_sd=5.,
-                   plot_title_str=None):
+                   plot_title_str=None, streaming=False,
+                   chunk_duration=60., report_fname=None):
     """Estimate onset delay of analogue (misc) input relative to trigger
 
     Parameters
@@ -84,6 +335,10 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
         High cut-off frequency in Hz. Uses mne.io.Raw.filter.
     plot_figures : bool
         Plot histogram and "ERP image" of delays (default: True)
+    report_fname : str | None
+        Write the figure to this PNG file, or to an HTML page with the
+        delay statistics if it ends in .html, instead of showing it. Needs
+        no display, e.g. for batch runs.
     plot_title_str : str | None
         If None (default), the name of the channel is plotted above the
         epochs-image. Alternatively, enter a string.
@@ -103,6 +358,14 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
         Defaults to 'delays'.
     trig_limit_sd : float
         For debugging only.
+    streaming : bool
+        If True, the recording is not loaded into memory: only `stim_chan`
+        and `misc_chan` are read, in chunks of `chunk_duration` seconds, so
+        memory use does not grow with recording length or channel count.
+        Events and delays are identical to the default mode. Filtering (`l_freq`,
+        `h_freq`) needs the data in memory and is not available.
+    chunk_duration : float
+        Chunk length in seconds for `streaming` (default: 60).
 
     Returns (see `return_values`-parameter)
     -------
@@ -117,13 +380,17 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
     if return_values not in ['events', 'delays', 'stats']:
         raise ValueError('Invalid return_value: {}'.format(return_values))
 
+    if streaming and (l_freq is not None or h_freq is not None):
+        raise ValueError('Filtering is not possible in streaming mode.')
+
     if isinstance(raw, string_types):
         if raw.endswith('fif'):
-            raw = read_raw_fif(raw, preload=True)
+            raw = read_raw_fif(raw, preload=not streaming)
         elif raw.endswith('vhdr'):
             raw = read_raw_brainvision(raw, misc=[misc_chan])
     elif isinstance(raw, BaseRaw):
-        raw.load_data()  # does nothing if data already (pre)loaded
+        if not streaming:
+            raw.load_data()  # does nothing if data already (pre)loaded
     else:
         raise ValueError('First argument should either be a Raw object, '
                          'or a string containing the path to a file.')
@@ -136,9 +403,14 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
 
     # for MEG, use 2 ms, for EEG it's shorter!
     min_duration = 0.002 if isinstance(raw, Raw) else 0
-    events = pick_events(find_events(raw, stim_channel=stim_chan,
-                                     min_duration=min_duration),
-                         include=include_trigs)
+    if streaming:
+        events = _find_events_chunked(raw, stim_chan,
+                                      min_duration=min_duration,
+                                      chunk_duration=chunk_duration)
+    else:
+        events = find_events(raw, stim_channel=stim_chan,
+                             min_duration=min_duration)
+    events = pick_events(events, include=include_trigs)
     if min_separation is not None:
         events = _filter_events_too_close(
             events, int(min_separation * raw.info['sfreq']))
@@ -148,64 +420,53 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
     delay_samps = np.zeros(events.shape[0], dtype=events.dtype)
     pick = pick_channels(raw.info['ch_names'], include=[misc_chan])
 
-    ana_data = np.sqrt(raw._data[pick, :].squeeze()**2)  # rectify!
-
-    # don't use all events for trigger level determination (memory-heavy)
-    decim_eve = 1
-    if len(events) > 300:
-        decim_eve = int(len(events) / 300.)
-        print('Warning: Using only every {}th event for trigger limit '
-              'calculations'.format(decim_eve))
-    # from IPython.core.debugger import set_trace; set_trace()
-    tmin, tmax = baseline
-    offlevel, onlimit = \
-        _find_analogue_trigger_limit_sd(raw, events[::decim_eve], pick,
-                                        tmin=tmin, tmax=tmax,
-                                        sd_limit=trig_limit_sd)
-
-    for row, unpack_me in enumerate(events):
-        ind, _, after = unpack_me
-        raw_ind = ind - raw.first_samp  # really indices into raw!
-        try:
-            anatrig_ind = _find_next_analogue_trigger(ana_data, raw_ind,
-                                                      offlevel, onlimit,
-                                                      maxdelay_samps=1000)
-        except RuntimeError as e:
-            # assume data collection ended after event, but before response
-            # continue silently
-            if row == (len(events) - 1):
-                continue
-            extra_info = ('Event #{:d} of category {:d}, at {:d} samples into '
-                          'the file'.format(row, after, raw_ind))
-            raise RuntimeError('{}\n{}'.format(e, extra_info))
-        delay_samps[row] = anatrig_ind
-
-        delays = delay_samps / raw.info['sfreq'] * 1.e3
-
-    if plot_figures:
-        import matplotlib.pyplot as plt
-        plt.figure()
-        evoked = True
-        hist = True
-        axes_list = []
-
-        # image
-        axes_list.append(plt.subplot2grid(
-            (3, 14), (0, 0), colspan=10 if hist else 14,
-            rowspan=2 if evoked else 3))
-        # evoked
-        axes_list.append(plt.subplot2grid(
-            (3, 14), (2, 0), colspan=10 if hist else 14, rowspan=1))
-        # colorbar
-        axes_list.append(plt.subplot2grid((3, 14), (2, 10),
-                                          colspan=1, rowspan=1))
-        # histogram
-        axes_list.append(plt.subplot2grid(
-            (3, 14), (0, 10), colspan=4, rowspan=2))
-
-        axes_list[-1].hist(delays, orientation=u'horizontal')
-        axes_list[-1].set_title('Delay values (ms)')
-        axes_list[-1].yaxis.tick_right()
+    # trigger limits from the baseline windows of all events
+    raw_inds = events[:, 0] - raw.first_samp  # really indices into raw!
+    win_start, win_samps = _baseline_window(raw.info['sfreq'], *baseline)
+    if streaming:
+        means, stds = _stream_baseline_stats(raw, pick, raw_inds, win_start,
+                                             win_samps,
+                                             chunk_duration=chunk_duration)
+    else:
+        misc_data = raw._data[pick[0]]
+        means, stds = _baseline_stats(misc_data, raw_inds, win_start,
+                                      win_samps)
+    offlevel, onlimit = _find_analogue_trigger_limit_sd(
+        means, stds, sd_limit=trig_limit_sd)
+
+    maxdelay_samps = 1000
+    if streaming:
+        found_samps, found = \
+            _stream_analogue_triggers(raw, pick, raw_inds, offlevel, onlimit,
+                                      maxdelay_samps=maxdelay_samps,
+                                      chunk_duration=chunk_duration)
+    else:
+        ana_data = np.sqrt(misc_data**2)  # rectify!
+        found_samps, found = \
+            _find_analogue_triggers(ana_data, raw_inds, offlevel, onlimit,
+                                    maxdelay_samps=maxdelay_samps)
+    # assume data collection ended after the last event, but before
+    # response: continue silently
+    missing = np.flatnonzero(~found[:-1])
+    if len(missing) > 0:
+        row = missing[0]
+        extra_info = ('Event #{:d} of category {:d}, at {:d} samples into '
+                      'the file'.format(row, events[row, 2], raw_inds[row]))
+        raise RuntimeError('ERROR: No analogue trigger found within %d '
+                           'samples of the digital trigger\n%s' %
+                           (maxdelay_samps, extra_info))
+    delay_samps[found] = found_samps[found]
+
+    delays = delay_samps / raw.info['sfreq'] * 1.e3
+
+    stats = None
+    if return_values == 'stats' or plot_figures or report_fname is not None:
+        stats = dict()
+        stats['mean'] = np.mean(delays)
+        stats['std'] = np.std(delays)
+        stats['median'] = np.median(delays)
+        stats['q10'] = np.percentile(delays, 10.)
+        stats['q90'] = np.percentile(delays, 90.)
 
         if crop_plot_time is not None:
             if not (isinstance(crop_plot_time, (list, tuple)) and
@@ -213,12 +474,32 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
                 raise RuntimeError('crop_plot_time must be length-2 tuple')
             epo_t_min, epo_t_max = crop_plot_time
         else:
-            epo_t_min, epo_t_max = -0.2, 0.5
-        epochs = Epochs(raw, events, tmax=epo_t_max, preload=True)
-        epochs.crop(epo_t_min, epo_t_max)
-        # This calls plt.show, which in inline-plotting settings causes the
-        # figure to be burnt in. All axes mods have to happen prior to it.
-        epochs.plot_image(pick, axes=axes_list[:3], title=plot_title_str)
+            epo_t_min, epo_t_max = -0.2, epoch_t_max
+        win_start, win_samps = _baseline_window(raw.info['sfreq'],
+                                                epo_t_min, epo_t_max)
+        # windows are only kept decimated, for display
+        decim = max(win_samps // _PLOT_MAX_SAMPS, 1)
+        if streaming:
+            windows, max_amp, min_amp = \
+                _stream_plot_windows(raw, pick, raw_inds, win_start,
+                                     win_samps, decim=decim,
+                                     chunk_duration=chunk_duration)
+        else:
+            windows, max_amp, min_amp = \
+                _plot_windows(misc_data, raw_inds, win_start, win_samps,
+                              decim=decim)
+        stats['max_amp'] = max_amp  # over epochs & times
+        stats['min_amp'] = min_amp
+
+    if plot_figures or report_fname is not None:
+        from .delayplot import plot_delays, save_report
+        times = (win_start + np.arange(0, win_samps, decim)) / \
+            raw.info['sfreq']
+        title = misc_chan if plot_title_str is None else plot_title_str
+        fig = plot_delays(windows, times, delays, title=title,
+                          show=report_fname is None)
+        if report_fname is not None:
+            save_report(fig, report_fname, stats=stats, title=title)
 
     if return_values == 'events':
         events[:, 0] += delay_samps  # these are of same dtype
@@ -227,14 +508,6 @@ def extract_delays(raw, stim_chan='STI101', misc_chan='MISC001',
     elif return_values == 'delays':
         return(delays)
     elif return_values == 'stats':
-        stats = dict()
-        stats['mean'] = np.mean(delays)
-        stats['std'] = np.std(delays)
-        stats['median'] = np.median(delays)
-        stats['q10'] = np.percentile(delays, 10.)
-        stats['q90'] = np.percentile(delays, 90.)
-        stats['max_amp'] = np.max(epochs._data[:, pick, :])  # ovr epochs&times
-        stats['min_amp'] = np.min(epochs._data[:, pick, :])  # ovr epochs&times
         return(stats)
 
 
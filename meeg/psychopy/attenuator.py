@@ -4,6 +4,10 @@ import time
 from psychopy import parallel  # this is OK, since part of psychopy
 
 class U3Port():
+    # a Feedback packet carries at most 57 bytes of IOTypes; a
+    # PortStateWrite takes 7 of them
+    maxWritesPerTransaction = 8
+
     def __init__(self):
         # Have to ensure u3 isn't imported unless the U3Port is explicitly needed
         from labjack import u3  # noqa
@@ -14,16 +18,37 @@ class U3Port():
     def setData(self, code=0):
         self.u3dev.getFeedback(self.PortStateWrite([0x00, code, 0x00]))  # noqa
 
+    def setDataSequence(self, codes):
+        # one USB round trip per packet of writes, instead of one per write
+        writes = [self.PortStateWrite([0x00, code, 0x00]) for code in codes]
+        for start in range(0, len(writes), self.maxWritesPerTransaction):
+            self.u3dev.getFeedback(
+                writes[start:start + self.maxWritesPerTransaction])
+
 
 class LPTPort():
-    def __init__(self, port_params=dict(address='0xDFF8')):
+    def __init__(self, port_params=dict(address='0xDFF8'), pulseWidth=1e-4):
 
         self.lpt_port = parallel
         self.lpt_port.setPortAddress(port_params['address'])
+        # each value of a sequence is held at least this long (s), so the
+        # attenuator sees every pulse and every return to zero
+        self.pulseWidth = pulseWidth
 
     def setData(self, code=0):
         self.lpt_port.setData(code)
 
+    def setDataSequence(self, codes):
+        # an LPT write takes about a microsecond, far too short a pulse;
+        # busy-wait rather than sleep, which can't wait that little
+        setData = self.lpt_port.setData
+        clock = time.perf_counter
+        for code in codes:
+            setData(code)
+            holdUntil = clock() + self.pulseWidth
+            while clock() < holdUntil:
+                pass
+
 
 class FakePort():
     def __init__(self):
@@ -33,6 +58,11 @@ class FakePort():
         if code > 0:
             self.fake_port(code, end=";")
 
+    def setDataSequence(self, codes):
+        pulses = [code for code in codes if code > 0]
+        if pulses:
+            self.fake_port(*pulses, sep=";", end=";")
+
 
 class AttenuatorController():
     def __init__(self, digital_port=FakePort(), startVal=[-20., -20.0]):
@@ -41,11 +71,14 @@ class AttenuatorController():
         self.volMax = 0.0
         self.volMin = -105.0
 
+        self._volumeLimitErrorMsg = \
+            "Trying to change volume beyond limits (-105 to 0 dB) " + \
+            "is not possible!"
+
         self._sendCode(4)  # reset to zero
         self.curVolLeft = 0.0
         self.curVolRight = 0.0
-        self.setVolume(startVal[0], 'left')
-        self.setVolume(startVal[1], 'right')
+        self.setVolume(startVal, 'both')
 
         self._relativeVolLeft = 0.
         self._relativeVolRight = 0.
@@ -54,25 +87,31 @@ class AttenuatorController():
         self._relativeVolMinLeft = 0.0
         self._relativeVolMinRight = 0.0
 
-        self._volumeLimitErrorMsg = \
-            "Trying to change volume beyond limits (-105 to 0 dB) " + \
-            "is not possible!"
-
     def _sendCode(self, code=4, duration=1e-6):
         self.port.setData(code)  # Set to code, 4 resets to zero
         time.sleep(duration)
         self.port.setData(0)  # Set to zero
         time.sleep(duration)
 
+    def _sendPulseTrain(self, codes, duration=1e-6):
+        # each code is followed by a return to zero, as in _sendCode
+        sequence = [value for code in codes for value in (code, 0)]
+        if hasattr(self.port, 'setDataSequence'):
+            # the port packs the whole train into as few transactions as it can
+            self.port.setDataSequence(sequence)
+        else:
+            for value in sequence:
+                self.port.setData(value)
+                time.sleep(duration)
+
     def _changeVolume(self, code, iters):
         # here the code already includes the information on iteration direction
-        for ii in range(np.abs(iters)):
-            self._sendCode(code)
+        self._sendPulseTrain([code] * int(np.abs(iters)))
 
     def applyZeroLevel(self):
         self._sendCode(4)
-        self.relativeVolLeft = 0.0
-        self.relativeVolRight = 0.0
+        self._relativeVolLeft = 0.0
+        self._relativeVolRight = 0.0
         self._relativeVolMaxLeft = self.volMax - self.getCurVolume(side='left')
         self._relativeVolMaxRight = \
             self.volMax - self.getCurVolume(side='right')
@@ -116,72 +155,106 @@ class AttenuatorController():
 
         return changeCode, nIters
 
-    def setVolume(self, newVol, side='left'):
-        if side == 'both':
-            print("Setting both volumes at same time not supported yet...")
+    def planVolumeChange(self, volDiffLeft, volDiffRight):
+        """Shortest pulse plan changing left and right volume by (dB).
+
+        Steps common to both channels use the 'both' codes (3 and 7) and
+        come first, followed by the remaining single-side steps.
+
+        Returns
+        -------
+        plan : list of (changeCode, nIters)
+            nIters is signed, as returned by getChangeInfo.
+        """
+        itersLeft = int(volDiffLeft / 0.5)
+        itersRight = int(volDiffRight / 0.5)
+        plan = []
+        if itersLeft * itersRight > 0:  # same direction
+            shared = int(np.sign(itersLeft)) * min(abs(itersLeft),
+                                                   abs(itersRight))
+            plan.append(self.getChangeInfo(shared * 0.5, 'both'))
+            itersLeft -= shared
+            itersRight -= shared
+        for side, iters in (('left', itersLeft), ('right', itersRight)):
+            if iters != 0:
+                plan.append(self.getChangeInfo(iters * 0.5, side))
+        return plan
+
+    def _applyPlan(self, plan):
+        # the whole plan goes out as a single pulse train
+        codes = []
+        for changeCode, nIters in plan:
+            codes += [changeCode] * abs(nIters)
+        self._sendPulseTrain(codes)
+
+        stepsLeft = stepsRight = 0
+        for changeCode, nIters in plan:
+            if changeCode in (1, 3, 5, 7):
+                stepsLeft += nIters
+            if changeCode in (2, 3, 6, 7):
+                stepsRight += nIters
+        self.curVolLeft += stepsLeft * 0.5
+        self.curVolRight += stepsRight * 0.5
+        return stepsLeft * 0.5, stepsRight * 0.5
+
+    def _checkLimits(self, newVol, volMin, volMax):
+        if (newVol > volMax) or (newVol < volMin):
+            print(self._volumeLimitErrorMsg)
             raise ValueError
 
-        curVol = self.getCurVolume(side=side)
-        volDiff = newVol - curVol
-        changeCode, nIters = self.getChangeInfo(volDiff, side=side)
-        if changeCode is not None:
-            if (curVol + volDiff > self.volMax) or \
-               (curVol + volDiff < self.volMin):
-                print(self._volumeLimitErrorMsg)
-                raise ValueError
-
-            self._changeVolume(changeCode, nIters)
-            if side == 'left' or side == 'both':
-                self.curVolLeft += nIters*0.5
-            if side == 'right' or side == 'both':
-                self.curVolRight += nIters*0.5
+    def _sideDiffs(self, volDiff, side):
+        # (left, right) change for a side; 'both' takes a pair or a scalar
+        if side == 'left':
+            return volDiff, 0.
+        elif side == 'right':
+            return 0., volDiff
+        elif side == 'both':
+            if np.ndim(volDiff) == 0:
+                return volDiff, volDiff
+            return volDiff[0], volDiff[1]
+        raise ValueError("side should be 'left', 'right' or 'both', "
+                         "not {}".format(side))
 
-    def increaseVolume(self, increment, side='left'):
+    def setVolume(self, newVol, side='left'):
+        """Set the volume of one side, or of both (newVol scalar or pair)."""
         if side == 'both':
-            print("Setting both volumes at same time not support yet...")
-            raise ValueError
-
-        curVol = self.getCurVolume(side=side)
-        volDiff = increment
-        changeCode, nIters = self.getChangeInfo(volDiff, side=side)
-
-        if changeCode is not None:
-            if (curVol + volDiff > self.volMax) or \
-               (curVol + volDiff < self.volMin):
-                print(self._volumeLimitErrorMsg)
-                raise ValueError
+            newVolLeft, newVolRight = self._sideDiffs(newVol, side)
+            self.increaseVolume((newVolLeft - self.curVolLeft,
+                                 newVolRight - self.curVolRight), side)
+        else:
+            self.increaseVolume(newVol - self.getCurVolume(side=side), side)
 
-            self._changeVolume(changeCode, nIters)
-            if side == 'left' or side == 'both':
-                self.curVolLeft += nIters*0.5
-            if side == 'right' or side == 'both':
-                self.curVolRight += nIters*0.5
+    def increaseVolume(self, increment, side='left'):
+        """Change the volume of one side, or of both (scalar or pair)."""
+        volDiffLeft, volDiffRight = self._sideDiffs(increment, side)
+        plan = self.planVolumeChange(volDiffLeft, volDiffRight)
+        if not plan:
+            return
+        for curVol, volDiff in ((self.curVolLeft, volDiffLeft),
+                                (self.curVolRight, volDiffRight)):
+            self._checkLimits(curVol + volDiff, self.volMin, self.volMax)
+        self._applyPlan(plan)
 
     def setVolumeRelative(self, newVol, side='both'):
-        curVol = self.getCurVolumeRelative(side=side)
-        volDiff = newVol - curVol
-
-        changeCode, nIters = self.getChangeInfo(volDiff, side=side)
-
-        if changeCode is not None:
-            if side == 'left' or side == 'both':
-                if (curVol + volDiff > self._relativeVolMaxLeft) or \
-                   (curVol + volDiff < self._relativeVolMinLeft):
-                    print(self._volumeLimitErrorMsg)
-                    raise ValueError
-            if side == 'right' or side == 'both':
-                if (curVol + volDiff > self._relativeVolMaxRight) or \
-                   (curVol + volDiff < self._relativeVolMinRight):
-                    print(self._volumeLimitErrorMsg)
-                    raise ValueError
-
-            self._changeVolume(changeCode, nIters)
-            if side == 'left' or side == 'both':
-                self.curVolLeft += np.sign(nIters)*nIters*0.5
-                self.relativeVolLeft += np.sign(nIters)*nIters*0.5
-            if side == 'right' or side == 'both':
-                self.curVolRight += np.sign(nIters)*nIters*0.5
-                self.relativeVolRight += np.sign(nIters)*nIters*0.5
+        """Set volume relative to the zero level (see applyZeroLevel)."""
+        curVolLeft, curVolRight = self.getCurVolumeRelative(side='both')
+        if side == 'both':
+            newVolLeft, newVolRight = self._sideDiffs(newVol, side)
+            volDiffs = (newVolLeft - curVolLeft, newVolRight - curVolRight)
+        else:
+            volDiffs = self._sideDiffs(
+                newVol - self.getCurVolumeRelative(side=side), side)
+        plan = self.planVolumeChange(*volDiffs)
+        if not plan:
+            return
+        self._checkLimits(curVolLeft + volDiffs[0],
+                          self._relativeVolMinLeft, self._relativeVolMaxLeft)
+        self._checkLimits(curVolRight + volDiffs[1],
+                          self._relativeVolMinRight,
+                          self._relativeVolMaxRight)
+        changeLeft, changeRight = self._applyPlan(plan)
+        self._relativeVolLeft += changeLeft
+        self._relativeVolRight += changeRight
 
 
 class FakeAttenuatorController(AttenuatorController):
@@ -193,7 +266,12 @@ class FakeAttenuatorController(AttenuatorController):
         AttenuatorController.__init__(self, attenuatorPort)
 
     def setVolume(self, newVol, side='left'):
-        if side == 'left':
+        if side == 'both':
+            newVolLeft, newVolRight = self._sideDiffs(newVol, side)
+            self.setVolume(newVolLeft, 'left')
+            self.setVolume(newVolRight, 'right')
+            return
+        elif side == 'left':
             curSound = self.soundLeft
         elif side == 'right':
             curSound = self.soundRight
@@ -0,0 +1,144 @@
+from __future__ import print_function
+import time
+import numpy as np
+
+from .attenuator import AttenuatorController
+
+# modelled cost of talking to the attenuator through each transport:
+# seconds per transaction, seconds per write within it, writes per
+# transaction (see U3Port.maxWritesPerTransaction); an LPT write is held
+# for the default LPTPort.pulseWidth
+TRANSPORTS = dict(lpt=dict(transaction=1e-4, write=0., max_writes=1),
+                  u3=dict(transaction=1e-3, write=4e-6, max_writes=8))
+
+# attenuator pulse codes: (left step, right step) in 0.5 dB units
+_CODE_STEPS = {1: (-1, 0), 2: (0, -1), 3: (-1, -1),
+               5: (1, 0), 6: (0, 1), 7: (1, 1)}
+_RESET_CODE = 4
+
+
+class SimulatedAttenuatorPort():
+    """Port that behaves like the attenuator behind LPT or U3 hardware.
+
+    Codes are decoded as the device does, acting on each change from 0 to
+    a code: 1-3 step left/right/both down by 0.5 dB, 5-7 step them up, and
+    4 resets both channels to 0 dB. Gains are clipped to -105..0 dB.
+    Transport time is modelled (see `TRANSPORTS`) rather than slept, unless
+    `realtime` is True.
+    """
+    def __init__(self, transport='lpt', realtime=False):
+        if transport not in TRANSPORTS:
+            raise ValueError('Unknown transport: {}'.format(transport))
+        self.transport = transport
+        self.realtime = realtime
+        self.gain = np.zeros(2)  # dB, left and right
+        self.resetCounters()
+        self._lastCode = 0
+
+    def resetCounters(self):
+        self.pulses = 0
+        self.writes = 0
+        self.transactions = 0
+        self.transportTime = 0.
+
+    def setData(self, code=0):
+        self._transaction([code])
+
+    def setDataSequence(self, codes):
+        maxWrites = TRANSPORTS[self.transport]['max_writes']
+        for start in range(0, len(codes), maxWrites):
+            self._transaction(codes[start:start + maxWrites])
+
+    def _transaction(self, codes):
+        model = TRANSPORTS[self.transport]
+        duration = model['transaction'] + model['write'] * len(codes)
+        self.transactions += 1
+        self.writes += len(codes)
+        self.transportTime += duration
+        if self.realtime:
+            time.sleep(duration)
+        for code in codes:
+            self._decode(code)
+
+    def _decode(self, code):
+        if code != 0 and self._lastCode == 0:
+            self.pulses += 1
+            if code == _RESET_CODE:
+                self.gain[:] = 0.
+            elif code in _CODE_STEPS:
+                self.gain += 0.5 * np.array(_CODE_STEPS[code])
+                np.clip(self.gain, -105., 0., out=self.gain)
+        self._lastCode = code
+
+
+def _calibration_sweep(controller):
+    # both ears down to -80 dB in 5 dB steps, then back up
+    for level in list(range(-25, -85, -5)) + list(range(-75, -15, 5)):
+        controller.setVolume((float(level), float(level)), 'both')
+
+
+def _staircase(controller, nTrials=100, seed=0):
+    # 1-up-2-down staircase in 2 dB steps, one per ear, interleaved
+    rng = np.random.RandomState(seed)
+    nCorrect = dict(left=0, right=0)
+    for trial in range(nTrials):
+        side = 'left' if trial % 2 == 0 else 'right'
+        if rng.rand() < 0.7:
+            nCorrect[side] += 1
+            if nCorrect[side] == 2:
+                controller.increaseVolume(-2., side)
+                nCorrect[side] = 0
+        else:
+            controller.increaseVolume(2., side)
+            nCorrect[side] = 0
+
+
+# 'startup' times the controller's own reset and start levels
+PROCEDURES = dict(startup=None, calibration_sweep=_calibration_sweep,
+                  staircase=_staircase)
+
+
+def benchmark_calibration(transports=('lpt', 'u3'), procedures=None):
+    """Run typical volume procedures against the simulated attenuator.
+
+    Returns
+    -------
+    results : list of dict
+        One row per (transport, procedure): pulses, writes, transactions,
+        modelled transport time and Python wall time (ms), and the final
+        device gains next to the controller's bookkeeping.
+    """
+    if procedures is None:
+        procedures = sorted(PROCEDURES)
+    results = []
+    for transport in transports:
+        for name in procedures:
+            port = SimulatedAttenuatorPort(transport)
+            if PROCEDURES[name] is None:
+                wallStart = time.perf_counter()
+                controller = AttenuatorController(port,
+                                                  startVal=[-20., -20.])
+            else:
+                controller = AttenuatorController(port,
+                                                  startVal=[-20., -20.])
+                port.resetCounters()
+                wallStart = time.perf_counter()
+                PROCEDURES[name](controller)
+            wall = time.perf_counter() - wallStart
+            results.append(dict(
+                transport=transport, procedure=name, pulses=port.pulses,
+                writes=port.writes, transactions=port.transactions,
+                transport_ms=port.transportTime * 1e3, wall_ms=wall * 1e3,
+                device_gain=tuple(float(gain) for gain in port.gain),
+                controller_gain=controller.getCurVolume(side='both')))
+    return results
+
+
+if __name__ == '__main__':
+    print('{:<4s} {:<18s} {:>7s} {:>7s} {:>7s} {:>12s} {:>9s}  {}'.format(
+        'port', 'procedure', 'pulses', 'writes', 'trans.', 'transport ms',
+        'wall ms', 'final gain (device / controller)'))
+    for row in benchmark_calibration():
+        print('{transport:<4s} {procedure:<18s} {pulses:>7d} {writes:>7d} '
+              '{transactions:>7d} {transport_ms:>12.2f} {wall_ms:>9.2f}  '
+              '{device_gain} / {controller_gain}'.format(**row))
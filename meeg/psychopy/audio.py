@@ -0,0 +1,47 @@
+from __future__ import print_function
+import time
+import numpy as np
+from psychopy import core, sound  # this is OK, since part of psychopy
+
+from ..audio import AudioBackend
+
+
+class PsychopyBackend(AudioBackend):
+    """Playback through psychopy.sound (whichever audio library it uses).
+
+    One psychopy Sound is built per preloaded buffer. psychopy doesn't tell
+    when the first sample is output, so the measured latency only covers
+    waiting for `when` and the `play` call itself.
+    """
+    name = 'psychopy'
+
+    def __init__(self, audioSamplingRate=44100., channels=2):
+        AudioBackend.__init__(self, audioSamplingRate, channels)
+        self._sounds = []
+        self._playing = None
+
+    def preload(self, buffer):
+        handle = AudioBackend.preload(self, buffer)
+        buffer = self._buffers[handle]
+        self._sounds.append(
+            sound.Sound(value=np.multiply(buffer, 1. / 32768.,
+                                          dtype=np.float32),
+                        sampleRate=self.audioSamplingRate,
+                        stereo=buffer.shape[1] > 1, hamming=False))
+        return handle
+
+    def play(self, handle, when=None):
+        requested = time.perf_counter()
+        if when is not None:
+            core.wait(max(when - requested, 0.))
+        self.stop()
+        self._playing = self._sounds[handle]
+        self._playing.play()
+        self._log_onset(handle, requested,
+                        requested if when is None else when,
+                        time.perf_counter())
+
+    def stop(self):
+        if self._playing is not None:
+            self._playing.stop()
+            self._playing = None
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Fixed-size, preallocated ring buffer for logging from timing-critical code.
+"""
+import numpy as np
+
+
+class RingBuffer(object):
+    """Keep the last `capacity` items of a stream in a preallocated array.
+
+    Appending never allocates, so it is safe to call from audio callbacks and
+    trigger threads. There should be a single writer; `read` returns a copy
+    and may be torn if called while the writer is active.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of items kept.
+    shape : tuple
+        Shape of each item (default: scalar items).
+    dtype : numpy dtype
+        Data type of the items.
+    """
+    def __init__(self, capacity, shape=(), dtype=float):
+        self.capacity = int(capacity)
+        self._data = np.zeros((self.capacity,) + tuple(shape), dtype=dtype)
+        self.count = 0  # total number of items ever appended
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, item):
+        """Add a single item, overwriting the oldest one when full."""
+        self._data[self.count % self.capacity] = item
+        self.count += 1
+
+    def extend(self, items):
+        """Add a block of items (first axis), in order."""
+        n = len(items)
+        skip = max(0, n - self.capacity)  # only the newest items fit
+        items = items[skip:]
+        start = (self.count + skip) % self.capacity
+        first = min(len(items), self.capacity - start)
+        self._data[start:start + first] = items[:first]
+        self._data[:len(items) - first] = items[first:]
+        self.count += n
+
+    def read(self):
+        """Copy of the stored items, oldest first."""
+        if self.count <= self.capacity:
+            return self._data[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate((self._data[start:], self._data[:start]))
+
+    def clear(self):
+        self.count = 0
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Pack tone/silence trials into a fixed time budget.
+
+A schedule is made of sets: one trial of every stimulus, all with the same
+tone duration and each followed by its own silence. The first set uses a
+required tone duration; the others draw theirs at random. `pack_schedule`
+draws candidate sets in bulk, keeps as many as fit (or one more, if that is
+closer to the budget) and then lengthens (or shortens) silences and, if
+needed, tone durations within their limits, so the budget is used up to
+the rounding grid. All arithmetic is done in integer grid units, so
+the result is exact and reproducible for a given seed.
+"""
+import numpy as np
+
+
+def _check_random_state(seed):
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def _distribute(amount, headroom):
+    """Integer amounts adding up to `amount`, proportional to `headroom`
+    and at most `headroom` each (largest remainder rounding).
+    """
+    total = headroom.sum()
+    if amount <= 0 or total == 0:
+        return np.zeros_like(headroom)
+    if amount >= total:
+        return headroom.copy()
+    share = headroom * (amount / float(total))
+    added = np.floor(share).astype(headroom.dtype)
+    rest = int(amount - added.sum())
+    added[np.argsort(added - share, kind='mergesort')[:rest]] += 1
+    return added
+
+
+def pack_schedule(n_stims, budget_sec, required_dur_sec, dur_min_sec,
+                  dur_max_sec, silence_min_sec, silence_max_sec, seed=None,
+                  decimals=2):
+    """Draw a schedule of trial sets filling `budget_sec` as fully as possible.
+
+    Parameters
+    ----------
+    n_stims : int
+        Number of stimuli, i.e. trials per set.
+    budget_sec : float
+        Total time available for tones and silences.
+    required_dur_sec : float
+        Tone duration of the first set (always included).
+    dur_min_sec, dur_max_sec : float
+        Limits of the tone duration of the other sets.
+    silence_min_sec, silence_max_sec : float
+        Limits of the silence after each tone.
+    seed : int | None | instance of np.random.RandomState
+        Random state; the same seed gives the same schedule.
+    decimals : int
+        Durations are multiples of ``10**-decimals`` seconds (default: 2).
+
+    Returns
+    -------
+    schedule : dict of ndarray
+        One entry per trial, in set order: 'set' (set number), 'stim'
+        (stimulus index, 0 to n_stims - 1), 'duration' and
+        'silence_duration' (seconds). The unused time is ``budget_sec``
+        minus the sum of durations and silences; it is below one grid unit
+        unless the limits do not allow filling the budget.
+
+    Notes
+    -----
+    Silences and tone durations are drawn uniformly within their limits,
+    then each is moved by the same fraction of its distance to the limit
+    it is moved towards, so the budget is met exactly. As the last set is
+    dropped or kept depending on which leaves less to move, the values are
+    lengthened about as often as shortened: their mean stays that of the
+    uniform draw, but values close to either limit are somewhat less
+    frequent than drawn.
+    """
+    rng = _check_random_state(seed)
+    unit = 10. ** -decimals
+
+    def to_units(sec):
+        return int(round(sec / unit))
+
+    dur_lo, dur_hi = to_units(dur_min_sec), to_units(dur_max_sec)
+    sil_lo, sil_hi = to_units(silence_min_sec), to_units(silence_max_sec)
+    if dur_lo > dur_hi or sil_lo > sil_hi:
+        raise ValueError('Minimum durations must not exceed the maxima')
+
+    first_sil = rng.randint(sil_lo, sil_hi + 1, n_stims)
+    remaining = (to_units(budget_sec) -
+                 n_stims * to_units(required_dur_sec) - first_sil.sum())
+
+    # more candidate sets than can possibly fit
+    min_set = n_stims * (dur_lo + sil_lo)
+    n_cand = int(max(remaining, 0) // max(min_set, 1)) + 1
+    tone = rng.randint(dur_lo, dur_hi + 1, n_cand)
+    sil = rng.randint(sil_lo, sil_hi + 1, (n_cand, n_stims))
+    set_total = n_stims * tone + sil.sum(axis=1)
+    n_sets = int(np.searchsorted(np.cumsum(set_total), remaining,
+                                 side='right'))
+    slack = remaining - set_total[:n_sets].sum()
+    if n_sets < n_cand:
+        # or take one more set and shorten everything to make room for it:
+        # whichever fills the budget better, or else is closer to it, so
+        # durations are moved up about as often as down (see Notes)
+        over = set_total[n_sets] - slack
+        room_up = ((sil_hi - first_sil).sum() +
+                   (sil_hi - sil[:n_sets]).sum() +
+                   n_stims * (dur_hi - tone[:n_sets]).sum())
+        room_down = ((first_sil - sil_lo).sum() +
+                     (sil[:n_sets + 1] - sil_lo).sum() +
+                     n_stims * (tone[:n_sets + 1] - dur_lo).sum())
+        if ((max(over - room_down, 0), over) <
+                (max(slack - room_up, 0), slack)):
+            slack = -over
+            n_sets += 1
+    tone, sil = tone[:n_sets], sil[:n_sets]
+    silences = np.concatenate((first_sil[np.newaxis], sil)).ravel()
+
+    if slack < 0:
+        # take the excess from the silences, then from the drawn tone
+        # durations (whole grid units per set, the rest is given back below)
+        removed = _distribute(-slack, silences - sil_lo)
+        silences -= removed
+        slack += removed.sum()
+        removed = _distribute(-(slack // n_stims), tone - dur_lo)
+        tone -= removed
+        slack += n_stims * removed.sum()
+    # spend what is left on the silences, then on the drawn tone durations
+    added = _distribute(slack, sil_hi - silences)
+    silences += added
+    slack -= added.sum()
+    added = _distribute(slack // n_stims, dur_hi - tone)
+    tone += added
+
+    durations = np.concatenate((np.full(n_stims, to_units(required_dur_sec)),
+                                np.repeat(tone, n_stims)))
+    return dict(set=np.repeat(np.arange(n_sets + 1), n_stims),
+                stim=np.tile(np.arange(n_stims), n_sets + 1),
+                duration=np.round(durations * unit, decimals),
+                silence_duration=np.round(silences * unit, decimals))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Deadline-driven scheduling of trial events.
+
+Every event is given an absolute deadline relative to the start of the
+block, computed up front on a monotonic high-resolution clock. Waiting
+sleeps in short slices (polling for abort requests in between) and spins
+for the last couple of milliseconds, so a late event never delays the ones
+after it: timing errors stay bounded instead of accumulating.
+"""
+import time
+import numpy as np
+
+
+class BlockAborted(Exception):
+    """Raised by `DeadlineScheduler` when its abort check returns True."""
+
+
+class DeadlineScheduler(object):
+    """Run actions at absolute deadlines with a hybrid sleep-then-spin wait.
+
+    Parameters
+    ----------
+    abort_check : callable | None
+        Called without arguments while sleeping (never while spinning);
+        returning True raises `BlockAborted`. Must not block, e.g.
+        ``lambda: bool(event.getKeys(keyList=['escape']))``.
+    spin_sec : float
+        Busy-wait for this long before each deadline, to avoid the wake-up
+        jitter of `time.sleep`. Should exceed the OS sleep granularity.
+    poll_sec : float
+        Longest single sleep, i.e. the abort polling interval.
+    clock : callable
+        Monotonic clock returning seconds (default: `time.perf_counter`).
+    """
+    def __init__(self, abort_check=None, spin_sec=0.002, poll_sec=0.005,
+                 clock=time.perf_counter):
+        self.abort_check = abort_check
+        self.spin_sec = spin_sec
+        self.poll_sec = poll_sec
+        self.clock = clock
+
+    def wait_until(self, deadline):
+        """Return at `deadline` (on `clock`); returns the actual wake time."""
+        clock = self.clock
+        while True:
+            remaining = deadline - clock()
+            if remaining <= self.spin_sec:
+                break
+            if self.abort_check is not None and self.abort_check():
+                raise BlockAborted()
+            time.sleep(min(remaining - self.spin_sec, self.poll_sec))
+        now = clock()
+        while now < deadline:
+            now = clock()
+        return now
+
+    def run(self, schedule, start=None):
+        """Run a schedule of (offset_sec, action, args) entries.
+
+        Parameters
+        ----------
+        schedule : list of tuple
+            Offsets are seconds from `start` and must be sorted. Each action
+            is called as ``action(*args)`` once its deadline is reached;
+            action may be None for a pure wait (e.g. the end of a block).
+        start : float | None
+            Block start on `clock`; defaults to now.
+
+        Returns
+        -------
+        lateness : ndarray of float
+            Actual minus scheduled time of each event, in seconds.
+        """
+        if start is None:
+            start = self.clock()
+        lateness = np.empty(len(schedule))
+        for ii, (offset, action, args) in enumerate(schedule):
+            deadline = start + offset
+            now = self.wait_until(deadline)
+            if action is not None:
+                action(*args)
+            lateness[ii] = now - deadline
+        return lateness
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Crash-safe session logging from a background thread.
+
+Trial records are appended to a write-ahead log (one JSON object per line)
+by a writer thread. The trial loop only queues records; the thread writes
+and fsyncs them when asked to with `sync` (e.g. at a tone offset), so disk
+I/O never happens during a tone. If the session crashes, everything synced
+so far is in the log; `export` turns it into CSV and a columnar NPZ file.
+"""
+from collections import deque
+import csv
+import json
+import os
+import threading
+import numpy as np
+
+
+def read_wal(fname):
+    """Read the records of a write-ahead log, ignoring a torn last line."""
+    records = []
+    with open(fname, 'r') as fp:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # incomplete write at crash time
+    return records
+
+
+class SessionLogger(object):
+    """Background, batched, fsynced logger of trial records.
+
+    Parameters
+    ----------
+    fname_base : str
+        Path without extension; the log is written to ``fname_base.wal``,
+        and `export` writes ``fname_base.csv`` and ``fname_base.npz``.
+    fields : list of str
+        Record keys, in the column order used by `export`.
+    """
+    def __init__(self, fname_base, fields):
+        self.fname_base = fname_base
+        self.fields = list(fields)
+        self.wal_fname = fname_base + '.wal'
+        self._pending = deque()
+        self._sync = threading.Event()
+        self._closing = False
+        self._fp = open(self.wal_fname, 'a')
+        self._thread = threading.Thread(target=self._run,
+                                        name='SessionLogger')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, record):
+        """Queue a record (a dict); it is written at the next `sync`."""
+        self._pending.append(record)
+
+    def sync(self):
+        """Ask the writer thread to write and fsync all queued records."""
+        self._sync.set()
+
+    def close(self):
+        """Write the remaining records and stop the writer thread."""
+        if self._closing:
+            return
+        self._closing = True
+        self._sync.set()
+        self._thread.join()
+        self._fp.close()
+
+    def _run(self):
+        while True:
+            self._sync.wait()
+            self._sync.clear()
+            lines = []
+            while self._pending:
+                lines.append(json.dumps(self._pending.popleft()) + '\n')
+            if lines:
+                self._fp.write(''.join(lines))
+                self._fp.flush()
+                os.fsync(self._fp.fileno())
+            if self._closing and not self._pending:
+                break
+
+    def export(self):
+        """Write the logged records to CSV and NPZ (one array per field).
+
+        Returns the CSV and NPZ file names.
+        """
+        records = read_wal(self.wal_fname)
+        csv_fname = self.fname_base + '.csv'
+        npz_fname = self.fname_base + '.npz'
+        with open(csv_fname, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=self.fields,
+                                    extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+        np.savez(npz_fname, **{field: _column([record.get(field)
+                                               for record in records])
+                               for field in self.fields})
+        return csv_fname, npz_fname
+
+
+def _column(values):
+    """Array of a field's values; missing ones become NaN (or '')."""
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, (bool, int, float)) for value in present):
+        return np.array([np.nan if value is None else value
+                         for value in values])
+    return np.array(['' if value is None else str(value)
+                     for value in values])
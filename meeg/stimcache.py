@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""In-memory cache of ready-to-play stimulus buffers.
+
+Buffers are int16 arrays of shape (n_samples, 2), as produced by
+`meeg.wavhelpers.synthesize_tones`, keyed by everything that determines
+their content: (frequency, duration, taper, sampling rate, scaling).
+"""
+from collections import OrderedDict
+import numpy as np
+
+from .wavhelpers import synthesize_tones, MAX_VAL_16BITS
+
+
+class StimulusCache(object):
+    """Least-recently-used cache of stimulus buffers with a byte budget.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Total size of the cached buffers that may be kept in memory. When a
+        new buffer would exceed the budget, the least recently used buffers
+        are dropped first. Default: 512 MB.
+    audioSamplingRate : float
+        Default sampling rate for `get` and `prefetch`.
+    taperLenSec : float
+        Default fade in/out duration for `get` and `prefetch`.
+    scaling : int
+        Default int16 peak value for `get` and `prefetch`.
+    store : StimulusStore | None
+        Optional on-disk store (see `meeg.stimstore`). Misses are looked up
+        there before synthesizing, and newly synthesized buffers are added.
+    """
+    def __init__(self, max_bytes=512 * 2**20, audioSamplingRate=44100.,
+                 taperLenSec=0.010, scaling=MAX_VAL_16BITS, store=None):
+        self.max_bytes = int(max_bytes)
+        self.audioSamplingRate = audioSamplingRate
+        self.taperLenSec = taperLenSec
+        self.scaling = scaling
+        self.store = store
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._buffers = OrderedDict()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def __contains__(self, key):
+        return key in self._buffers
+
+    def key(self, stimHz, audStimDur_sec, taperLenSec=None,
+            audioSamplingRate=None, scaling=None, trigger_code=None,
+            trigger_channel=1):
+        """Cache key of a stimulus, filling in the cache defaults."""
+        key = (float(stimHz), float(audStimDur_sec),
+               float(self.taperLenSec if taperLenSec is None
+                     else taperLenSec),
+               float(self.audioSamplingRate if audioSamplingRate is None
+                     else audioSamplingRate),
+               int(self.scaling if scaling is None else scaling))
+        if trigger_code is not None:
+            key += (int(trigger_code), int(trigger_channel))
+        return key
+
+    def get(self, stimHz, audStimDur_sec, taperLenSec=None,
+            audioSamplingRate=None, scaling=None):
+        """Return the buffer of a single stimulus, synthesizing it if needed.
+        """
+        return self.prefetch([stimHz], [audStimDur_sec], taperLenSec,
+                             audioSamplingRate, scaling)[0]
+
+    def prefetch(self, stimHz, audStimDur_sec, taperLenSec=None,
+                 audioSamplingRate=None, scaling=None, trigger_codes=None,
+                 trigger_channel=1):
+        """Return one buffer per trial, synthesizing all misses in one batch.
+
+        Parameters
+        ----------
+        stimHz : array-like of float
+            Tone frequency of each trial.
+        audStimDur_sec : float | array-like of float
+            Tone duration of each trial (or one duration for all trials).
+        trigger_codes : array-like of int | None
+            Trigger code of each trial to embed as an audio pulse train (see
+            `meeg.wavhelpers.synthesize_tones`).
+        trigger_channel : int
+            Channel holding the pulse train.
+
+        Returns
+        -------
+        buffers : list of ndarray
+            One read-only int16 (n_samples, 2) array per trial.
+        """
+        durations = np.broadcast_to(np.asarray(audStimDur_sec, dtype=float),
+                                    np.shape(stimHz))
+        if trigger_codes is None:
+            codes = [None] * len(durations)
+        else:
+            codes = trigger_codes
+        keys = [self.key(hz, dur, taperLenSec, audioSamplingRate, scaling,
+                         code, trigger_channel)
+                for hz, dur, code in zip(stimHz, durations, codes)]
+
+        found = dict()
+        missing = []
+        for key in keys:
+            if key in found:
+                continue
+            buf = self._buffers.get(key)
+            if buf is not None:
+                self._buffers.move_to_end(key)
+                self.hits += 1
+            elif self.store is not None:
+                buf = self.store.get(key)
+                if buf is not None:
+                    buf.flags.writeable = False
+                    self._insert(key, buf)
+            if buf is None:
+                missing.append(key)
+                self.misses += 1
+            found[key] = buf
+
+        # missing keys share taper, rate, scaling and trigger channel, so one
+        # batch does it
+        if missing:
+            taper, rate, scale = missing[0][2:5]
+            missingCodes = None
+            if trigger_codes is not None:
+                missingCodes = [key[5] for key in missing]
+            buffers = synthesize_tones([key[0] for key in missing], rate,
+                                       [key[1] for key in missing], taper,
+                                       scale, missingCodes, trigger_channel)
+            for key, buf in zip(missing, buffers):
+                found[key] = buf
+                self._insert(key, buf)
+                if self.store is not None:
+                    self.store.put(key, buf)
+
+        return [found[key] for key in keys]
+
+    def clear(self):
+        """Drop all cached buffers."""
+        self._buffers.clear()
+        self.nbytes = 0
+
+    def _insert(self, key, buf):
+        if buf.nbytes > self.max_bytes:
+            return  # would evict everything else and still not fit
+        while self._buffers and self.nbytes + buf.nbytes > self.max_bytes:
+            _, evicted = self._buffers.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        self._buffers[key] = buf
+        self.nbytes += buf.nbytes
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Steps of a stim channel, merged the way ``mne.find_events`` does.
+
+A step is a (sample, value before, value after) row. Triggers that ramp
+up over a few samples (e.g. 0, 1, 3) give several close steps; with a
+`min_duration`, those are merged into a single step to the final value.
+Needs no mne, so the online monitor can use it too.
+"""
+import numpy as np
+
+
+def merge_samples(min_duration, sfreq):
+    """Steps at most this many samples apart are merged (as mne does)."""
+    min_samples = min_duration * sfreq
+    if min_samples <= 0:
+        return 0
+    merge = int(min_samples // 1)
+    if merge == min_samples:
+        merge -= 1
+    return merge
+
+
+def merge_steps(steps, merge):
+    """Merge (sample, before, after) steps at most `merge` samples apart.
+
+    As in ``mne.find_events``, the earlier step of a close pair is dropped
+    and the later one takes over its value before, so a ramp (e.g. 0, 1,
+    2) becomes a single step to its final value, at the last sample.
+    """
+    if merge == 0 or len(steps) < 2:
+        return steps
+    close = np.diff(steps[:, 0]) <= merge
+    if not np.any(close):
+        return steps
+    steps = steps.copy()
+    where = np.flatnonzero(close)
+    steps[where + 1, 1] = steps[where, 1]
+    keep = np.append(~close, True)
+    return steps[keep & (steps[:, 1] != steps[:, 2])]
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Persistent, content-addressed store of synthesized stimuli.
+
+Every buffer is saved as ``<sha1 of synthesis parameters>.npy`` in the store
+directory, and a single ``manifest.json`` records what is available, so that
+checking for a stimulus is a dictionary lookup rather than a file read.
+Files are evicted by total size and/or age of last use.
+"""
+import hashlib
+import json
+import os
+from os.path import join as opj
+import time
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+# bump when the synthesis changes, so old files are no longer matched
+STORE_VERSION = 1
+
+
+def params_hash(params):
+    """Hash of a tuple of synthesis parameters (e.g. a StimulusCache key)."""
+    blob = json.dumps([STORE_VERSION] + [repr(p) for p in params])
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+class StimulusStore(object):
+    """On-disk stimulus store with a JSON manifest index.
+
+    Parameters
+    ----------
+    root : str
+        Directory holding the stimulus files and the manifest.
+    max_bytes : int | None
+        Total size of stored files to keep when calling `evict`; least
+        recently used files go first. None (default) means no limit.
+    max_age_days : float | None
+        Files not used for this many days are removed by `evict`. None
+        (default) means no limit.
+    """
+    def __init__(self, root='./stims/', max_bytes=None, max_age_days=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.manifest_fname = opj(root, MANIFEST_NAME)
+        self._dirty = False
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        try:
+            with open(self.manifest_fname, 'r') as fp:
+                self._manifest = json.load(fp)
+        except (IOError, ValueError):
+            self._manifest = dict()
+
+    def __len__(self):
+        return len(self._manifest)
+
+    def __contains__(self, params):
+        return params_hash(params) in self._manifest
+
+    @property
+    def nbytes(self):
+        return sum(entry['nbytes'] for entry in self._manifest.values())
+
+    def get(self, params, mmap_mode=None):
+        """Load a stored buffer, or return None if it isn't in the store."""
+        digest = params_hash(params)
+        entry = self._manifest.get(digest)
+        if entry is None:
+            return None
+        try:
+            buf = np.load(opj(self.root, entry['file']), mmap_mode=mmap_mode)
+        except (IOError, ValueError):
+            # removed or damaged behind our back: forget about it
+            del self._manifest[digest]
+            self._dirty = True
+            return None
+        entry['last_used'] = time.time()
+        self._dirty = True
+        return buf
+
+    def put(self, params, buf):
+        """Save a buffer under the hash of its synthesis parameters."""
+        digest = params_hash(params)
+        fname = digest + '.npy'
+        np.save(opj(self.root, fname), buf)
+        now = time.time()
+        self._manifest[digest] = dict(file=fname, params=list(params),
+                                      nbytes=int(buf.nbytes), created=now,
+                                      last_used=now)
+        self._dirty = True
+
+    def evict(self, max_bytes=None, max_age_days=None):
+        """Remove files older than the age limit, then LRU down to max_bytes.
+
+        Returns the number of files removed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_age_days = (self.max_age_days if max_age_days is None
+                        else max_age_days)
+        by_age = sorted(self._manifest.items(),
+                        key=lambda item: item[1]['last_used'])
+        remove = []
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 86400.
+            remove = [digest for digest, entry in by_age
+                      if entry['last_used'] < cutoff]
+        if max_bytes is not None:
+            total = self.nbytes - sum(self._manifest[digest]['nbytes']
+                                      for digest in remove)
+            for digest, entry in by_age[len(remove):]:
+                if total <= max_bytes:
+                    break
+                remove.append(digest)
+                total -= entry['nbytes']
+
+        for digest in remove:
+            entry = self._manifest.pop(digest)
+            try:
+                os.remove(opj(self.root, entry['file']))
+            except OSError:
+                pass
+        if remove:
+            self._dirty = True
+        return len(remove)
+
+    def flush(self):
+        """Write the manifest (atomically) if anything has changed."""
+        if not self._dirty:
+            return
+        tmp_fname = self.manifest_fname + '.tmp'
+        with open(tmp_fname, 'w') as fp:
+            json.dump(self._manifest, fp, indent=1, sort_keys=True)
+        os.replace(tmp_fname, self.manifest_fname)
+        self._dirty = False
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+from meeg.delaymonitor import FileSource, run_monitor  # noqa: E402
+from meeg.delays import extract_delays  # noqa: E402
+from meeg.tests.test_delays import _ramped_raw  # noqa: E402
+
+
+@pytest.mark.parametrize('block_duration', [0.001, 0.05, 1.])
+def test_monitor_ramped_triggers(tmp_path, block_duration):
+    """Ramped triggers are reported once, with the offline code and delay.
+    """
+    fname = str(tmp_path / 'ramped_raw.fif')
+    _ramped_raw(max_ramp=1).save(fname, verbose=False)
+    kwargs = dict(stim_chan='STI101', misc_chan='MISC001',
+                  plot_figures=False)
+    events = extract_delays(fname, return_values='events', **kwargs)
+    delays = extract_delays(fname, **kwargs)
+    monitor = run_monitor(FileSource(fname, block_duration=block_duration),
+                          report=lambda line: None)
+    results = monitor.recent()
+    assert len(results) == len(events) == 40
+    np.testing.assert_array_equal(results[:, 1], events[:, 2])
+    np.testing.assert_array_equal(results[:, 2], delays)
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+from meeg.delays import _find_events_chunked, extract_delays  # noqa: E402
+
+SFREQ = 1000.
+
+
+def _ramped_raw(n_events=40, max_ramp=2, seed=0):
+    """Stim channel with triggers ramping up (e.g. 0, 1, 3) over up to
+    `max_ramp` samples, and a misc channel stepping up some ms after each.
+    """
+    rng = np.random.RandomState(seed)
+    n_times = 1000 * (n_events + 1)
+    stim = np.zeros(n_times)
+    misc = rng.randn(n_times) * 1e-3
+    onsets = 200 + 1000 * np.arange(n_events) + rng.randint(-10, 10,
+                                                            n_events)
+    onsets[3] = 1999  # ramp across a chunk boundary
+    for ii, onset in enumerate(onsets):
+        code = 3 + ii % 4
+        ramp = 1 + ii % max_ramp
+        stim[onset:onset + ramp] = 1  # transient value
+        stim[onset + ramp:onset + 100] = code
+        misc[onset + 20 + ii % 5:onset + 300] += 1.
+    info = mne.create_info(['STI101', 'MISC001'], SFREQ, ['stim', 'misc'])
+    return mne.io.RawArray(np.array([stim, misc]), info, verbose=False)
+
+
+@pytest.mark.parametrize('min_duration, shortest_event',
+                         [(0, 1), (0.002, 2), (0.003, 2)])
+@pytest.mark.parametrize('chunk_duration', [0.5, 1., 60.])
+def test_find_events_chunked(min_duration, shortest_event, chunk_duration):
+    """Chunked event detection matches mne.find_events on ramped steps."""
+    raw = _ramped_raw()
+    want = mne.find_events(raw, 'STI101', min_duration=min_duration,
+                           shortest_event=shortest_event, verbose=False)
+    got = _find_events_chunked(raw, 'STI101', min_duration=min_duration,
+                               shortest_event=shortest_event,
+                               chunk_duration=chunk_duration)
+    np.testing.assert_array_equal(got, want)
+
+
+def test_find_events_chunked_shortest_event():
+    """Events shorter than shortest_event raise, as in mne."""
+    raw = _ramped_raw()
+    with pytest.raises(ValueError, match='shortest_event'):
+        mne.find_events(raw, 'STI101', verbose=False)
+    with pytest.raises(ValueError, match='shortest_event'):
+        _find_events_chunked(raw, 'STI101')
+
+
+def test_extract_delays_streaming(tmp_path):
+    """Streaming delays equal in-memory ones on a FIF file."""
+    fname = str(tmp_path / 'ramped_raw.fif')
+    _ramped_raw(max_ramp=1).save(fname, verbose=False)
+    kwargs = dict(stim_chan='STI101', misc_chan='MISC001',
+                  plot_figures=False)
+    want = extract_delays(fname, **kwargs)
+    got = extract_delays(fname, streaming=True, chunk_duration=0.5,
+                         **kwargs)
+    np.testing.assert_array_equal(got, want)
+    assert len(want) == 40
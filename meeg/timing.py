@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Per-trial timing instrumentation for the trial loop.
+
+`TrialTimer` preallocates one row of timestamps per trial, so marking an
+event in the timed loop is a single clock read and array store. After the
+block, `summary` and `report` give latency and jitter statistics of the
+actual event times relative to the scheduled ones.
+"""
+import time
+import numpy as np
+
+# columns of TrialTimer.times
+SCHEDULED_ONSET = 0
+SCHEDULED_OFFSET = 1
+PLAY_RETURN = 2
+TRIGGER_ONSET = 3
+TRIGGER_OFFSET = 4
+# when play is meant to be called (tones are queued ahead of their onset)
+SCHEDULED_PLAY = 5
+COLUMNS = ('scheduled_onset', 'scheduled_offset', 'play_return',
+           'trigger_onset', 'trigger_offset', 'scheduled_play')
+
+# which scheduled time each measured event is compared to
+_REFERENCE = {PLAY_RETURN: SCHEDULED_PLAY,
+              TRIGGER_ONSET: SCHEDULED_ONSET,
+              TRIGGER_OFFSET: SCHEDULED_OFFSET}
+
+
+class TrialTimer(object):
+    """Timestamps of the scheduled and actual events of every trial.
+
+    Parameters
+    ----------
+    n_trials : int
+        Number of trials in the block.
+    clock : callable
+        Monotonic clock returning seconds; must be the clock the schedule
+        is defined on (default: `time.perf_counter`).
+    """
+    def __init__(self, n_trials, clock=time.perf_counter):
+        self.clock = clock
+        self.times = np.full((n_trials, len(COLUMNS)), np.nan)
+
+    def __len__(self):
+        return len(self.times)
+
+    def mark(self, trial, column):
+        """Store the current time for an event (one of the column ids)."""
+        self.times[trial, column] = self.clock()
+
+    def set(self, trial, column, value):
+        """Store a time taken elsewhere, e.g. by a trigger thread."""
+        self.times[trial, column] = value
+
+    def set_schedule(self, onsets, offsets, plays=None):
+        """Store scheduled onset, offset and play call times of all trials
+        at once; `plays` defaults to the onsets.
+        """
+        self.times[:, SCHEDULED_ONSET] = onsets
+        self.times[:, SCHEDULED_OFFSET] = offsets
+        self.times[:, SCHEDULED_PLAY] = onsets if plays is None else plays
+
+    def latencies(self, column):
+        """Actual minus scheduled time of an event for every trial, in ms."""
+        return (self.times[:, column] -
+                self.times[:, _REFERENCE[column]]) * 1e3
+
+    def summary(self):
+        """Latency and jitter statistics (ms) of each measured event.
+
+        Returns a dict mapping event names to dicts with n, mean, std
+        (jitter), p50, p99 and max_drift (largest absolute deviation from
+        schedule). Events never marked are left out.
+        """
+        summary = dict()
+        for column in (PLAY_RETURN, TRIGGER_ONSET, TRIGGER_OFFSET):
+            latency = self.latencies(column)
+            latency = latency[~np.isnan(latency)]
+            if len(latency) == 0:
+                continue
+            summary[COLUMNS[column]] = dict(
+                n=len(latency), mean=np.mean(latency), std=np.std(latency),
+                p50=np.percentile(latency, 50.),
+                p99=np.percentile(latency, 99.),
+                max_drift=np.max(np.abs(latency)))
+        return summary
+
+    def report(self, title='Timing'):
+        """Human-readable version of `summary`."""
+        lines = ['{} (ms, actual - scheduled):'.format(title)]
+        for name, stats in self.summary().items():
+            lines.append('  {:<14s} n={:<5d} mean={:8.3f} std={:7.3f} '
+                         'p50={:8.3f} p99={:8.3f} max_drift={:8.3f}'
+                         .format(name, stats['n'], stats['mean'],
+                                 stats['std'], stats['p50'], stats['p99'],
+                                 stats['max_drift']))
+        return '\n'.join(lines)
+
+    def save(self, fname):
+        """Save the raw timestamps (seconds) with their column names."""
+        np.savez(fname, times=self.times, columns=np.array(COLUMNS))
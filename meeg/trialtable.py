@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Array-backed table of trials.
+
+`TrialTable` keeps one row per trial in a NumPy structured array, so
+totals, selections, shuffling, trigger lookup and serialization are
+vectorized instead of loops over lists of dicts. Rows are records of the
+array: ``table['duration']`` is a column, ``table[3]['stim']`` a value and
+``table[table['condition'] == 'open']`` a new table.
+"""
+import csv
+import numpy as np
+
+# default columns; tables may add their own (see `TrialTable.empty`)
+TRIAL_DTYPE = [('condition', 'U16'), ('trial', np.int64), ('stim', np.int64),
+               ('duration', np.float64), ('silence_duration', np.float64),
+               ('eeg_tag', np.int64), ('onset_samp', np.int64),
+               ('offset_samp', np.int64)]
+
+
+class TrialTable(object):
+    """Trials as a structured array.
+
+    Parameters
+    ----------
+    data : ndarray
+        Structured array with one element per trial.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def empty(cls, n_trials, dtype=TRIAL_DTYPE):
+        """Table of `n_trials` zero-filled rows."""
+        return cls(np.zeros(n_trials, dtype=dtype))
+
+    @classmethod
+    def from_columns(cls, dtype=TRIAL_DTYPE, **columns):
+        """Table from equally long columns; missing ones are zero-filled.
+
+        Columns not in `dtype` are added with their own dtype.
+        """
+        dtype = list(dtype)
+        names = [name for name, _ in dtype]
+        columns = dict((name, np.asarray(values))
+                       for name, values in columns.items())
+        for name in sorted(set(columns) - set(names)):
+            dtype.append((name, columns[name].dtype))
+        lengths = set(len(values) for values in columns.values())
+        if len(lengths) > 1:
+            raise ValueError('Columns differ in length: {}'.format(
+                sorted(lengths)))
+        table = cls.empty(lengths.pop() if lengths else 0, dtype)
+        for name, values in columns.items():
+            table.data[name] = values
+        return table
+
+    @classmethod
+    def concatenate(cls, tables):
+        """One table with the rows of all `tables` (same columns), in order.
+        """
+        return cls(np.concatenate([table.data for table in tables]))
+
+    @classmethod
+    def load(cls, fname, dtype=TRIAL_DTYPE):
+        """Read a table saved with `save`."""
+        with np.load(fname) as data:
+            return cls.from_columns(dtype, **dict(
+                (name, data[name]) for name in data.files))
+
+    @property
+    def columns(self):
+        return self.data.dtype.names
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        if isinstance(key, (int, np.integer)):
+            return self.data[key]
+        return TrialTable(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def copy(self):
+        return TrialTable(self.data.copy())
+
+    def total_duration(self):
+        """Summed tone and silence durations, in seconds."""
+        return float(self.data['duration'].sum() +
+                     self.data['silence_duration'].sum())
+
+    def shuffled(self, rng=None):
+        """New table with the rows in random order.
+
+        `rng` is a np.random.RandomState or a seed.
+        """
+        if not isinstance(rng, np.random.RandomState):
+            rng = np.random.RandomState(rng)
+        return TrialTable(self.data[rng.permutation(len(self.data))])
+
+    def lookup_triggers(self, trigger_map, condition=None):
+        """Trigger code of every trial from a {stim: {condition: code}} map.
+
+        If `condition` is None, each row's own condition is used.
+        """
+        conditions = (np.unique(self.data['condition']) if condition is None
+                      else [condition])
+        codes = np.empty(len(self.data), dtype=np.int64)
+        keys = np.array(sorted(key for key in trigger_map
+                               if isinstance(trigger_map[key], dict)))
+        for cond in conditions:
+            rows = (slice(None) if condition is not None else
+                    self.data['condition'] == cond)
+            stims = self.data['stim'][rows]
+            pos = np.minimum(np.searchsorted(keys, stims), len(keys) - 1)
+            missing = keys[pos] != stims
+            if np.any(missing):
+                raise KeyError('No trigger for stimulus {}'.format(
+                    stims[missing][0]))
+            codes[rows] = np.array([trigger_map[key][cond]
+                                    for key in keys])[pos]
+        return codes
+
+    def save(self, fname):
+        """Save the columns to an NPZ file."""
+        np.savez(fname, **self.to_columns())
+
+    def to_columns(self):
+        """Dict of column arrays, e.g. to pass to np.savez."""
+        return dict((name, self.data[name]) for name in self.columns)
+
+    def to_csv(self, fname, columns=None, header=None, constants=None):
+        """Write the table as CSV.
+
+        Parameters
+        ----------
+        fname : str | file-like
+            Output file name, or an open text file.
+        columns : list of str | None
+            Columns to write, in order (default: all). Names in
+            `constants` are written as that value on every row.
+        header : list of str | None
+            Header line (default: the column names).
+        constants : dict | None
+            Values of extra columns that are the same for all trials.
+        """
+        columns = list(self.columns) if columns is None else columns
+        constants = constants or dict()
+        values = [[constants[name]] * len(self.data) if name in constants
+                  else self.data[name].tolist() for name in columns]
+        if hasattr(fname, 'write'):
+            self._write_csv(fname, columns, header, values)
+        else:
+            with open(fname, 'w', newline='') as fp:
+                self._write_csv(fp, columns, header, values)
+
+    @staticmethod
+    def _write_csv(fp, columns, header, values):
+        writer = csv.writer(fp, lineterminator='\n')
+        writer.writerow(columns if header is None else header)
+        writer.writerows(zip(*values))
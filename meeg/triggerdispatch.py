@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Send trigger codes from a dedicated thread, on deadlines.
+
+`TriggerDispatcher` takes (deadline, code) pairs from a priority queue and
+writes them to the port from its own (best-effort high-priority) thread,
+with the same sleep-then-spin wait as `meeg.scheduler`. Every write is
+timestamped, so dispatch lateness and port write latency can be measured.
+
+`RecordingPort` is a stand-in for a parallel port that records codes and
+timestamps in a ring buffer instead of printing them.
+"""
+import heapq
+import itertools
+import sys
+import threading
+import time
+import numpy as np
+
+from .ringbuffer import RingBuffer
+
+# rows of the dispatch log: code, deadline, write start, write end
+_DISPATCH_LOG_LEN = 65536
+
+
+class RecordingPort(object):
+    """Fake trigger port that records (time, code) of every write.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of writes kept in the ring buffer `log`.
+    clock : callable
+        Clock used for the timestamps (default: `time.perf_counter`).
+    """
+    def __init__(self, capacity=65536, clock=time.perf_counter):
+        self.clock = clock
+        self.log = RingBuffer(capacity, shape=(2,))
+
+    def setData(self, code=0):
+        self.log.append((self.clock(), code))
+
+    def read(self):
+        """Array of (time, code) rows, oldest first."""
+        return self.log.read()
+
+
+def _raise_thread_priority():
+    """Best effort: make the calling thread (near) real-time priority."""
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            THREAD_PRIORITY_TIME_CRITICAL = 15
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadPriority(kernel32.GetCurrentThread(),
+                                       THREAD_PRIORITY_TIME_CRITICAL)
+        else:
+            import os
+            # pid 0: the calling thread; needs CAP_SYS_NICE or an rtprio limit
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(
+                os.sched_get_priority_min(os.SCHED_FIFO)))
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+class TriggerDispatcher(object):
+    """Write trigger codes on deadlines from a dedicated thread.
+
+    Parameters
+    ----------
+    write : callable
+        Function writing a code to the port, e.g. ``port.setData`` or
+        ``triggers.setParallelData``.
+    spin_sec : float
+        Busy-wait for this long before each deadline.
+    clock : callable
+        Monotonic clock of the deadlines (default: `time.perf_counter`).
+    high_priority : bool
+        Try to raise the priority of the dispatch thread (default: True).
+    """
+    def __init__(self, write, spin_sec=0.002, clock=time.perf_counter,
+                 high_priority=True):
+        self.write = write
+        self.spin_sec = spin_sec
+        self.clock = clock
+        self.high_priority = high_priority
+        self.log = RingBuffer(_DISPATCH_LOG_LEN, shape=(4,))
+        self._queue = []
+        self._busy = False  # a code is being written
+        self._counter = itertools.count()  # keeps equal deadlines in order
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='TriggerDispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, code, deadline=None, callback=None):
+        """Queue a code for writing.
+
+        Parameters
+        ----------
+        code : int
+            Trigger value.
+        deadline : float | None
+            Time on `clock` to write it at; None means right away.
+        callback : callable | None
+            Called from the dispatch thread with the write time, e.g. to
+            store it in a `meeg.timing.TrialTimer`.
+        """
+        if deadline is None:
+            deadline = self.clock()
+        with self._cond:
+            heapq.heappush(self._queue, (deadline, next(self._counter), code,
+                                         callback))
+            self._cond.notify_all()
+
+    def cancel(self):
+        """Drop all codes not written yet."""
+        with self._cond:
+            del self._queue[:]
+            self._cond.notify_all()
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def flush(self, timeout=None):
+        """Wait until every queued code is written (codes not yet due are
+        written on their deadline). Returns False on timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._busy, timeout)
+
+    def close(self):
+        """Stop the thread (codes not yet due are dropped)."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        if self.high_priority:
+            _raise_thread_priority()
+        clock = self.clock
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                deadline = self._queue[0][0]
+                remaining = deadline - clock()
+                if remaining > self.spin_sec:
+                    # wakes early if an earlier code is queued
+                    self._cond.wait(remaining - self.spin_sec)
+                    continue
+                deadline, _, code, callback = heapq.heappop(self._queue)
+                self._busy = True
+            while clock() < deadline:
+                pass
+            start = clock()
+            self.write(code)
+            end = clock()
+            self.log.append((code, deadline, start, end))
+            if callback is not None:
+                callback(start)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def dispatch_log(self):
+        """Array of (code, deadline, write start, write end) rows."""
+        return self.log.read()
+
+    def latency_stats(self):
+        """Dispatch lateness and port write duration statistics, in ms."""
+        log = self.dispatch_log()
+        stats = dict(n=len(log))
+        if len(log) == 0:
+            return stats
+        for name, values in (('lateness', log[:, 2] - log[:, 1]),
+                             ('write', log[:, 3] - log[:, 2])):
+            values = values * 1e3
+            stats[name] = dict(mean=np.mean(values), std=np.std(values),
+                               p50=np.percentile(values, 50.),
+                               p99=np.percentile(values, 99.),
+                               max=np.max(values))
+        return stats
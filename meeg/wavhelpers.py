@@ -6,13 +6,30 @@ import glob
 from math import ceil, floor
 import traceback
 import numpy as np
-from scipy.io.wavfile import write as wavwrite
-from scipy.io.wavfile import read as wavread
 from os.path import join as opj
 from os.path import expanduser as ope
 
 DATA_DIR: str = './stims/'
 
+# Scaling: maxOutSoundcard: 5.53 Vpp, maxInAttenuator: 3.13 Vpp
+MAX_VAL_16BITS: int = int((2**15 - 1.) / (5.56 / 3.13))
+
+# Audio trigger pulse trains: a start pulse followed by one slot per bit
+TRIGGER_PULSE_SEC: float = 0.002
+TRIGGER_N_BITS: int = 8
+
+
+# scipy is only imported when wav files are actually read or written
+def wavread(fname):
+    from scipy.io.wavfile import read
+    return read(fname)
+
+
+def wavwrite(fname, rate, data):
+    from scipy.io.wavfile import write
+    write(fname, rate, data)
+
+
 def list_wavs_in_dir(dirname):
     return glob.glob(opj(ope(dirname), '*.wav'))
 
@@ -52,6 +69,181 @@ def wavlist_to_wavarr(wavlist):
     return np.array(wavlist)
 
 
+def _make_audio_mask(stimLenSamp, audioSamplingRate, taperLenSec):
+    """Unit-gain envelope with raised-sine fade in/out of ``taperLenSec``."""
+    audMask = np.ones(stimLenSamp)
+    taperLenSamp = floor(taperLenSec*audioSamplingRate)
+    if taperLenSamp > 0:
+        taperF = 1./(taperLenSec * 2.)
+        taper = (np.sin(2 * np.pi * taperF *
+                 np.linspace(-taperLenSec / 2., taperLenSec / 2.,
+                             taperLenSamp)) + 1) / 2.
+        audMask[0:taperLenSamp] *= taper
+        audMask[-taperLenSamp:] *= taper[::-1]
+    return audMask
+
+
+def mono_wav_name(stimHz, audStimDur_sec):
+    """File name used for a mono (both channels) stimulus."""
+    return DATA_DIR + 'mono-%.0fHz-%.2fs.wav' % (round(stimHz), audStimDur_sec)
+
+
+def encode_trigger_pulses(code, audioSamplingRate,
+                          pulseLenSec=TRIGGER_PULSE_SEC,
+                          scaling=MAX_VAL_16BITS):
+    """Pulse train that marks a stimulus onset and carries its trigger code.
+
+    The train starts with a pulse at its first sample (the onset marker),
+    followed by `TRIGGER_N_BITS` slots holding the code, least significant
+    bit first; a slot contains a pulse if its bit is set. Each pulse/slot is
+    `pulseLenSec` long.
+
+    Returns
+    -------
+    pulses : ndarray of int16, shape ((1 + TRIGGER_N_BITS) * slot_samples,)
+    """
+    if not 0 <= code < 2**TRIGGER_N_BITS:
+        raise ValueError('Trigger code {} does not fit in {:d} bits'
+                         .format(code, TRIGGER_N_BITS))
+    slotLenSamp = int(round(pulseLenSec*audioSamplingRate))
+    bits = np.r_[1, (int(code) >> np.arange(TRIGGER_N_BITS)) & 1]
+    return np.repeat(bits * scaling, slotLenSamp).astype(np.int16)
+
+
+def decode_trigger_pulses(signal, audioSamplingRate, threshold=None,
+                          pulseLenSec=TRIGGER_PULSE_SEC):
+    """Find the pulse trains written by `encode_trigger_pulses` in a signal.
+
+    Parameters
+    ----------
+    signal : array-like
+        Recorded trigger channel (any polarity; it is rectified).
+    audioSamplingRate : float
+        Sampling rate of `signal` in Hz.
+    threshold : float | None
+        Pulse detection level. Defaults to half the peak of the signal.
+
+    Returns
+    -------
+    onsets : ndarray of int
+        Sample index of each start pulse.
+    codes : ndarray of int
+        Decoded trigger code of each pulse train.
+    """
+    signal = np.abs(np.asarray(signal, dtype=float))
+    if threshold is None:
+        threshold = signal.max() / 2.
+    high = signal >= threshold
+    edges = np.flatnonzero(high[1:] & ~high[:-1]) + 1
+    if len(high) and high[0]:
+        edges = np.r_[0, edges]
+
+    slotLenSamp = int(round(pulseLenSec*audioSamplingRate))
+    frameLenSamp = (1 + TRIGGER_N_BITS) * slotLenSamp
+    # sample the middle of each bit slot
+    bitCentres = ((np.arange(1, TRIGGER_N_BITS + 1) + 0.5) *
+                  slotLenSamp).astype(int)
+    bitValues = 1 << np.arange(TRIGGER_N_BITS)
+    onsets, codes = [], []
+    nextFrame = 0
+    for edge in edges:
+        if edge < nextFrame:
+            continue  # a data bit of the current frame
+        if edge + frameLenSamp > len(signal):
+            break
+        onsets.append(edge)
+        codes.append(int(np.dot(high[edge + bitCentres], bitValues)))
+        nextFrame = edge + frameLenSamp
+    return (np.array(onsets, dtype=np.int64),
+            np.array(codes, dtype=np.int64))
+
+
+def synthesize_tones(stimHz, audioSamplingRate, audStimDur_sec,
+                     taperLenSec=0.010, scaling=MAX_VAL_16BITS,
+                     trigger_codes=None, trigger_channel=1):
+    """Synthesize the mono tones for a whole trial list in one pass.
+
+    Duplicate (Hz, duration) pairs are synthesized only once, and all unique
+    tones of the same duration are computed together as a single
+    (n_tones x n_samples) array.
+
+    Parameters
+    ----------
+    stimHz : array-like of float
+        Tone frequency of each trial.
+    audioSamplingRate : float
+        Sampling rate in Hz.
+    audStimDur_sec : float | array-like of float
+        Tone duration of each trial (or one duration for all trials).
+    taperLenSec : float
+        Length of the fade in/out at either end of the tone.
+    scaling : int
+        Peak value of the int16 output (default: `MAX_VAL_16BITS`).
+    trigger_codes : array-like of int | None
+        If given, the trigger code of each trial is written as a pulse train
+        (see `encode_trigger_pulses`) starting at the tone onset, so that it
+        can be recorded as an audio-locked marker.
+    trigger_channel : int
+        Channel holding the pulse train: 0 (left) or 1 (right, default)
+        replace the tone on that channel, 2 adds a dedicated third channel.
+
+    Returns
+    -------
+    buffers : list of ndarray
+        One C-contiguous int16 array of shape (n_samples, 2) per trial, scaled
+        exactly like the files written by `load_stimuli`; (n_samples, 3) if
+        `trigger_channel` is 2. Trials with the same (Hz, duration, code)
+        share the same (read-only) array.
+    """
+    stimHz = np.atleast_1d(np.asarray(stimHz, dtype=float))
+    durations = np.broadcast_to(np.asarray(audStimDur_sec, dtype=float),
+                                stimHz.shape)
+    if trigger_codes is None:
+        codes = np.full(stimHz.shape, -1.)
+        nChan = 2
+    else:
+        codes = np.broadcast_to(np.asarray(trigger_codes, dtype=float),
+                                stimHz.shape)
+        if trigger_channel not in (0, 1, 2):
+            raise ValueError('trigger_channel must be 0, 1 or 2, not '
+                             '{}'.format(trigger_channel))
+        nChan = 3 if trigger_channel == 2 else 2
+    triples = np.column_stack((stimHz, durations, codes))
+    if len(triples) == 0:
+        return []
+    uniqueStims, trialToTone = np.unique(triples, axis=0, return_inverse=True)
+    trialToTone = trialToTone.ravel()
+
+    tones = [None] * len(uniqueStims)
+    for dur in np.unique(uniqueStims[:, 1]):
+        rows = np.flatnonzero(uniqueStims[:, 1] == dur)
+        stimLenSamp = floor(dur*audioSamplingRate)
+        audMask = _make_audio_mask(stimLenSamp, audioSamplingRate,
+                                   taperLenSec)
+        # (n_tones x n_samples), one row per unique frequency
+        waves = np.sin(2 * np.pi * uniqueStims[rows, 0][:, np.newaxis] *
+                       np.linspace(0, dur, stimLenSamp)[np.newaxis, :])
+        waves *= audMask
+        waves /= np.max(np.abs(waves), axis=1, keepdims=True)
+        waves *= scaling
+        # (n_tones x n_samples x n_chan): same signal on every channel
+        stereo = np.repeat(waves.astype(np.int16)[:, :, np.newaxis], nChan,
+                           axis=2)
+        if trigger_codes is not None:
+            stereo[:, :, trigger_channel] = 0
+            for ii, row in enumerate(rows):
+                pulses = encode_trigger_pulses(int(uniqueStims[row, 2]),
+                                               audioSamplingRate,
+                                               scaling=scaling)
+                pulses = pulses[:stimLenSamp]
+                stereo[ii, :len(pulses), trigger_channel] = pulses
+        stereo.flags.writeable = False
+        for ii, row in enumerate(rows):
+            tones[row] = stereo[ii]
+
+    return [tones[idx] for idx in trialToTone]
+
+
 def loadWavFromDisk(Hz=[800, 1500], dur=1.0):
     if type(Hz) is list:
         leftChanStr = DATA_DIR + 'leftChan-%.0fHz-%0.2fs.wav' % (round(Hz[0]), dur)
@@ -77,15 +269,9 @@ def load_stimuli(stimHz, audioSamplingRate, audStimDur_sec,
         retval = loadWavFromDisk(Hz=stimHz, dur=audStimDur_sec)
     except IOError:
         print("No WAV file for stimuli (Hz: {}, duration: {}s) found! Creating one now...".format(stimHz, audStimDur_sec))
-        audMask = np.ones(int(audStimDur_sec*audioSamplingRate))
-        taperLenSamp = floor(taperLenSec*audioSamplingRate)
         stimLenSamp = floor(audStimDur_sec*audioSamplingRate)
-        taperF = 1./(taperLenSec * 2.)
-        taper = (np.sin(2 * np.pi * taperF *
-                 np.linspace(-taperLenSec / 2., taperLenSec / 2.,
-                             taperLenSamp)) + 1) / 2.
-        audMask[0:taperLenSamp] *= taper
-        audMask[-taperLenSamp:] *= taper[::-1]
+        audMask = _make_audio_mask(stimLenSamp, audioSamplingRate,
+                                   taperLenSec)
 
         if isStereo:
             sinewaveL = audMask * \
@@ -113,11 +299,10 @@ def load_stimuli(stimHz, audioSamplingRate, audStimDur_sec,
                        np.linspace(0, audStimDur_sec, stimLenSamp))
             bothChan = np.require(np.column_stack((sinewaveB, sinewaveB)),
                                   requirements=['C'])
-            bothChanStr = DATA_DIR + 'mono-%.0fHz-%.2fs.wav' % (round(stimHz), audStimDur_sec)
+            bothChanStr = mono_wav_name(stimHz, audStimDur_sec)
             retval = bothChanStr
 
-        # Scaling: maxOutSoundcard: 5.53 Vpp, maxInAttenuator: 3.13 Vpp
-        maxVal16bits = int((2**15 - 1.) / (5.56 / 3.13))
+        maxVal16bits = MAX_VAL_16BITS
 
         if isStereo:
             scaled = np.int16(leftChan / np.max(np.abs(leftChan)) *
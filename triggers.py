@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from warnings import warn
 from psychopy import parallel
+from meeg.triggerdispatch import RecordingPort
 import platform
 
 PLATFORM = platform.platform()
@@ -23,28 +24,21 @@ else:  # on Win this will work, on Mac we catch error below
 # port = parallel
 
 # Figure out whether to flip pins or fake it
+# fake ports record codes and timestamps (see fakePort.read()) rather than
+# printing them, which would add milliseconds to the timed loop
+fakePort = None
 if port is not None:
     try:
         port.setData(128)
     except NotImplementedError:
-        def setParallelData(code=1):
-            if code > 0:
-                # logging.exp('TRIG %d (Fake)' % code)
-                print('TRIG %d (Fake)' % code)
-                pass
+        warn("Parallel port cannot be written. Fake trigger will be used.")
+        fakePort = RecordingPort()
+        setParallelData = fakePort.setData
     else:
         port.setData(0)
         setParallelData = port.setData
 # If port hasn't been found, fake it
 else:
     warn("Parallel port not found. Fake trigger will be used.")
-    lastCode = 0
-    def setParallelData(code=1):
-        global lastCode
-        if code > 0:
-            print('TRIG %d (Fake): ON' % code)
-            lastCode = code
-        else:
-            print('TRIG %d (Fake): OFF' % lastCode)
-            lastCode = code
-
+    fakePort = RecordingPort()
+    setParallelData = fakePort.setData